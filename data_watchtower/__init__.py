@@ -1,9 +1,60 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from .core.base import Validator, DataLoader
-from .core.watchtower import Watchtower
-from .core.data_loaders import *
-from .core.validators import *
-from .model.services import DbServices
+import importlib
 
 __version__ = '0.0.5'
+
+# 第一次访问时才导入对应的模块, 只使用部分功能(例如定时任务、子进程)时不需要导入polars、pandas等
+_LAZY_ATTRIBUTES = {
+    'Validator': '.core.base',
+    'DataLoader': '.core.base',
+    'Watchtower': '.core.watchtower',
+    'DbServices': '.model.services',
+    'MetricsStore': '.model.metrics_store',
+    'ResultWriter': '.model.result_writer',
+    'WatchtowerRunner': '.runner',
+    'DatabaseLoader': '.core.data_loaders',
+    'ParallelDatabaseLoader': '.core.data_loaders',
+    'FileLoader': '.core.data_loaders',
+    'get_registered_data_loader_maps': '.core.data_loaders',
+    'get_registered_data_loaders': '.core.data_loaders',
+    'ExpectColumnValuesToNotBeNull': '.core.validators',
+    'ExpectColumnRecentlyUpdated': '.core.validators',
+    'ExpectColumnStdToBeBetween': '.core.validators',
+    'ExpectColumnMeanToBeBetween': '.core.validators',
+    'ExpectColumnNullRatioToBeBetween': '.core.validators',
+    'ExpectRowCountToBeBetween': '.core.validators',
+    'ExpectColumnDistinctValuesToContainSet': '.core.validators',
+    'ExpectColumnDistinctValuesToEqualSet': '.core.validators',
+    'ExpectColumnDistinctValuesToBeInSet': '.core.validators',
+    'ExpectColumnApproxDistinctCountToBeBetween': '.core.validators',
+    'ExpectColumnQuantileToBeBetween': '.core.validators',
+    'ExpectMetricToMatchBaseline': '.core.validators',
+    'get_registered_validator_maps': '.core.validators',
+    'get_registered_validators': '.core.validators',
+}
+# 以前使用import *导出的其他名称
+_FALLBACK_MODULES = ('.core.data_loaders', '.core.validators')
+
+__all__ = list(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name], __name__), name)
+    elif not name.startswith('_'):
+        for module_name in _FALLBACK_MODULES:
+            module = importlib.import_module(module_name, __name__)
+            if hasattr(module, name):
+                value = getattr(module, name)
+                break
+        else:
+            raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    else:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
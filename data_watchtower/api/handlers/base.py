@@ -1,13 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import hashlib
+import datetime
 import logging
 import tornado.web
 from data_watchtower.utils import json_dumps, json_loads
 
 logger = logging.getLogger(__name__)
 
+# 序列化后的返回数据. {名称: (版本, 数据, etag)}
+RESPONSE_CACHE = {}
+
 
 class BaseHandler(tornado.web.RequestHandler):
+    # 分页接口每页最多返回的行数
+    MAX_LIMIT = 1000
+
     def _handle_request_exception(self, e):
         logger.exception(e)
         self.json(error={'err_code': 1, 'err_msg': str(e)})
@@ -41,6 +49,24 @@ class BaseHandler(tornado.web.RequestHandler):
     def initialize(self, *args, **kwargs):
         self.database = self.settings.get('database')
 
+    def get_time_argument(self, name):
+        value = self.get_argument(name, None)
+        if not value:
+            return None
+        try:
+            return datetime.datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError('%s must be an ISO format time. value:%s' % (name, value))
+
+    def get_int_argument(self, name, default=None):
+        value = self.get_argument(name, None)
+        if not value:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError('%s must be an integer. value:%s' % (name, value))
+
     @staticmethod
     def json_dumps(data):
         return json_dumps(data)
@@ -49,7 +75,7 @@ class BaseHandler(tornado.web.RequestHandler):
     def json_loads(data):
         return json_loads(data)
 
-    def json(self, data=None, error=None):
+    def json_body(self, data=None, error=None):
         if data is None:
             data = []
         if error is None:
@@ -61,4 +87,28 @@ class BaseHandler(tornado.web.RequestHandler):
             'data': data,
         }
         data.update(error)
-        self.write(self.json_dumps(data))
+        return self.json_dumps(data)
+
+    def json(self, data=None, error=None):
+        self.write(self.json_body(data, error))
+
+    def cached_json(self, key, version, build):
+        """
+        返回缓存的数据. 版本变化时调用build重新生成, 请求的If-None-Match与etag相同时返回304
+        :param key: 缓存的名称
+        :param version: 数据的版本
+        :param build: 生成数据的函数
+        :return:
+        """
+        item = RESPONSE_CACHE.get(key)
+        if item is None or item[0] != version:
+            body = self.json_body(build())
+            etag = '"%s"' % hashlib.sha1(body.encode('utf-8')).hexdigest()
+            item = (version, body, etag)
+            RESPONSE_CACHE[key] = item
+        _, body, etag = item
+        self.set_header('Etag', etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.write(body)
@@ -2,25 +2,28 @@
 # -*- coding: utf-8 -*-
 from .base import BaseHandler
 from ...utils import get_subclasses
-from ... import get_registered_data_loaders
+from ... import get_registered_data_loader_maps
 
 
 class DataLoaderListHandler(BaseHandler):
     def get(self):
+        data_loader_maps = get_registered_data_loader_maps()
+        return self.cached_json('data_loaders', data_loader_maps.version,
+                                lambda: self.get_records(data_loader_maps))
+
+    @staticmethod
+    def get_records(data_loader_maps):
         data = []
-        data_loaders = get_registered_data_loaders()
-        for cls in data_loaders:
+        for cls in data_loader_maps.values():
             row = dict(
                 name=cls.__name__,
                 module_path=cls.module_path(),
                 schema=cls.to_schema(),
             )
             data.append(row)
-        result = dict(
+        return dict(
             records=data
         )
-        self.json(result)
-        return
 
     def post(self):
         return self.get()
@@ -2,15 +2,18 @@
 # -*- coding: utf-8 -*-
 from .base import BaseHandler
 from ...utils import get_subclasses
-from ... import get_registered_validators
+from ... import get_registered_validator_maps
 
 
 class ValidatorListHandler(BaseHandler):
     def get(self):
-        data = []
-        validators = get_registered_validators()
-        for cls in validators:
+        validator_maps = get_registered_validator_maps()
+        return self.cached_json('validators', validator_maps.version, lambda: self.get_records(validator_maps))
 
+    @staticmethod
+    def get_records(validator_maps):
+        data = []
+        for cls in validator_maps.values():
             if isinstance(cls.__doc__, str):
                 description = cls.__doc__.split("\f")[0].strip()
             else:
@@ -22,11 +25,9 @@ class ValidatorListHandler(BaseHandler):
                 description=description,
             )
             data.append(row)
-        result = dict(
+        return dict(
             records=data
         )
-        self.json(result)
-        return
 
     def post(self):
         return self.get()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import datetime
 from .base import BaseHandler
 from ...core.watchtower import Watchtower
 from ... import get_registered_data_loader_maps
@@ -45,25 +46,70 @@ class WatchtowerHandler(BaseHandler):
 
 
 class WatchtowerListHandler(BaseHandler):
+    def get_query_args(self):
+        """
+        解析分页和过滤参数. success: true/false/null, 时间使用ISO格式, fields使用逗号分隔.
+        limit最大为MAX_LIMIT. 参数不合法时抛出ValueError
+        :return:
+        """
+        args = dict(
+            after=self.get_argument('after', None),
+            data_loader_cls=self.get_argument('data_loader_cls', None),
+        )
+        limit = self.get_int_argument('limit')
+        if limit is not None:
+            args['limit'] = min(max(limit, 1), self.MAX_LIMIT)
+        success = self.get_argument('success', None)
+        if success:
+            success = success.lower()
+            if success == 'null':
+                args['success'] = 'null'
+            elif success in ('true', '1', 'false', '0'):
+                args['success'] = success in ('true', '1')
+            else:
+                raise ValueError('success must be true, false or null. value:%s' % success)
+        for name in ('run_time_after', 'run_time_before'):
+            value = self.get_time_argument(name)
+            if value is not None:
+                args[name] = value
+        fields = self.get_argument('fields', None)
+        if fields:
+            args['fields'] = [item.strip() for item in fields.split(',') if item.strip()]
+            unknown = set(args['fields']) - set(self.database.WATCHTOWER_LIST_FIELDS) - set(
+                self.database.WATCHTOWER_FIELDS)
+            if unknown:
+                raise ValueError('unknown fields: %s' % ', '.join(sorted(unknown)))
+        return args
+
     def get(self):
-        data = self.database.get_watchtowers()
+        try:
+            args = self.get_query_args()
+        except ValueError as e:
+            self.json(error={'err_code': 1004, 'err_msg': str(e)})
+            return
+        data = self.database.get_watchtowers(**args)
+        data_loader_maps = get_registered_data_loader_maps()
         for item in data:
-            data_loader = item['data_loader']
+            data_loader = item.get('data_loader')
             if isinstance(data_loader, dict):
                 item['data_loader'] = data_loader.pop('__class__')
                 item['cls_name'] = item['data_loader'].split(':')[-1]
                 # item['data_loader_params'] = data_loader
                 item['cls_params'] = data_loader
-                data_loader_maps = get_registered_data_loader_maps()
                 # todo 如果data_loader被删除， 则会报错
+                # schema在每个类第一次使用时生成后缓存
                 data_loader_cls = data_loader_maps[item['cls_name']]
                 item['data_loader_schema'] = data_loader_cls.to_schema()
             if isinstance(item.get('params'), dict):
                 for k, v in item['params'].items():
                     item[k] = v
                 del item['params']
+        next_cursor = None
+        if args.get('limit') and len(data) == args['limit'] and data and 'name' in data[-1]:
+            next_cursor = data[-1]['name']
         result = dict(
-            records=data
+            records=data,
+            next_cursor=next_cursor,
         )
         self.json(result)
         return
@@ -72,6 +118,58 @@ class WatchtowerListHandler(BaseHandler):
         return self.get()
 
 
+class WatchtowerHistoryHandler(BaseHandler):
+    """
+    运行历史. 传入bucket(秒)时返回降采样的结果, 否则返回分页的明细
+    """
+
+    def get_cursor_argument(self, name):
+        # 游标格式: run_time,id
+        value = self.get_argument(name, None)
+        if not value:
+            return None
+        try:
+            run_time, row_id = value.rsplit(',', 1)
+            return datetime.datetime.fromisoformat(run_time), int(row_id)
+        except ValueError:
+            raise ValueError('%s must be a cursor returned by the previous page. value:%s' % (name, value))
+
+    def get(self):
+        wt_name = self.get_argument('name')
+        run_name = self.get_argument('run_name', None)
+        try:
+            start_time = self.get_time_argument('start_time')
+            end_time = self.get_time_argument('end_time')
+            bucket = self.get_int_argument('bucket')
+            limit = self.get_int_argument('limit', 100)
+            after = self.get_cursor_argument('after')
+            if bucket is not None and bucket <= 0:
+                raise ValueError('bucket must be positive. value:%s' % bucket)
+        except ValueError as e:
+            self.json(error={'err_code': 1004, 'err_msg': str(e)})
+            return
+        if bucket is not None:
+            if start_time is None or end_time is None:
+                self.json(error={'err_code': 1003, 'err_msg': 'start_time and end_time are required'})
+                return
+            metrics = self.get_argument('metrics', None)
+            if metrics:
+                metrics = [item.strip() for item in metrics.split(',') if item.strip()]
+            buckets = self.database.get_history_buckets(wt_name, start_time, end_time, bucket,
+                                                        name=run_name, metrics=metrics or None)
+            self.json(dict(buckets=buckets, bucket=bucket))
+            return
+        limit = min(max(limit, 1), self.MAX_LIMIT)
+        with_validators = self.get_argument('validators', 'true').lower() in ('true', '1')
+        records = self.database.get_run_history(wt_name, start_time=start_time, end_time=end_time, after=after,
+                                                limit=limit, name=run_name, with_validators=with_validators)
+        next_cursor = None
+        if len(records) == limit:
+            last = records[-1]
+            next_cursor = '%s,%s' % (last['run_time'].isoformat(), last['id'])
+        self.json(dict(records=records, next_cursor=next_cursor))
+
+
 class ValidatorRelationHandler(BaseHandler):
     def get(self):
         name = self.get_argument('name')
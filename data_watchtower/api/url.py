@@ -6,6 +6,7 @@ URLS = [
     (r"/", validator.ValidatorListHandler),
     (r"/data_watchtower/v1/watchtower", watchtower.WatchtowerHandler),
     (r"/data_watchtower/v1/watchtower/validator", watchtower.ValidatorRelationHandler),
+    (r"/data_watchtower/v1/watchtower/history", watchtower.WatchtowerHistoryHandler),
     (r"/data_watchtower/v1/watchtowers", watchtower.WatchtowerListHandler),
     (r"/data_watchtower/v1/data_loaders", data_loader.DataLoaderListHandler),
     (r"/data_watchtower/v1/validators", validator.ValidatorListHandler),
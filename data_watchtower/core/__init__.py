@@ -1,4 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from .data_loaders import get_registered_data_loader_maps, get_registered_data_loaders
-from .validators import get_registered_validators, get_registered_validator_maps
+import importlib
+
+_LAZY_ATTRIBUTES = {
+    'get_registered_data_loader_maps': '.data_loaders',
+    'get_registered_data_loaders': '.data_loaders',
+    'get_registered_validators': '.validators',
+    'get_registered_validator_maps': '.validators',
+}
+
+__all__ = list(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name], __name__), name)
+    globals()[name] = value
+    return value
@@ -1,22 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import sys
 import datetime
 import logging
+from functools import lru_cache
 import polars as pl
-import pandas as pd
 from attrs import define, field, NOTHING
-from apischema import settings, schema
-from apischema.json_schema import deserialization_schema
-from apischema.objects import ObjectField
 
 from ..utils import to_dict, from_dict, to_snake
 
 logger = logging.getLogger(__name__)
 
-prev_default_object_fields = settings.default_object_fields
+prev_default_object_fields = None
 
 
 def attrs_fields(cls: type):
+    from apischema import schema
+    from apischema.objects import ObjectField
     if hasattr(cls, "__attrs_attrs__"):
         result = []
         for col in getattr(cls, "__attrs_attrs__"):
@@ -35,11 +35,66 @@ def attrs_fields(cls: type):
 
 
 def field_base_schema(tp, name: str, alias: str):
+    from apischema import schema
     return schema(title=alias)
 
 
-settings.base_schema.field = field_base_schema
-settings.default_object_fields = attrs_fields
+@lru_cache(maxsize=None)
+def deserialization_schema(cls):
+    """
+    生成参数的json schema, 每个类只生成一次. apischema只在第一次使用时导入并配置
+    :param cls:
+    :return:
+    """
+    global prev_default_object_fields
+    from apischema import settings
+    from apischema.json_schema import deserialization_schema as _deserialization_schema
+    if prev_default_object_fields is None:
+        prev_default_object_fields = settings.default_object_fields
+        settings.base_schema.field = field_base_schema
+        settings.default_object_fields = attrs_fields
+    return _deserialization_schema(cls)
+
+
+def to_polars_frame(data):
+    """
+    把加载器返回的数据统一转换成pl.DataFrame
+    :param data:
+    :return:
+    """
+    # 没有导入pandas时, 数据不可能是pd.DataFrame
+    pd = sys.modules.get('pandas')
+    if isinstance(data, pl.DataFrame):
+        return data
+    elif pd is not None and isinstance(data, pd.DataFrame):
+        return pl.from_pandas(data)
+    else:
+        return pl.DataFrame(data)
+
+
+def count_expr():
+    """
+    总行数的表达式. 兼容旧版本polars(没有pl.len)
+    :return:
+    """
+    if hasattr(pl, 'len'):
+        return pl.len()
+    return pl.count()
+
+
+def collect_aggregates(data, aggregations):
+    """
+    在一次查询计划里计算所有的聚合表达式
+    :param data: pl.DataFrame 或 pl.LazyFrame. LazyFrame使用polars的streaming引擎计算
+    :param aggregations: {名称: pl.Expr}
+    :return: {名称: 值}
+    """
+    if not aggregations:
+        return {}
+    exprs = [expr.alias(name) for name, expr in aggregations.items()]
+    if isinstance(data, pl.LazyFrame):
+        return data.select(exprs).collect(streaming=True).row(0, named=True)
+    return data.select(exprs).row(0, named=True)
 
 
 class BaseBean:
@@ -57,12 +112,55 @@ class BaseBean:
         return "%s:%s" % (cls.__module__, cls.__name__)
 
 
+def merge_sum(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+    return left + right
+
+
+def merge_min(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+    return min(left, right)
+
+
+def merge_max(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+    return max(left, right)
+
+
+def merge_union(left, right):
+    """
+    合并两个去重后的列表
+    :param left:
+    :param right:
+    :return:
+    """
+    result = list(left or [])
+    seen = set(result)
+    for item in right or []:
+        if item not in seen:
+            seen.add(item)
+            result.append(item)
+    return result
+
+
 @define()
 class DataLoader(BaseBean):
 
     def _load(self):
         raise NotImplementedError
 
+    def _load_lazy(self):
+        return to_polars_frame(self._load()).lazy()
+
     def load(self):
         try:
             return self._load()
@@ -70,6 +168,105 @@ class DataLoader(BaseBean):
             logger.error("Data loading failure. DataLoader: %s" % self.__class__.__name__)
             raise
 
+    def _iter_batches(self, batch_size):
+        yield from to_polars_frame(self._load()).iter_slices(batch_size)
+
+    def iter_batches(self, batch_size):
+        """
+        分批加载数据, 每批是一个pl.DataFrame. 默认先加载全部数据再切分, 支持游标的加载器可以重写_iter_batches
+        :param batch_size: 每批的行数
+        :return:
+        """
+        try:
+            yield from self._iter_batches(batch_size)
+        except Exception as e:
+            logger.error("Data loading failure. DataLoader: %s" % self.__class__.__name__)
+            raise
+
+    @classmethod
+    def supports_incremental(cls):
+        """
+        是否支持只加载水位线之后的数据
+        :return:
+        """
+        return False
+
+    def since(self, column, watermark):
+        """
+        返回一个只加载column大于watermark的数据的加载器
+        :param column: 水位线字段
+        :param watermark: 上次加载到的水位线
+        :return: DataLoader
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def supports_sampling(cls):
+        """
+        是否支持在数据源中随机抽样
+        :return:
+        """
+        return False
+
+    def sample(self, sample_size):
+        """
+        返回一个只加载sample_size行随机样本的加载器
+        :param sample_size: 样本行数
+        :return: DataLoader
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def supports_pushdown(cls):
+        """
+        是否支持把聚合下推到数据源计算
+        :return:
+        """
+        return False
+
+    def quote_identifier(self, name):
+        raise NotImplementedError
+
+    def stddev_function(self):
+        """
+        数据源的样本标准差聚合函数名, 不支持时返回None
+        :return:
+        """
+        return None
+
+    def get_columns(self):
+        """
+        数据源的字段名称, 不加载数据. 下推前用于检查校验器引用的字段是否存在
+        :return:
+        """
+        raise NotImplementedError
+
+    def _load_aggregates(self, sql_aggregations):
+        raise NotImplementedError
+
+    def load_aggregates(self, sql_aggregations):
+        """
+        在数据源中计算聚合, 只返回一行结果
+        :param sql_aggregations: {名称: SQL聚合表达式}
+        :return: {名称: 值}
+        """
+        try:
+            return self._load_aggregates(sql_aggregations)
+        except Exception as e:
+            logger.error("Data loading failure. DataLoader: %s" % self.__class__.__name__)
+            raise
+
+    def load_lazy(self):
+        """
+        以pl.LazyFrame的形式加载数据. 默认先加载到内存, 支持扫描的加载器可以重写_load_lazy
+        :return:
+        """
+        try:
+            return self._load_lazy()
+        except Exception as e:
+            logger.error("Data loading failure. DataLoader: %s" % self.__class__.__name__)
+            raise
+
     @classmethod
     def to_schema(cls):
         return deserialization_schema(cls)
@@ -94,6 +291,10 @@ class Validator(object):
         self._data = None
         self.result = None
         self.params = params
+        # 校验的是随机样本时的置信水平, 为None表示校验全部数据
+        self.sample_confidence = None
+        # baseline_key不为None时, Watchtower在运行前设置该指标历史值的MetricBaseline
+        self.baseline = None
 
     @classmethod
     def to_schema(cls):
@@ -107,22 +308,94 @@ class Validator(object):
     def params_to_dict(self):
         return to_dict(self.params)
 
-    def _validation(self):
+    def aggregations(self):
+        """
+        校验需要的聚合表达式, 格式: {名称: pl.Expr}
+        Watchtower会把所有校验器的表达式合并成一次查询, 计算结果交给_validation_with_aggregates.
+        返回None表示不支持, 使用_validation单独计算
+        :return:
+        """
+        return None
+
+    def sql_aggregations(self, quote):
+        """
+        可以下推到数据库计算的聚合, 格式: {名称: SQL聚合表达式}
+        返回None表示不支持下推, 需要加载数据后计算
+        :param quote: 给字段名加引号的函数. quote.stddev是样本标准差的函数名, 数据库不支持时为None
+        :return:
+        """
+        return None
+
+    def finalize_sql_aggregates(self, values):
+        """
+        把SQL聚合的结果转换成与aggregations()相同格式的结果
+        :param values: {名称: 值}, 名称与sql_aggregations()一致
+        :return:
+        """
+        return values
+
+    def merge_aggregates(self, left, right):
+        """
+        合并两批数据的聚合结果, 用于分批加载的数据. 合并后的结果与一次计算全部数据的结果格式相同
+        :param left: {名称: 值}
+        :param right: {名称: 值}
+        :return:
+        """
         raise NotImplementedError
 
-    def validation(self):
+    def supports_merge(self):
+        return type(self).merge_aggregates is not Validator.merge_aggregates and self.aggregations() is not None
+
+    @classmethod
+    def supports_sampling(cls):
+        """
+        是否可以只校验随机样本. 比率类的校验器可以根据样本给出置信区间,
+        行数、去重集合、非空等校验的结果与样本的大小有关, 抽样时仍然校验全部数据
+        :return:
+        """
+        return False
+
+    def baseline_key(self):
+        """
+        需要与历史结果比较的指标名称. 返回None表示不需要历史的状态.
+        运行后新的状态保存在ValidationResult.extra['baseline']中
+        :return:
+        """
+        return None
+
+    def _validation_with_aggregates(self, aggregates):
+        """
+        根据聚合结果生成ValidationResult
+        :param aggregates: {名称: 值}, 名称与aggregations()一致
+        :return:
+        """
+        raise NotImplementedError
+
+    def _validation(self):
+        aggregations = self.aggregations()
+        if aggregations is None:
+            raise NotImplementedError
+        if isinstance(self._data, pl.LazyFrame):
+            aggregates = collect_aggregates(self._data, aggregations)
+        else:
+            aggregates = collect_aggregates(self.get_data(), aggregations)
+        return self._validation_with_aggregates(aggregates)
+
+    def validation(self, aggregates=None):
+        if aggregates is not None:
+            return self._validation_with_aggregates(aggregates)
         result = self._validation()
         return result
 
     def set_data(self, data):
-        if isinstance(data, pl.DataFrame):
+        if isinstance(data, pl.LazyFrame):
             self._data = data
-        elif isinstance(data, pd.DataFrame):
-            self._data = pl.from_pandas(data)
         else:
-            self._data = pl.DataFrame(data)
+            self._data = to_polars_frame(data)
 
     def get_data(self):
+        if isinstance(self._data, pl.LazyFrame):
+            self._data = self._data.collect(streaming=True)
         if isinstance(self._data, pl.DataFrame):
             return self._data
         else:
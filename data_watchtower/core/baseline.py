@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import math
+import statistics
+
+# 中位数绝对偏差转换为正态分布标准差的系数
+MAD_SCALE = 1.4826
+
+
+class MetricBaseline(object):
+    """
+    某个指标历史值的增量状态. 每次运行只更新一次, 与历史的长度无关:
+    count/mean/m2: 全部历史的平均值和方差(Welford)
+    ewma/ewm_var: 指数加权的平均值和方差, 近似最近N次运行
+    window: 最近N次的原始值, 用于计算中位数绝对偏差
+    """
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, ewma=None, ewm_var=0.0, window=None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.ewma = ewma
+        self.ewm_var = ewm_var
+        self.window = list(window or [])
+
+    @classmethod
+    def load(cls, value):
+        if value is None:
+            return cls()
+        return cls(**value)
+
+    def dumps(self):
+        return dict(
+            count=self.count,
+            mean=self.mean,
+            m2=self.m2,
+            ewma=self.ewma,
+            ewm_var=self.ewm_var,
+            window=self.window,
+        )
+
+    @property
+    def std(self):
+        if self.count < 2:
+            return None
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    @property
+    def ewm_std(self):
+        if self.ewma is None:
+            return None
+        return math.sqrt(self.ewm_var)
+
+    def update(self, value, window_size):
+        """
+        加入一个新的值, 返回新的状态
+        :param value:
+        :param window_size: 最近的运行次数. 指数加权的系数为2/(window_size+1)
+        :return:
+        """
+        count = self.count + 1
+        delta = value - self.mean
+        mean = self.mean + delta / count
+        m2 = self.m2 + delta * (value - mean)
+        alpha = 2 / (window_size + 1)
+        if self.ewma is None:
+            ewma, ewm_var = value, 0.0
+        else:
+            diff = value - self.ewma
+            increment = alpha * diff
+            ewma = self.ewma + increment
+            ewm_var = (1 - alpha) * (self.ewm_var + diff * increment)
+        window = (self.window + [value])[-window_size:]
+        return MetricBaseline(count, mean, m2, ewma, ewm_var, window)
+
+    def score(self, value, method='zscore'):
+        """
+        新的值偏离历史的程度, 单位是标准差
+        :param value:
+        :param method: zscore 使用指数加权的平均值和标准差; mad 使用最近N次的中位数和中位数绝对偏差
+        :return: (分数, 中心值, 离散程度)
+        """
+        if method == 'zscore':
+            center, spread = self.ewma, self.ewm_std
+        elif method == 'mad':
+            center = statistics.median(self.window)
+            spread = MAD_SCALE * statistics.median([abs(x - center) for x in self.window])
+        else:
+            raise ValueError('method must be zscore or mad. value:%s' % method)
+        deviation = abs(value - center)
+        if spread:
+            return deviation / spread, center, spread
+        # 历史值完全相同时, 只要不相等就是异常
+        return (0.0 if deviation == 0 else float('inf')), center, spread
@@ -3,12 +3,12 @@
 import os
 from functools import lru_cache
 
-import pandas as pd
 import polars as pl
-from attrs import define, field
+from attrs import define, field, evolve
 
 from .base import DataLoader
-from ..utils import connect_db_from_url, get_subclasses, load_subclasses
+from ..utils import (get_pooled_database, get_subclasses, get_plugin_index, LazyClassMap, quote_identifier,
+                     to_connectorx_uri, sql_literal, random_function, stddev_function)
 
 CUSTOM_DATA_LOADER_PATH = os.getenv("DW_CUSTOM_DATA_LOADER_PATH", "dw_custom.data_loaders")
 
@@ -21,39 +21,157 @@ class DatabaseLoader(DataLoader):
     query = field(type=str)
     connection = field(type=str)
 
+    def get_database(self):
+        """
+        使用进程内共享的连接池, 用完后调用database.close()把连接还给连接池
+        :return:
+        """
+        return get_pooled_database(self.connection)
+
     def _load(self):
-        if pl.__version__ > '0.18.4':
-            database = connect_db_from_url(self.connection)
+        database = self.get_database()
+        try:
             connection = database.connection()
-            data = pl.read_database(self.query, connection=connection)
-            connection.close()
+            if pl.__version__ > '0.18.4':
+                data = pl.read_database(self.query, connection=connection)
+            else:
+                import pandas as pd
+                data = pd.read_sql(sql=self.query, con=connection)
+        finally:
             database.close()
-            return data
-        else:
-            database = connect_db_from_url(self.connection)
+        return data
+
+    def _iter_batches(self, batch_size):
+        database = self.get_database()
+        try:
             connection = database.connection()
-            data = pd.read_sql(sql=self.query, con=connection)
-            connection.close()
+            if pl.__version__ > '0.18.4':
+                yield from pl.read_database(self.query, connection=connection,
+                                            iter_batches=True, batch_size=batch_size)
+            else:
+                import pandas as pd
+                for chunk in pd.read_sql(sql=self.query, con=connection, chunksize=batch_size):
+                    yield pl.from_pandas(chunk)
+        finally:
             database.close()
-            return data
+
+    @classmethod
+    def supports_incremental(cls):
+        return True
+
+    def since(self, column, watermark):
+        if watermark is None:
+            return self
+        query = "SELECT * FROM (%s) dw_incremental WHERE %s > %s" % (
+            self.query.strip().rstrip(';'), self.quote_identifier(column), sql_literal(watermark))
+        return evolve(self, query=query)
+
+    @classmethod
+    def supports_sampling(cls):
+        return True
+
+    def sample(self, sample_size):
+        query = "SELECT * FROM (%s) dw_sample ORDER BY %s LIMIT %d" % (
+            self.query.strip().rstrip(';'), random_function(self.get_database()), sample_size)
+        return evolve(self, query=query)
+
+    @classmethod
+    def supports_pushdown(cls):
+        return True
+
+    def quote_identifier(self, name):
+        return quote_identifier(self.get_database(), name)
+
+    def stddev_function(self):
+        return stddev_function(self.get_database())
+
+    def get_columns(self):
+        query = "SELECT * FROM (%s) dw_columns LIMIT 0" % self.query.strip().rstrip(';')
+        database = self.get_database()
+        try:
+            cursor = database.execute_sql(query)
+            return [item[0] for item in cursor.description]
+        finally:
+            database.close()
+
+    def get_pushdown_query(self, sql_aggregations):
+        """
+        把聚合表达式包装在用户的查询外面, 只返回一行结果
+        :param sql_aggregations: {名称: SQL聚合表达式}
+        :return:
+        """
+        columns = ", ".join("%s AS %s" % (sql, self.quote_identifier(name)) for name, sql in sql_aggregations.items())
+        query = self.query.strip().rstrip(';')
+        return "SELECT %s FROM (%s) dw_pushdown" % (columns, query)
+
+    def _load_aggregates(self, sql_aggregations):
+        query = self.get_pushdown_query(sql_aggregations)
+        database = self.get_database()
+        try:
+            cursor = database.execute_sql(query)
+            row = cursor.fetchone()
+        finally:
+            database.close()
+        return dict(zip(sql_aggregations.keys(), row))
+
+
+@define()
+class ParallelDatabaseLoader(DatabaseLoader):
+    """
+    使用connectorx多线程读取数据库, 数据直接以Arrow格式读入polars.
+    指定partition_on时, 按照该字段(数值类型)的范围把查询拆分成partition_num个查询并行读取
+    """
+    partition_on = field(default=None, type=str, metadata={'help': '用于分区的数值类型字段'})
+    partition_num = field(default=None, type=int, metadata={'help': '分区数量, 默认为CPU核数'})
+
+    def _load(self):
+        uri = to_connectorx_uri(self.connection)
+        if self.partition_on:
+            partition_num = self.partition_num or os.cpu_count() or 1
+            return pl.read_database_uri(self.query, uri, engine='connectorx',
+                                        partition_on=self.partition_on, partition_num=partition_num)
+        return pl.read_database_uri(self.query, uri, engine='connectorx')
+
+
+@define()
+class FileLoader(DataLoader):
+    """
+    加载本地或者远程的数据文件. 使用LazyFrame加载时只扫描文件, 不会把整个文件读入内存
+    """
+    path = field(type=str, metadata={'help': '文件路径, 支持通配符'})
+    file_format = field(default='parquet', type=str, metadata={'help': 'parquet, csv, ipc, ndjson'})
+
+    def _load(self):
+        return self._load_lazy().collect()
+
+    def _load_lazy(self):
+        if self.file_format == 'parquet':
+            return pl.scan_parquet(self.path)
+        elif self.file_format == 'csv':
+            return pl.scan_csv(self.path)
+        elif self.file_format == 'ipc':
+            return pl.scan_ipc(self.path)
+        elif self.file_format == 'ndjson':
+            return pl.scan_ndjson(self.path)
+        else:
+            raise ValueError('file_format must be parquet, csv, ipc or ndjson. value:%s' % self.file_format)
 
 
 @lru_cache()
 def get_registered_data_loader_maps():
+    """
+    内置的以及自定义的data loader. 自定义模块的类名使用持久化的索引查找, 第一次访问时才导入
+    :return: {类名: 类}
+    """
     custom_path = CUSTOM_DATA_LOADER_PATH.split(";")
-    subclasses = get_subclasses(DataLoader)
-    try:
-        custom_subclasses = load_subclasses(custom_path, DataLoader)
-    except ModuleNotFoundError:
-        custom_subclasses = []
-    result = {}
-    for cls in (subclasses + custom_subclasses):
-        cls_name = cls.__name__
-        if cls_name in result:
+    items = [(cls.__name__, cls.module_path()) for cls in get_subclasses(DataLoader)]
+    items.extend(get_plugin_index().get_classes(custom_path, DataLoader).items())
+    paths = {}
+    for cls_name, path in items:
+        if paths.get(cls_name, path) != path:
             raise ValueError("Duplicate data loader name: %s" % cls_name)
-        else:
-            result[cls.__name__] = cls
-    return result
+        paths[cls_name] = path
+    return LazyClassMap(paths)
 
 
 def get_registered_data_loaders():
@@ -3,6 +3,7 @@
 import os
 import logging
 import datetime
+from functools import lru_cache
 from data_watchtower.utils import load_object
 
 logger = logging.getLogger(__name__)
@@ -36,10 +37,19 @@ DEFAULT_MACRO_CONFIG = {
     },
 
 }
-try:
-    dw_custom_macro_config = os.getenv("DW_CUSTOM_MACRO_CONFIG", 'dw_custom.macros:DEFAULT_MACRO_CONFIG')
-    custom_macro = load_object(dw_custom_macro_config)
-    DEFAULT_MACRO_CONFIG.update(custom_macro)
-    logger.info('custom macros loaded. count:%s' % len(custom_macro))
-except (ModuleNotFoundError, NameError):
-    pass
+
+
+@lru_cache()
+def get_default_macro_config():
+    """
+    默认的宏以及自定义的宏. 自定义的宏在第一次使用时才导入
+    :return:
+    """
+    try:
+        dw_custom_macro_config = os.getenv("DW_CUSTOM_MACRO_CONFIG", 'dw_custom.macros:DEFAULT_MACRO_CONFIG')
+        custom_macro = load_object(dw_custom_macro_config)
+        DEFAULT_MACRO_CONFIG.update(custom_macro)
+        logger.info('custom macros loaded. count:%s' % len(custom_macro))
+    except (ModuleNotFoundError, NameError):
+        pass
+    return DEFAULT_MACRO_CONFIG
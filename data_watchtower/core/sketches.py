@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+可以合并、可以序列化的近似统计结构. 用于分批加载、增量校验以及跨多次运行合并结果
+"""
+import math
+import base64
+
+import numpy as np
+import polars as pl
+
+HASH_SEED = 20240501
+
+
+class HyperLogLog(object):
+    """
+    近似去重计数. 相对误差约为 1.04 / sqrt(2 ** precision)
+    """
+
+    def __init__(self, precision, registers=None):
+        self.precision = precision
+        self.m = 1 << precision
+        if registers is None:
+            registers = np.zeros(self.m, dtype=np.uint8)
+        self.registers = registers
+
+    @staticmethod
+    def precision_for_error(relative_error):
+        """
+        根据期望的相对误差计算precision, 范围[4, 18]
+        :param relative_error: eg. 0.02
+        :return:
+        """
+        precision = math.ceil(2 * math.log2(1.04 / relative_error))
+        return min(max(precision, 4), 18)
+
+    @staticmethod
+    def expr(column, precision):
+        """
+        计算寄存器的polars表达式. 结果是 寄存器序号 * 64 + 寄存器的值 组成的列表
+        :param column:
+        :param precision:
+        :return:
+        """
+        bits = 64 - precision
+        hashed = pl.col(column).drop_nulls().hash(HASH_SEED)
+        index = (hashed // (1 << bits)).cast(pl.Int64)
+        rest = hashed % (1 << bits)
+        # 剩余的bits中第一个1的位置
+        rank = pl.when(rest > 0).then(bits - rest.cast(pl.Float64).log(2).floor()).otherwise(bits + 1)
+        encoded = (index * 64 + rank.cast(pl.Int64)).unique().sort()
+        # 每个寄存器只保留最大值
+        return encoded.filter(((encoded // 64) != (encoded // 64).shift(-1)).fill_null(True)).implode()
+
+    @classmethod
+    def load(cls, value, precision):
+        """
+        :param value: expr()的计算结果, 或者dumps()的结果
+        :param precision:
+        :return:
+        """
+        if isinstance(value, str):
+            registers = np.frombuffer(base64.b64decode(value), dtype=np.uint8).copy()
+            return cls(precision, registers)
+        inst = cls(precision)
+        if value:
+            encoded = np.asarray(value, dtype=np.int64)
+            inst.registers[encoded // 64] = encoded % 64
+        return inst
+
+    def dumps(self):
+        return base64.b64encode(self.registers.tobytes()).decode('ascii')
+
+    def merge(self, other):
+        return HyperLogLog(self.precision, np.maximum(self.registers, other.registers))
+
+    def estimate(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros > 0:
+            # 基数较小时使用线性计数
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+class TDigest(object):
+    """
+    近似分位数. compression越大越精确, 质心数量约为 compression / 2
+    """
+
+    def __init__(self, compression, means=None, counts=None, min_value=None, max_value=None):
+        self.compression = compression
+        self.means = np.asarray(means if means is not None else [], dtype=np.float64)
+        self.counts = np.asarray(counts if counts is not None else [], dtype=np.float64)
+        self.min_value = min_value
+        self.max_value = max_value
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def _scale(self, q):
+        return self.compression / (2 * math.pi) * np.arcsin(2 * q - 1)
+
+    @staticmethod
+    def expr(column, compression):
+        """
+        计算质心的polars表达式. 排序后按照分位数把相邻的值划分到同一个质心,
+        返回每个质心最后一个值的位置以及累加和, 只包含少量的数据
+        :param column:
+        :param compression:
+        :return:
+        """
+        values = pl.col(column).drop_nulls().cast(pl.Float64).sort()
+        count = values.len()
+        q = (pl.int_range(0, count) + 0.5) / count
+        cluster = (compression / (2 * math.pi) * (q * 2 - 1).arcsin()).floor()
+        last = (cluster != cluster.shift(-1)).fill_null(True)
+        return pl.struct(
+            pl.int_range(0, count).filter(last).implode().alias('ends'),
+            values.cum_sum().filter(last).implode().alias('sums'),
+            values.min().alias('min'),
+            values.max().alias('max'),
+        )
+
+    @classmethod
+    def load(cls, value, compression):
+        """
+        :param value: expr()的计算结果, 或者dumps()的结果
+        :param compression:
+        :return:
+        """
+        if value is None:
+            return cls(compression)
+        if 'centroids' in value:
+            centroids = value['centroids'] or []
+            return cls(compression, [x[0] for x in centroids], [x[1] for x in centroids],
+                       value.get('min'), value.get('max'))
+        ends = np.asarray(value['ends'] or [], dtype=np.float64)
+        sums = np.asarray(value['sums'] or [], dtype=np.float64)
+        counts = np.diff(np.concatenate([[-1], ends]))
+        means = np.diff(np.concatenate([[0], sums])) / np.where(counts > 0, counts, 1)
+        return cls(compression, means, counts, value.get('min'), value.get('max'))
+
+    def dumps(self):
+        return dict(
+            centroids=[[float(x), int(y)] for x, y in zip(self.means, self.counts)],
+            min=self.min_value,
+            max=self.max_value,
+        )
+
+    def merge(self, other):
+        means = np.concatenate([self.means, other.means])
+        counts = np.concatenate([self.counts, other.counts])
+        min_value = min((x for x in (self.min_value, other.min_value) if x is not None), default=None)
+        max_value = max((x for x in (self.max_value, other.max_value) if x is not None), default=None)
+        if len(means) == 0:
+            return TDigest(self.compression, min_value=min_value, max_value=max_value)
+        order = np.argsort(means, kind='mergesort')
+        means, counts = means[order], counts[order]
+        total = counts.sum()
+        q = (np.cumsum(counts) - counts / 2) / total
+        cluster = np.floor(self._scale(q))
+        # 相邻的质心属于同一个分位区间时合并
+        starts = np.concatenate([[True], cluster[1:] != cluster[:-1]])
+        group = np.cumsum(starts) - 1
+        merged_counts = np.bincount(group, weights=counts)
+        merged_means = np.bincount(group, weights=means * counts) / merged_counts
+        return TDigest(self.compression, merged_means, merged_counts, min_value, max_value)
+
+    def quantile(self, q):
+        """
+        :param q: 0~1
+        :return:
+        """
+        if len(self.means) == 0:
+            return None
+        total = self.counts.sum()
+        positions = np.cumsum(self.counts) - self.counts / 2
+        points = np.concatenate([[0], positions, [total]])
+        values = np.concatenate([[self.min_value], self.means, [self.max_value]])
+        return float(np.interp(q * total, points, values))
@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import math
 import datetime
 import logging
 from functools import lru_cache
-import arrow
+from statistics import NormalDist
+import polars as pl
 from attrs import define, field
-from .base import Validator, ValidationResult
+from .base import (Validator, ValidationResult, count_expr, merge_sum, merge_min, merge_max, merge_union)
+from .sketches import HyperLogLog, TDigest
+from .baseline import MetricBaseline
 
-from ..utils import get_subclasses, load_subclasses
+from ..utils import get_subclasses, get_plugin_index, LazyClassMap
 
 CUSTOM_VALIDATOR_PATH = os.getenv("DW_CUSTOM_VALIDATOR_PATH", "dw_custom.data_loaders")
 logger = logging.getLogger(__name__)
@@ -16,20 +20,19 @@ logger = logging.getLogger(__name__)
 
 @lru_cache()
 def get_registered_validator_maps():
+    """
+    内置的以及自定义的validator. 自定义模块的类名使用持久化的索引查找, 第一次访问时才导入
+    :return: {类名: 类}
+    """
     custom_path = CUSTOM_VALIDATOR_PATH.split(";")
-    subclasses = get_subclasses(Validator)
-    try:
-        custom_subclasses = load_subclasses(custom_path, Validator)
-    except ModuleNotFoundError:
-        custom_subclasses = []
-    result = {}
-    for cls in (subclasses + custom_subclasses):
-        cls_name = cls.__name__
-        if cls_name in result:
-            raise ValueError("Duplicate data loader name: %s" % cls_name)
-        else:
-            result[cls.__name__] = cls
-    return result
+    items = [(cls.__name__, cls.module_path()) for cls in get_subclasses(Validator)]
+    items.extend(get_plugin_index().get_classes(custom_path, Validator).items())
+    paths = {}
+    for cls_name, path in items:
+        if paths.get(cls_name, path) != path:
+            raise ValueError("Duplicate validator name: %s" % cls_name)
+        paths[cls_name] = path
+    return LazyClassMap(paths)
 
 
 def get_registered_validators():
@@ -37,6 +40,230 @@ def get_registered_validators():
     return list(result.values())
 
 
+HISTOGRAM_BINS = 10
+SUMMARY_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+SUMMARY_COMPRESSION = 100
+
+
+def to_float(value):
+    """
+    数据库返回的Decimal等类型转换成float
+    :param value:
+    :return:
+    """
+    if value is None:
+        return None
+    return float(value)
+
+
+def wilson_interval(positive, total, confidence):
+    """
+    根据样本计算比率的Wilson置信区间
+    :param positive: 样本中满足条件的行数
+    :param total: 样本行数
+    :param confidence: 置信水平, eg. 0.95
+    :return: (下限, 上限)
+    """
+    if not total:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    ratio = positive / total
+    denominator = 1 + z * z / total
+    center = (ratio + z * z / (2 * total)) / denominator
+    margin = z * math.sqrt(ratio * (1 - ratio) / total + z * z / (4 * total * total)) / denominator
+    return max(center - margin, 0.0), min(center + margin, 1.0)
+
+
+def sql_moments(quote, column):
+    """
+    计算平均值和标准差需要的SQL聚合. 标准差使用数据库的样本标准差函数, 数据库不支持时返回None(不下推).
+    不使用平方和计算, 数值较大且方差较小时平方和相减会损失全部精度
+    :param quote:
+    :param column:
+    :return:
+    """
+    stddev = getattr(quote, 'stddev', None)
+    if stddev is None:
+        return None
+    column = quote(column)
+    return dict(
+        count="COUNT(%s)" % column,
+        mean="AVG(%s)" % column,
+        std="%s(%s)" % (stddev, column),
+        min="MIN(%s)" % column,
+        max="MAX(%s)" % column,
+    )
+
+
+def finalize_sql_moments(values):
+    # 下推时没有分位数和直方图
+    return dict(
+        count=values['count'],
+        mean=to_float(values['mean']),
+        std=to_float(values['std']),
+        min=to_float(values['min']),
+        max=to_float(values['max']),
+    )
+
+
+def histogram_expr(column, bins=HISTOGRAM_BINS):
+    """
+    等宽直方图, 区间为[min, max]. 返回每个区间的行数
+    :param column:
+    :param bins:
+    :return:
+    """
+    col = pl.col(column).cast(pl.Float64)
+    low, high = col.min(), col.max()
+    index = pl.when(high > low).then(((col - low) / ((high - low) / bins)).floor()).when(col.is_not_null()).then(0)
+    index = index.clip(0, bins - 1)
+    return pl.concat_list([(index == i).sum() for i in range(bins)])
+
+
+def summary_aggregations(column, keep_values=False, max_values=None):
+    """
+    字段的统计摘要: 非空行数、平均值、标准差、最大最小值、分位数、直方图. 大小与数据量无关.
+    分位数由t-digest估算, 分批和增量校验时可以合并
+    :param column:
+    :param keep_values: 是否保留原始数据
+    :param max_values: 最多保留的原始数据条数
+    :return:
+    """
+    col = pl.col(column)
+    result = dict(
+        count=col.is_not_null().sum(),
+        mean=col.mean(),
+        std=col.std(),
+        min=col.min(),
+        max=col.max(),
+        digest=TDigest.expr(column, SUMMARY_COMPRESSION),
+        histogram=histogram_expr(column),
+    )
+    if keep_values:
+        result['rows'] = count_expr()
+        result['values'] = col.head(max_values).implode() if max_values else col.implode()
+    return result
+
+
+def check_max_values(params):
+    """
+    保留原始数据时必须限制条数, 否则分批和增量校验时内存与数据量成正比
+    :param params:
+    :return:
+    """
+    if params.keep_values and not (params.max_values and params.max_values > 0):
+        raise ValueError('max_values must be a positive integer when keep_values is set. value:%s'
+                         % params.max_values)
+
+
+def merge_histogram(left, right, low, high):
+    """
+    合并两个直方图. 按照原区间的中点重新分配到新的区间, 结果是近似值
+    :param left: {min, max, histogram}
+    :param right: {min, max, histogram}
+    :param low: 合并后的最小值
+    :param high: 合并后的最大值
+    :return:
+    """
+    bins = len(left.get('histogram') or right.get('histogram') or []) or HISTOGRAM_BINS
+    counts = [0] * bins
+    for item in (left, right):
+        histogram = item.get('histogram')
+        if not histogram or item.get('min') is None:
+            continue
+        width = (to_float(item['max']) - to_float(item['min'])) / len(histogram)
+        for i, count in enumerate(histogram):
+            if not count:
+                continue
+            center = to_float(item['min']) + (i + 0.5) * width
+            if high > low:
+                index = min(max(int((center - low) / (high - low) * bins), 0), bins - 1)
+            else:
+                index = 0
+            counts[index] += count
+    return counts
+
+
+def merge_summary(left, right, max_values=None):
+    """
+    合并两批数据的统计摘要. 平均值、标准差、最大最小值与一次计算的结果相同;
+    分位数合并t-digest, 误差与一次计算的t-digest相当; 直方图按照原区间的中点重新分配
+    :param left:
+    :param right:
+    :param max_values: 最多保留的原始数据条数, 为空时合并后不保留原始数据
+    :return:
+    """
+    result = merge_moments(left, right)
+    result['min'] = merge_min(left.get('min'), right.get('min'))
+    result['max'] = merge_max(left.get('max'), right.get('max'))
+    if 'digest' in left and 'digest' in right:
+        digest = TDigest.load(left['digest'], SUMMARY_COMPRESSION).merge(
+            TDigest.load(right['digest'], SUMMARY_COMPRESSION))
+        result['digest'] = digest.dumps()
+    if 'histogram' in left and 'histogram' in right and result['min'] is not None:
+        result['histogram'] = merge_histogram(left, right, to_float(result['min']), to_float(result['max']))
+    if 'values' in left and 'values' in right and max_values:
+        # 只保留前max_values条, 分批合并时占用的内存与数据量无关
+        result['rows'] = left['rows'] + right['rows']
+        values = list(left['values'][:max_values])
+        if len(values) < max_values:
+            values.extend(right['values'][:max_values - len(values)])
+        result['values'] = values
+    return result
+
+
+def summary_metrics(aggregates):
+    """
+    统计摘要转换成metrics
+    :param aggregates:
+    :return:
+    """
+    metrics = dict(
+        min=to_float(aggregates.get('min')),
+        max=to_float(aggregates.get('max')),
+    )
+    if aggregates.get('digest') is not None:
+        digest = TDigest.load(aggregates['digest'], SUMMARY_COMPRESSION)
+        quantiles = [digest.quantile(q) for q in SUMMARY_QUANTILES]
+        metrics['quantiles'] = {
+            str(q): None if v is None else round(v, 4)
+            for q, v in zip(SUMMARY_QUANTILES, quantiles)
+        }
+    if aggregates.get('histogram') is not None and metrics['min'] is not None:
+        bins = len(aggregates['histogram'])
+        width = (metrics['max'] - metrics['min']) / bins
+        metrics['histogram'] = dict(
+            edges=[round(metrics['min'] + i * width, 4) for i in range(bins + 1)],
+            counts=list(aggregates['histogram']),
+        )
+    if 'values' in aggregates:
+        metrics['values'] = list(aggregates['values'])
+        metrics['values_truncated'] = aggregates['rows'] > len(metrics['values'])
+    return metrics
+
+
+def merge_moments(left, right):
+    """
+    合并两批数据的非空行数、平均值、样本标准差(Chan的并行算法)
+    :param left: {count, mean, std}
+    :param right: {count, mean, std}
+    :return: {count, mean, std}
+    """
+    n1, n2 = left['count'] or 0, right['count'] or 0
+    if n1 == 0:
+        return dict(count=n2, mean=right['mean'], std=right['std'])
+    if n2 == 0:
+        return dict(count=n1, mean=left['mean'], std=left['std'])
+    mean1, mean2 = to_float(left['mean']), to_float(right['mean'])
+    m2_1 = (to_float(left['std']) or 0) ** 2 * (n1 - 1)
+    m2_2 = (to_float(right['std']) or 0) ** 2 * (n2 - 1)
+    count = n1 + n2
+    delta = mean2 - mean1
+    mean = mean1 + delta * n2 / count
+    m2 = m2_1 + m2_2 + delta ** 2 * n1 * n2 / count
+    return dict(count=count, mean=mean, std=math.sqrt(m2 / (count - 1)))
+
+
 class ExpectColumnValuesToNotBeNull(Validator):
     @define()
     class Params:
@@ -46,14 +273,31 @@ class ExpectColumnValuesToNotBeNull(Validator):
         super().__init__(params)
         self.params = params
 
-    def _validation(self):
-        df = self.get_data()
-        temp = df.filter(df[self.params.column].is_null())
+    def aggregations(self):
+        return dict(
+            null_rows=pl.col(self.params.column).null_count(),
+            total_rows=count_expr(),
+        )
+
+    def sql_aggregations(self, quote):
+        return dict(
+            null_rows="COUNT(*) - COUNT(%s)" % quote(self.params.column),
+            total_rows="COUNT(*)",
+        )
+
+    def merge_aggregates(self, left, right):
+        return dict(
+            null_rows=merge_sum(left['null_rows'], right['null_rows']),
+            total_rows=merge_sum(left['total_rows'], right['total_rows']),
+        )
+
+    def _validation_with_aggregates(self, aggregates):
+        null_rows = aggregates['null_rows']
         return ValidationResult(
-            success=len(temp) == 0,
+            success=null_rows == 0,
             metrics=dict(
-                null_rows=len(temp),
-                total_rows=len(df),
+                null_rows=null_rows,
+                total_rows=aggregates['total_rows'],
             )
         )
 
@@ -78,16 +322,36 @@ class ExpectColumnRecentlyUpdated(Validator):
         if isinstance(value, datetime.datetime):
             return value
         try:
+            import arrow
             value = arrow.get(value).datetime.replace(tzinfo=None)
         except Exception as e:
             logger.warning("value_to_datetime error: %s", exc_info=e)
         return value
 
+    def aggregations(self):
+        return dict(
+            last_updated_time=pl.col(self.params.update_time_column).max(),
+        )
+
+    def sql_aggregations(self, quote):
+        return dict(
+            last_updated_time="MAX(%s)" % quote(self.params.update_time_column),
+        )
+
+    def merge_aggregates(self, left, right):
+        return dict(
+            last_updated_time=merge_max(left['last_updated_time'], right['last_updated_time']),
+        )
+
     def _validation(self):
-        df = self.get_data()
         try:
-            last_updated_time = df[self.params.update_time_column].max()
-        except (IndexError, KeyError, ValueError):
+            return super()._validation()
+        except (IndexError, KeyError, ValueError, pl.ColumnNotFoundError):
+            return self._validation_with_aggregates(dict(last_updated_time=None))
+
+    def _validation_with_aggregates(self, aggregates):
+        last_updated_time = aggregates['last_updated_time']
+        if last_updated_time is None:
             return ValidationResult(
                 success=False,
                 metrics=dict(
@@ -117,31 +381,48 @@ class ExpectColumnStdToBeBetween(Validator):
                           metadata={'help': 'The minimum value for the column standard deviation.'})
         max_value = field(default=None, type=float,
                           metadata={'help': 'The maximum value for the column standard deviation.'})
+        keep_values = field(default=False, type=bool,
+                            metadata={'help': 'Keep the raw column values in the metrics.'})
+        max_values = field(default=10000, type=int,
+                           metadata={'help': 'The maximum number of raw values to keep.'})
 
     def __init__(self, params: Params):
         super().__init__(params)
         self.params = params
+        check_max_values(params)
 
-    def _validation(self):
-        df = self.get_data()
-        column = self.params.column
+    def aggregations(self):
+        return summary_aggregations(self.params.column, self.params.keep_values, self.params.max_values)
+
+    def sql_aggregations(self, quote):
+        # 下推时不会返回原始数据, metrics中没有values
+        return sql_moments(quote, self.params.column)
+
+    def finalize_sql_aggregates(self, values):
+        return finalize_sql_moments(values)
+
+    def merge_aggregates(self, left, right):
+        return merge_summary(left, right, self.params.max_values)
+
+    def _validation_with_aggregates(self, aggregates):
         min_value = self.params.min_value
         max_value = self.params.max_value
-        std = round(df[column].std(), 2)
-        mean = round(df[column].mean(), 2)
+        std = round(aggregates['std'], 2)
+        mean = round(aggregates['mean'], 2)
         success = True
         if min_value is not None or max_value is not None:
             min_value = min_value or -float('inf')
             max_value = max_value or float('inf')
             success = min_value < std < max_value
 
+        metrics = dict(
+            std=std,
+            mean=mean,
+        )
+        metrics.update(summary_metrics(aggregates))
         result = ValidationResult(
             success=success,
-            metrics=dict(
-                values=list(df[column]),
-                std=std,
-                mean=mean,
-            )
+            metrics=metrics,
         )
         return result
 
@@ -156,31 +437,48 @@ class ExpectColumnMeanToBeBetween(Validator):
         column = field(type=str, metadata={'help': 'The column name'})
         min_value = field(default=None, type=float, metadata={'help': 'The minimum value for the column mean.'})
         max_value = field(default=None, type=float, metadata={'help': 'The maximum value for the column mean.'})
+        keep_values = field(default=False, type=bool,
+                            metadata={'help': 'Keep the raw column values in the metrics.'})
+        max_values = field(default=10000, type=int,
+                           metadata={'help': 'The maximum number of raw values to keep.'})
 
     def __init__(self, params: Params):
         super().__init__(params)
         self.params = params
+        check_max_values(params)
 
-    def _validation(self):
-        df = self.get_data()
-        column = self.params.column
+    def aggregations(self):
+        return summary_aggregations(self.params.column, self.params.keep_values, self.params.max_values)
+
+    def sql_aggregations(self, quote):
+        # 下推时不会返回原始数据, metrics中没有values
+        return sql_moments(quote, self.params.column)
+
+    def finalize_sql_aggregates(self, values):
+        return finalize_sql_moments(values)
+
+    def merge_aggregates(self, left, right):
+        return merge_summary(left, right, self.params.max_values)
+
+    def _validation_with_aggregates(self, aggregates):
         min_value = self.params.min_value
         max_value = self.params.max_value
-        mean = round(df[column].mean(), 2)
-        std = round(df[column].std(), 2)
+        mean = round(aggregates['mean'], 2)
+        std = round(aggregates['std'], 2)
         success = True
         if min_value is not None or max_value is not None:
             min_value = min_value or -float('inf')
             max_value = max_value or float('inf')
             success = min_value < mean < max_value
 
+        metrics = dict(
+            mean=mean,
+            std=std,
+        )
+        metrics.update(summary_metrics(aggregates))
         result = ValidationResult(
             success=success,
-            metrics=dict(
-                values=list(df[column]),
-                mean=mean,
-                std=std,
-            )
+            metrics=metrics,
         )
 
         return result
@@ -201,30 +499,60 @@ class ExpectColumnNullRatioToBeBetween(Validator):
         super().__init__(params)
         self.params = params
 
-    def _validation(self):
-        df = self.get_data()
-        column = self.params.column
+    @classmethod
+    def supports_sampling(cls):
+        return True
+
+    def aggregations(self):
+        return dict(
+            total_rows=count_expr(),
+            null_rows=pl.col(self.params.column).null_count(),
+        )
+
+    def sql_aggregations(self, quote):
+        return dict(
+            total_rows="COUNT(*)",
+            null_rows="COUNT(*) - COUNT(%s)" % quote(self.params.column),
+        )
+
+    def merge_aggregates(self, left, right):
+        return dict(
+            total_rows=merge_sum(left['total_rows'], right['total_rows']),
+            null_rows=merge_sum(left['null_rows'], right['null_rows']),
+        )
+
+    def _validation_with_aggregates(self, aggregates):
         min_value = self.params.min_value
         max_value = self.params.max_value
-        total_rows = len(df)
-        null_rows = df[column].is_null().sum()
+        total_rows = aggregates['total_rows']
+        null_rows = aggregates['null_rows']
         if total_rows > 0:
             null_ratio = round(null_rows / total_rows, 3)
         else:
             null_ratio = 0
+        metrics = dict(
+            null_ratio=null_ratio,
+            total_rows=total_rows,
+            null_rows=null_rows,
+        )
+        lower = upper = null_ratio
+        if self.sample_confidence is not None:
+            # 校验的是样本, 置信区间与范围有交集时认为通过
+            lower, upper = wilson_interval(null_rows, total_rows, self.sample_confidence)
+            metrics.update(
+                null_ratio_lower=round(lower, 3),
+                null_ratio_upper=round(upper, 3),
+                confidence=self.sample_confidence,
+            )
         success = True
         if min_value is not None or max_value is not None:
             min_value = min_value or -float('inf')
             max_value = max_value or float('inf')
-            success = min_value < null_ratio < max_value
+            success = upper > min_value and lower < max_value
 
         result = ValidationResult(
             success=success,
-            metrics=dict(
-                null_ratio=null_ratio,
-                total_rows=total_rows,
-                null_rows=null_rows,
-            )
+            metrics=metrics,
         )
 
         return result
@@ -245,11 +573,25 @@ class ExpectRowCountToBeBetween(Validator):
         super().__init__(params)
         self.params = params
 
-    def _validation(self):
-        df = self.get_data()
+    def aggregations(self):
+        return dict(
+            total_rows=count_expr(),
+        )
+
+    def sql_aggregations(self, quote):
+        return dict(
+            total_rows="COUNT(*)",
+        )
+
+    def merge_aggregates(self, left, right):
+        return dict(
+            total_rows=merge_sum(left['total_rows'], right['total_rows']),
+        )
+
+    def _validation_with_aggregates(self, aggregates):
         min_value = self.params.min_value
         max_value = self.params.max_value
-        total_rows = len(df)
+        total_rows = aggregates['total_rows']
         success = True
         if min_value is not None or max_value is not None:
             min_value = min_value or -float('inf')
@@ -283,11 +625,19 @@ class ExpectColumnDistinctValuesToContainSet(Validator):
         super().__init__(params)
         self.params = params
 
-    def _validation(self):
-        df = self.get_data()
-        column = self.params.column
+    def aggregations(self):
+        return dict(
+            column_values=pl.col(self.params.column).unique().implode(),
+        )
+
+    def merge_aggregates(self, left, right):
+        return dict(
+            column_values=merge_union(left['column_values'], right['column_values']),
+        )
+
+    def _validation_with_aggregates(self, aggregates):
         value_set = self.params.value_set
-        column_values = set(df[column])
+        column_values = set(aggregates['column_values'])
         success = column_values >= value_set
         laced_values = sorted(value_set - column_values)
         result = ValidationResult(
@@ -316,11 +666,19 @@ class ExpectColumnDistinctValuesToEqualSet(Validator):
         super().__init__(params)
         self.params = params
 
-    def _validation(self):
-        df = self.get_data()
-        column = self.params.column
+    def aggregations(self):
+        return dict(
+            column_values=pl.col(self.params.column).unique().implode(),
+        )
+
+    def merge_aggregates(self, left, right):
+        return dict(
+            column_values=merge_union(left['column_values'], right['column_values']),
+        )
+
+    def _validation_with_aggregates(self, aggregates):
         value_set = self.params.value_set
-        column_values = set(df[column])
+        column_values = set(aggregates['column_values'])
         success = column_values == value_set
         column_laced_values = sorted(value_set - column_values)
         param_laced_values = sorted(column_values - value_set)
@@ -351,11 +709,19 @@ class ExpectColumnDistinctValuesToBeInSet(Validator):
         super().__init__(params)
         self.params = params
 
-    def _validation(self):
-        df = self.get_data()
-        column = self.params.column
+    def aggregations(self):
+        return dict(
+            column_values=pl.col(self.params.column).unique().implode(),
+        )
+
+    def merge_aggregates(self, left, right):
+        return dict(
+            column_values=merge_union(left['column_values'], right['column_values']),
+        )
+
+    def _validation_with_aggregates(self, aggregates):
         value_set = self.params.value_set
-        column_values = set(df[column])
+        column_values = set(aggregates['column_values'])
         success = column_values <= value_set
         # 指定字段的值比参数多的数据
         excrescent_values = sorted(column_values - value_set)
@@ -366,3 +732,248 @@ class ExpectColumnDistinctValuesToBeInSet(Validator):
             )
         )
         return result
+
+
+class ExpectColumnApproxDistinctCountToBeBetween(Validator):
+    """
+    指定字段去重后的数量在某个范围. 使用HyperLogLog估算, 内存占用与数据量无关
+    """
+
+    @define()
+    class Params:
+        column = field(type=str, metadata={'help': 'The column name'})
+        min_value = field(default=None, type=float, metadata={'help': 'The minimum distinct count, inclusive.'})
+        max_value = field(default=None, type=float, metadata={'help': 'The maximum distinct count, inclusive.'})
+        relative_error = field(default=0.02, type=float,
+                               metadata={'help': 'The expected relative error of the estimate.'})
+
+    def __init__(self, params: Params):
+        super().__init__(params)
+        self.params = params
+        if not (params.relative_error and 0 < params.relative_error < 1):
+            raise ValueError('relative_error must be between 0 and 1. value:%s' % params.relative_error)
+
+    @property
+    def precision(self):
+        return HyperLogLog.precision_for_error(self.params.relative_error)
+
+    def aggregations(self):
+        return dict(
+            registers=HyperLogLog.expr(self.params.column, self.precision),
+        )
+
+    def merge_aggregates(self, left, right):
+        # 合并后保存序列化的结果, 可以直接写入state
+        sketch = HyperLogLog.load(left['registers'], self.precision)
+        sketch = sketch.merge(HyperLogLog.load(right['registers'], self.precision))
+        return dict(
+            registers=sketch.dumps(),
+        )
+
+    def _validation_with_aggregates(self, aggregates):
+        min_value = self.params.min_value
+        max_value = self.params.max_value
+        sketch = HyperLogLog.load(aggregates['registers'], self.precision)
+        distinct_count = sketch.estimate()
+        success = True
+        if min_value is not None and distinct_count < min_value:
+            success = False
+        if max_value is not None and distinct_count > max_value:
+            success = False
+        result = ValidationResult(
+            success=success,
+            metrics=dict(
+                distinct_count=distinct_count,
+                precision=self.precision,
+                sketch=sketch.dumps(),
+            )
+        )
+        return result
+
+
+class ExpectColumnQuantileToBeBetween(Validator):
+    """
+    指定字段的分位数在某个范围. 使用t-digest估算, 内存占用与数据量无关
+    """
+
+    @define()
+    class Params:
+        column = field(type=str, metadata={'help': 'The column name'})
+        quantile = field(type=float, metadata={'help': 'The quantile to check, between 0 and 1.'})
+        min_value = field(default=None, type=float, metadata={'help': 'The minimum value for the quantile.'})
+        max_value = field(default=None, type=float, metadata={'help': 'The maximum value for the quantile.'})
+        compression = field(default=100, type=int,
+                            metadata={'help': 'The t-digest compression, larger is more accurate.'})
+
+    def __init__(self, params: Params):
+        super().__init__(params)
+        self.params = params
+        if params.quantile is None or not 0 <= params.quantile <= 1:
+            raise ValueError('quantile must be between 0 and 1. value:%s' % params.quantile)
+        if not (params.compression and params.compression > 0):
+            raise ValueError('compression must be a positive integer. value:%s' % params.compression)
+
+    def aggregations(self):
+        return dict(
+            digest=TDigest.expr(self.params.column, self.params.compression),
+        )
+
+    def merge_aggregates(self, left, right):
+        compression = self.params.compression
+        digest = TDigest.load(left['digest'], compression).merge(TDigest.load(right['digest'], compression))
+        return dict(
+            digest=digest.dumps(),
+        )
+
+    def _validation_with_aggregates(self, aggregates):
+        min_value = self.params.min_value
+        max_value = self.params.max_value
+        digest = TDigest.load(aggregates['digest'], self.params.compression)
+        quantile_value = digest.quantile(self.params.quantile)
+        success = True
+        if quantile_value is None:
+            success = False
+        else:
+            if min_value is not None and quantile_value < min_value:
+                success = False
+            if max_value is not None and quantile_value > max_value:
+                success = False
+        result = ValidationResult(
+            success=success,
+            metrics=dict(
+                quantile_value=quantile_value,
+                count=digest.count,
+                sketch=digest.dumps(),
+            )
+        )
+        return result
+
+
+class ExpectMetricToMatchBaseline(Validator):
+    """
+    指标与watchtower自身的历史结果相比没有异常. 历史保存为增量更新的状态, 每次校验的耗时与历史的长度无关
+    """
+    COLUMN_METRICS = ('null_count', 'null_ratio', 'mean', 'std', 'min', 'max', 'sum')
+    NUMERIC_METRICS = ('mean', 'std', 'min', 'max', 'sum')
+
+    @define()
+    class Params:
+        metric = field(default='row_count', type=str,
+                       metadata={'help': 'The metric to check: row_count, null_count, null_ratio, mean, std, min, '
+                                         'max or sum.'})
+        column = field(default=None, type=str, metadata={'help': 'The column name, not required for row_count.'})
+        method = field(default='zscore', type=str,
+                       metadata={'help': 'zscore: exponentially weighted mean and std; mad: median absolute '
+                                         'deviation of the recent runs.'})
+        window = field(default=30, type=int, metadata={'help': 'The number of recent runs the baseline follows.'})
+        threshold = field(default=3.0, type=float,
+                          metadata={'help': 'The maximum deviation from the baseline, in standard deviations.'})
+        min_history = field(default=5, type=int,
+                            metadata={'help': 'The number of runs required before the check is enforced.'})
+
+    def __init__(self, params: Params):
+        super().__init__(params)
+        self.params = params
+        if params.metric != 'row_count' and params.metric not in self.COLUMN_METRICS:
+            raise ValueError('unknown metric: %s' % params.metric)
+        if params.metric in self.COLUMN_METRICS and not params.column:
+            raise ValueError('column is required for metric: %s' % params.metric)
+        if params.method not in ('zscore', 'mad'):
+            raise ValueError('method must be zscore or mad. value:%s' % params.method)
+
+    def baseline_key(self):
+        if self.params.metric in self.COLUMN_METRICS:
+            return '%s:%s' % (self.params.metric, self.params.column)
+        return self.params.metric
+
+    def aggregations(self):
+        result = dict(total_rows=count_expr())
+        if self.params.metric in self.COLUMN_METRICS:
+            col = pl.col(self.params.column)
+            result['count'] = col.count()
+            if self.params.metric in self.NUMERIC_METRICS:
+                col = col.cast(pl.Float64)
+                result.update(sum=col.sum(), min=col.min(), max=col.max())
+            if self.params.metric == 'std':
+                result.update(mean=col.mean(), std=col.std())
+        return result
+
+    def sql_aggregations(self, quote):
+        result = dict(total_rows="COUNT(*)")
+        if self.params.metric in self.COLUMN_METRICS:
+            column = quote(self.params.column)
+            result['count'] = "COUNT(%s)" % column
+            if self.params.metric in self.NUMERIC_METRICS:
+                result.update(
+                    sum="SUM(%s)" % column,
+                    min="MIN(%s)" % column,
+                    max="MAX(%s)" % column,
+                )
+            if self.params.metric == 'std':
+                moments = sql_moments(quote, self.params.column)
+                if moments is None:
+                    return None
+                result.update(mean=moments['mean'], std=moments['std'])
+        return result
+
+    def finalize_sql_aggregates(self, values):
+        return {k: to_float(v) if k in ('sum', 'min', 'max', 'mean', 'std') else v for k, v in values.items()}
+
+    def merge_aggregates(self, left, right):
+        result = {}
+        if 'std' in left:
+            moments = merge_moments(left, right)
+            result.update(mean=moments['mean'], std=moments['std'])
+        for key in left:
+            if key in ('mean', 'std'):
+                continue
+            elif key == 'min':
+                result[key] = merge_min(left[key], right[key])
+            elif key == 'max':
+                result[key] = merge_max(left[key], right[key])
+            else:
+                result[key] = merge_sum(left[key], right[key])
+        return result
+
+    def compute_metric(self, aggregates):
+        metric = self.params.metric
+        total_rows = aggregates['total_rows']
+        if metric == 'row_count':
+            return total_rows
+        count = aggregates['count'] or 0
+        if metric == 'null_count':
+            return total_rows - count
+        if metric == 'null_ratio':
+            return (total_rows - count) / total_rows if total_rows else 0
+        if metric == 'std':
+            return to_float(aggregates['std']) if count >= 2 else None
+        if metric == 'mean':
+            return aggregates['sum'] / count if count else None
+        return aggregates[metric]
+
+    def _validation_with_aggregates(self, aggregates):
+        value = self.compute_metric(aggregates)
+        baseline = self.baseline or MetricBaseline()
+        metrics = dict(
+            value=value,
+            history_count=baseline.count,
+        )
+        success = True
+        if value is None:
+            # 没有非空值时无法计算, 也不更新历史
+            success = baseline.count < self.params.min_history
+            return ValidationResult(success=success, metrics=metrics)
+        if baseline.count >= self.params.min_history:
+            score, center, spread = baseline.score(value, self.params.method)
+            success = score <= self.params.threshold
+            metrics.update(
+                score=round(score, 3) if math.isfinite(score) else None,
+                baseline=center,
+                spread=spread,
+            )
+        result = ValidationResult(
+            success=success,
+            metrics=metrics,
+        )
+        result.extra['baseline'] = baseline.update(value, self.params.window).dumps()
+        return result
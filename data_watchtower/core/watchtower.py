@@ -1,11 +1,143 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import copy
+import hashlib
+import logging
 import datetime
 
-from data_watchtower.utils import (spawn_data_loader_from_dict, spawn_validator_from_dict,
-                                   get_string_values, MacroTemplate, json_loads, json_dumps)
-from data_watchtower.core.macro import DEFAULT_MACRO_CONFIG
+import polars as pl
+from data_watchtower.utils import (spawn_data_loader_from_dict, spawn_validator_from_dict, load_object,
+                                   get_string_values, MacroTemplate, json_loads, json_dumps, state_dumps,
+                                   is_plain_string, SqlQuote, params_hash)
+from data_watchtower.core.macro import get_default_macro_config
+from data_watchtower.core.baseline import MetricBaseline
+from data_watchtower.core.base import to_polars_frame, collect_aggregates, merge_max, count_expr, ValidationResult
+
+logger = logging.getLogger(__name__)
+
+# 原始数据只出现在本次运行的metrics中, 不写入保存的状态
+RAW_VALUE_KEYS = ('values', 'values_truncated', 'rows')
+
+
+def without_raw_values(item):
+    if not isinstance(item, dict):
+        return item
+    return {k: v for k, v in item.items() if k not in RAW_VALUE_KEYS}
+
+
+class WatermarkTracker(object):
+    """
+    与校验器一起计算水位线字段的最大值. 不是校验器, 不会出现在校验结果中
+    """
+
+    def __init__(self, column):
+        self.column = column
+
+    def aggregations(self):
+        return dict(watermark=pl.col(self.column).max())
+
+    def sql_aggregations(self, quote):
+        return dict(watermark="MAX(%s)" % quote(self.column))
+
+    def finalize_sql_aggregates(self, values):
+        return values
+
+    def supports_merge(self):
+        return True
+
+    def merge_aggregates(self, left, right):
+        return dict(watermark=merge_max(left['watermark'], right['watermark']))
+
+
+class FingerprintTracker(object):
+    """
+    数据的指纹: 行数, 所有行的哈希之和, 每个字段的哈希之和. 与行的顺序无关.
+    在校验器之前单独计算, 与上次相同时不计算校验器的聚合
+    """
+    seed = 20240501
+
+    def aggregations(self):
+        return dict(
+            row_count=count_expr(),
+            rows=pl.struct(pl.all()).hash(self.seed).sum(),
+            columns=pl.struct(pl.all().hash(self.seed).sum()),
+        )
+
+    def sql_aggregations(self, quote):
+        return None
+
+    def supports_merge(self):
+        return True
+
+    def merge_aggregates(self, left, right):
+        columns = dict(left['columns'])
+        for k, v in right['columns'].items():
+            columns[k] = (columns.get(k, 0) + v) % 2 ** 64
+        return dict(
+            row_count=left['row_count'] + right['row_count'],
+            rows=(left['rows'] + right['rows']) % 2 ** 64,
+            columns=columns,
+        )
+
+    @staticmethod
+    def to_fingerprint(aggregates):
+        if aggregates is None:
+            return None
+        # 不同版本的polars哈希结果可能不同
+        return dict(aggregates, polars_version=pl.__version__)
+
+
+class WatchtowerPlan(object):
+    """
+    预先编译的执行计划: 加载器和校验器的类只解析一次, 不包含宏的加载器和校验器参数只构造一次.
+    每次运行只替换包含宏的字段
+    """
+
+    def __init__(self, data_loader_meta, validators_meta):
+        self.data_loader_meta = data_loader_meta
+        self.data_loader_cls = load_object(data_loader_meta['__class__'])
+        self.data_loader_macro_keys = {k for k, v in data_loader_meta.items()
+                                       if isinstance(v, str) and not is_plain_string(v)}
+        self.data_loader = None
+        if not self.data_loader_macro_keys:
+            self.data_loader = spawn_data_loader_from_dict(data_loader_meta)
+        self.validators = []
+        for item in validators_meta:
+            cls = load_object(item['__class__'])
+            params = None
+            if all(is_plain_string(v) for v in get_string_values(item['params'])):
+                params = cls.from_dict(item).params
+            self.validators.append((cls, item, params))
+
+    def spawn_data_loader(self, macro_template):
+        """
+        :param macro_template: 本次运行使用的宏
+        :return: (data_loader, 替换宏之后的参数)
+        """
+        if self.data_loader is not None:
+            return self.data_loader, self.data_loader_meta
+        data_loader_meta = {}
+        for k, v in self.data_loader_meta.items():
+            if k in self.data_loader_macro_keys:
+                data_loader_meta[k] = macro_template.apply_string(v)
+            else:
+                data_loader_meta[k] = v
+        item = {k: v for k, v in data_loader_meta.items() if k != '__class__'}
+        return self.data_loader_cls.from_dict(item), data_loader_meta
+
+    def spawn_validators(self, macro_template):
+        """
+        :param macro_template: 本次运行使用的宏
+        :return: [(validator, params)]
+        """
+        result = []
+        for cls, item, params in self.validators:
+            if params is not None:
+                # 参数不包含宏, 直接使用构造好的参数
+                result.append((cls(params), item['params']))
+            else:
+                validator_params = macro_template.apply(item['params'])
+                result.append((cls.from_dict(dict(item, params=validator_params)), validator_params))
+        return result
 
 
 class Watchtower(object):
@@ -14,7 +146,8 @@ class Watchtower(object):
 
         :param name:
         :param data_loader:
-        :param params: schedule, validator_success_method, success_method
+        :param params: schedule, validator_success_method, success_method, lazy, pushdown, batch_size,
+            watermark_column, fingerprint, sample_size, sample_confidence, sample_seed
         """
         custom_macro_map = custom_macro_map or {}  # 只是运行的时候使用,不会保存
         self.params = params
@@ -24,9 +157,12 @@ class Watchtower(object):
         self._validators_meta = []
         self.name = name
         self.metrics = {}
-        self.macro_map = copy.deepcopy(DEFAULT_MACRO_CONFIG)
+        self.macro_map = dict(get_default_macro_config())
         self.macro_map.update(custom_macro_map)
         self.macro_template = MacroTemplate(self.macro_map)
+        # 模板中使用的宏名称, 添加校验器时重新计算
+        self._macro_names = None
+        self._plan = None
         # 回填默认值
         self.params['schedule'] = self.schedule
         self.params['validator_success_method'] = self.validator_success_method
@@ -40,11 +176,80 @@ class Watchtower(object):
     def validator_success_method(self):
         return self.params.get('validator_success_method', 'all')
 
+    @property
+    def lazy(self):
+        """
+        是否使用LazyFrame加载数据, 聚合使用polars的streaming引擎计算, 适用于超过内存的数据
+        :return:
+        """
+        return self.params.get('lazy', False)
+
+    @property
+    def pushdown(self):
+        """
+        是否把聚合下推到数据库计算, 只在加载器支持时生效
+        :return:
+        """
+        return self.params.get('pushdown', False)
+
+    @property
+    def batch_size(self):
+        """
+        分批加载数据时每批的行数. 为None时一次加载全部数据
+        :return:
+        """
+        return self.params.get('batch_size')
+
+    @property
+    def watermark_column(self):
+        """
+        增量校验使用的水位线字段. 每次只加载该字段大于上次水位线的数据, 与保存的聚合状态合并后校验.
+        适用于只追加的表, 需要所有校验器都支持合并
+        :return:
+        """
+        return self.params.get('watermark_column')
+
+    @property
+    def fingerprint(self):
+        """
+        是否计算数据指纹. 数据指纹和参数都与上次运行相同时, 直接使用上次的校验结果. 增量校验和抽样时不生效.
+        先只计算指纹, 相同时不计算校验器的聚合(分位数、去重等), 也不写入校验器明细; 数据仍然需要全部加载一次.
+        指纹变化时, 加载的数据直接用于校验; 设置了batch_size时不保留数据, 需要再分批加载一次.
+        指纹需要每一行的数据, 不能下推到数据库. 同时开启pushdown且加载器支持下推时, 不计算指纹
+        :return:
+        """
+        return self.params.get('fingerprint', False)
+
+    @property
+    def sample_size(self):
+        """
+        支持抽样的校验器只校验随机抽取的sample_size行数据. 加载器支持时在数据源中抽样, 否则加载后在polars中抽样.
+        其他校验器仍然校验全部数据. 抽样时不使用增量校验和数据指纹
+        :return:
+        """
+        return self.params.get('sample_size')
+
+    @property
+    def sample_confidence(self):
+        """
+        抽样时比率类校验器计算置信区间使用的置信水平
+        :return:
+        """
+        return self.params.get('sample_confidence', 0.95)
+
+    @property
+    def sample_seed(self):
+        """
+        在polars中抽样时使用的随机种子
+        :return:
+        """
+        return self.params.get('sample_seed')
+
     @property
     def success_method(self):
         success_method = self.params.get('success_method')
         if success_method is None:
-            if len(self.macro_template.get_used_macro_maps([self.name])) > 0:
+            if len(self.macro_template.get_used_macro_names([self.name])) > 0:
                 return 'all'
             else:
                 return 'last'
@@ -54,6 +259,15 @@ class Watchtower(object):
     def set_custom_macro(self, **custom_macro_map):
         self.macro_map.update(custom_macro_map)
         self.macro_template.macro_config.update(custom_macro_map)
+        self._macro_names = None
+
+    def set_macro_cache(self, macro_cache):
+        """
+        多个watchtower共享callable宏的计算结果
+        :param macro_cache: MacroCache
+        :return:
+        """
+        self.macro_template.macro_cache = macro_cache
 
     @classmethod
     def from_dict(cls, data):
@@ -76,6 +290,8 @@ class Watchtower(object):
     def add_validator(self, validator):
         item = validator.to_dict()
         self._validators_meta.append(item)
+        self._macro_names = None
+        self._plan = None
 
     def get_validator_meta(self):
         return self._validators_meta
@@ -87,11 +303,16 @@ class Watchtower(object):
     def get_params_strings(params):
         return params
 
+    def get_macro_names(self):
+        if self._macro_names is None:
+            strings = [self.name]
+            strings.extend(get_string_values(self._data_loader_meta))
+            strings.extend(get_string_values(self._validators_meta))
+            self._macro_names = self.macro_template.get_used_macro_names(strings)
+        return self._macro_names
+
     def get_macro_maps(self):
-        strings = [self.name]
-        strings.extend(get_string_values(self._data_loader_meta))
-        strings.extend(get_string_values(self._validators_meta))
-        return self.macro_template.get_used_macro_maps(strings)
+        return self.macro_template.get_macro_map(self.get_macro_names())
 
     def gen_metrics(self, data, validators_result):
         # self.metrics = data
@@ -107,40 +328,379 @@ class Watchtower(object):
             raise ValueError('validator_success_method must be any or all.')
         return success_method(success_list)
 
-    def run_validators(self, data, macro_template):
+    @staticmethod
+    def compute_aggregates(data, validators):
+        """
+        把所有校验器的聚合表达式合并成一次查询计划, 只扫描一次数据. 相同的表达式只计算一次
+        :param data: pl.DataFrame 或 pl.LazyFrame
+        :param validators:
+        :return: 与validators一一对应的聚合结果, 不支持聚合的校验器对应None
+        """
+        schema = data.schema
+        columns = set(schema)
+        null_columns = [name for name, dtype in schema.items() if dtype == pl.Null]
+        if null_columns:
+            # 全部为空的字段(例如分批加载时的某一批)没有类型, 很多聚合不支持
+            data = data.with_columns(pl.col(null_columns).cast(pl.Float64))
+        exprs = {}
+        plans = []
+        for validator in validators:
+            aggregations = validator.aggregations()
+            plan = None
+            if aggregations is not None:
+                plan = {}
+                for name, expr in aggregations.items():
+                    if not set(expr.meta.root_names()) <= columns:
+                        # 字段不存在, 交给校验器自己处理
+                        plan = None
+                        break
+                    key = str(expr)
+                    if key not in exprs:
+                        exprs[key] = ("_agg_%s" % len(exprs), expr)
+                    plan[name] = exprs[key][0]
+            plans.append(plan)
+        values = collect_aggregates(data, dict(exprs.values()))
+        result = []
+        for plan in plans:
+            if plan is None:
+                result.append(None)
+            else:
+                result.append({name: values[alias] for name, alias in plan.items()})
+        return result
+
+    @staticmethod
+    def compute_pushdown_aggregates(data_loader, validators):
+        """
+        把校验器的聚合编译成一条SQL, 在数据库中计算. 相同的表达式只计算一次
+        :param data_loader:
+        :param validators:
+        :return: 与validators一一对应的聚合结果, 不支持下推的校验器对应None.
+            引用了不存在的字段的校验器也对应None, 在加载的数据上由校验器自己处理, 不会使整条SQL失败
+        """
+        exprs = {}
+        plans = []
+        quote = SqlQuote(data_loader.quote_identifier, data_loader.stddev_function())
+        columns = None
+        for validator in validators:
+            sql_aggregations = validator.sql_aggregations(quote)
+            plan = None
+            if sql_aggregations is not None:
+                if columns is None:
+                    columns = set(data_loader.get_columns())
+                aggregations = validator.aggregations() or {}
+                if not all(set(expr.meta.root_names()) <= columns for expr in aggregations.values()):
+                    sql_aggregations = None
+            if sql_aggregations is not None:
+                plan = {}
+                for name, sql in sql_aggregations.items():
+                    if sql not in exprs:
+                        exprs[sql] = "_agg_%s" % len(exprs)
+                    plan[name] = exprs[sql]
+            plans.append(plan)
+        if not exprs:
+            return [None] * len(validators)
+        values = data_loader.load_aggregates({alias: sql for sql, alias in exprs.items()})
         result = []
-        for item in self._validators_meta:
-            validator_item = {}
-            for k, v in item.items():
-                if k == 'params':
-                    validator_item['params'] = macro_template.apply(v)
+        for validator, plan in zip(validators, plans):
+            if plan is None:
+                result.append(None)
+            else:
+                result.append(validator.finalize_sql_aggregates({name: values[alias] for name, alias in plan.items()}))
+        return result
+
+    def compute_batch_aggregates(self, data_loader, validators, batch_size):
+        """
+        分批加载数据, 每批计算一次聚合后合并, 内存占用与数据总量无关.
+        第一批之后仍然都可以合并时, 不保留批次的数据. 之后某一批不能计算聚合(例如字段不存在)时,
+        前面的批次已经丢弃, 这些校验器返回None, 由调用方加载完整的数据校验, 不会只校验部分数据
+        :param data_loader:
+        :param validators:
+        :param batch_size:
+        :return: (合并后的完整数据或None, 与validators一一对应的聚合结果)
+        """
+        mergeable = [validator.supports_merge() for validator in validators]
+        states = [None] * len(validators)
+        batches = []
+        first = True
+        keep_batches = True
+        for batch in data_loader.iter_batches(batch_size):
+            indexes = [i for i, flag in enumerate(mergeable) if flag]
+            fused = self.compute_aggregates(batch, [validators[i] for i in indexes])
+            for i, aggregates in zip(indexes, fused):
+                if aggregates is None:
+                    # 字段不存在等情况, 交给校验器自己处理
+                    mergeable[i] = False
+                elif first:
+                    states[i] = aggregates
                 else:
-                    validator_item[k] = v
+                    states[i] = validators[i].merge_aggregates(states[i], aggregates)
+            if first:
+                keep_batches = not all(mergeable)
+            elif keep_batches is False and not all(mergeable):
+                # 前面的批次已经丢弃, 不能只使用剩余的批次
+                keep_batches = None
+            if keep_batches:
+                batches.append(batch)
+            first = False
+        for i, flag in enumerate(mergeable):
+            if not flag:
+                states[i] = None
+        data = None
+        if batches:
+            data = pl.concat(batches, how='diagonal_relaxed')
+        elif first:
+            # 没有数据
+            states = [None] * len(validators)
+        return data, states
 
-            validator = spawn_validator_from_dict(validator_item)
-            validator.set_data(data)
-            validator_result = validator.validation()
-            validator_result.params = validator_item['params']
+    def compile(self):
+        """
+        生成执行计划, 多次运行时复用. 添加校验器后重新生成
+        :return: WatchtowerPlan
+        """
+        if self._plan is None:
+            self._plan = WatchtowerPlan(self._data_loader_meta, self._validators_meta)
+        return self._plan
+
+    def spawn_validators(self, macro_template):
+        """
+        替换参数里的宏, 生成校验器
+        :param macro_template:
+        :return: [(validator, params)]
+        """
+        return self.compile().spawn_validators(macro_template)
+
+    def run_validators(self, data, validators, validators_aggregates=None):
+        """
+        执行校验
+        :param data: 加载的数据. 所有校验器都已经有聚合结果时可以为None
+        :param validators: [(validator, params)]
+        :param validators_aggregates: 已经计算好的聚合结果, 与validators一一对应. 为None的校验器使用data单独计算
+        :return:
+        """
+        if validators_aggregates is None:
+            validators_aggregates = [None] * len(validators)
+        if data is not None and not isinstance(data, pl.LazyFrame):
+            data = to_polars_frame(data)
+
+        result = []
+        eager_data = None
+        for (validator, params), aggregates in zip(validators, validators_aggregates):
+            if aggregates is None and isinstance(data, pl.LazyFrame):
+                # 不支持聚合的校验器需要完整的数据, 只物化一次
+                if eager_data is None:
+                    eager_data = data.collect(streaming=True)
+                validator.set_data(eager_data)
+            elif data is not None:
+                validator.set_data(data)
+            validator_result = validator.validation(aggregates)
+            validator_result.params = params
             validator_result.name = validator.get_validator_name()
             result.append(validator_result)
         return result
 
-    def run(self):
+    def sample_data(self, data, sample_size):
+        """
+        在polars中随机抽取sample_size行
+        :param data: pl.DataFrame 或 pl.LazyFrame
+        :param sample_size:
+        :return:
+        """
+        if isinstance(data, pl.LazyFrame):
+            return data.filter(pl.int_range(0, pl.len()).shuffle(self.sample_seed) < sample_size)
+        data = to_polars_frame(data)
+        return data.sample(min(sample_size, data.height), seed=self.sample_seed)
+
+    def run_sample_validators(self, data_loader, validators, sample_size):
+        """
+        抽样校验. 支持抽样的校验器使用随机样本, 其他校验器使用全部数据, 行数等指标是精确值.
+        加载器不支持抽样时只加载一次完整的数据, 在polars中抽样; 支持抽样时, 只有其他校验器需要加载完整的数据时
+        才从这份数据中抽样, 否则在数据源中抽样
+        :param data_loader:
+        :param validators: [(validator, params)]
+        :param sample_size:
+        :return: 与validators一一对应的校验结果
+        """
+        sampled = [i for i, (validator, _) in enumerate(validators) if validator.supports_sampling()]
+        exact = [i for i, (validator, _) in enumerate(validators) if not validator.supports_sampling()]
+        result = [None] * len(validators)
+        data = None
+        if not data_loader.supports_sampling():
+            data = self.load_data(data_loader)
+            if not isinstance(data, pl.LazyFrame):
+                data = to_polars_frame(data)
+        if exact:
+            group = [validators[i] for i in exact]
+            exact_data, validators_aggregates = self.collect_validators_aggregates(
+                data_loader, [validator for validator, _ in group], data)
+            for i, item in zip(exact, self.run_validators(exact_data, group, validators_aggregates)):
+                result[i] = item
+            if data is None:
+                data = exact_data
+        if sampled:
+            group = [validators[i] for i in sampled]
+            validator_objs = [validator for validator, _ in group]
+            if data is not None:
+                sample = self.sample_data(data, sample_size)
+                validators_aggregates = self.compute_aggregates(sample, validator_objs)
+            else:
+                sample, validators_aggregates = self.collect_validators_aggregates(
+                    data_loader.sample(sample_size), validator_objs)
+            for i, item in zip(sampled, self.run_validators(sample, group, validators_aggregates)):
+                result[i] = item
+        return result
+
+    def compute_fingerprint(self, data_loader):
+        """
+        只计算数据的指纹. 设置了batch_size时分批计算, 不保留数据; 否则加载完整的数据,
+        指纹变化时校验器直接使用这份数据, 不需要再次加载
+        :param data_loader:
+        :return: (加载的数据或None, 指纹)
+        """
+        tracker = FingerprintTracker()
+        if self.batch_size:
+            _, (aggregates,) = self.compute_batch_aggregates(data_loader, [tracker], self.batch_size)
+            return None, FingerprintTracker.to_fingerprint(aggregates)
+        data = self.load_data(data_loader)
+        if not isinstance(data, pl.LazyFrame):
+            data = to_polars_frame(data)
+        aggregates = self.compute_aggregates(data, [tracker])[0]
+        return data, FingerprintTracker.to_fingerprint(aggregates)
+
+    def load_data(self, data_loader=None):
+        data_loader = data_loader or self._data_loader
+        if self.lazy:
+            return data_loader.load_lazy()
+        else:
+            return data_loader.load()
+
+    def collect_validators_aggregates(self, data_loader, validators, data=None):
+        """
+        按照配置计算所有校验器的聚合: 先下推到数据库, 再分批加载, 最后一次加载全部数据
+        :param data_loader:
+        :param validators:
+        :param data: 已经加载的完整数据, 不为None时直接在这份数据上计算, 不再加载
+        :return: (加载的数据或None, 与validators一一对应的聚合结果, 不支持聚合的校验器对应None)
+        """
+        if data is not None:
+            return data, self.compute_aggregates(data, validators)
+        validators_aggregates = [None] * len(validators)
+        if self.pushdown and data_loader.supports_pushdown():
+            validators_aggregates = self.compute_pushdown_aggregates(data_loader, validators)
+        data = None
+        pending = [i for i, item in enumerate(validators_aggregates) if item is None]
+        if pending and self.batch_size:
+            data, batch_aggregates = self.compute_batch_aggregates(
+                data_loader, [validators[i] for i in pending], self.batch_size)
+            for i, aggregates in zip(pending, batch_aggregates):
+                validators_aggregates[i] = aggregates
+        pending = [i for i, item in enumerate(validators_aggregates) if item is None]
+        if pending and data is None:
+            # 有不能下推或者不能合并的校验器时才加载完整的数据
+            data = self.load_data(data_loader)
+            if not isinstance(data, pl.LazyFrame):
+                data = to_polars_frame(data)
+            fused = self.compute_aggregates(data, [validators[i] for i in pending])
+            for i, aggregates in zip(pending, fused):
+                validators_aggregates[i] = aggregates
+        return data, validators_aggregates
+
+    @staticmethod
+    def get_signature(item):
+        return hashlib.md5(state_dumps(item).encode('utf-8')).hexdigest()
+
+    def run(self, state=None, baselines=None):
+        """
+        执行校验
+        :param state: 上一次运行结果中的state. 用于增量校验以及数据没有变化时复用结果
+        :param baselines: 历史指标的状态, {(校验器名称, 参数摘要, 指标名称): 状态}. 不为None时, 运行后新的状态在结果的baselines中.
+            为None时表示没有加载历史, 校验器从空的历史开始, 结果中不返回baselines, 不会覆盖已经保存的历史
+        :return:
+        """
         run_time = datetime.datetime.now()
+        # 每次运行使用新的字典, 结果中的metrics不会被之后的运行修改
+        self.metrics = {}
         macro_maps = self.get_macro_maps()
         macro_template = MacroTemplate(macro_maps)
         wt_name = macro_template.apply_string(self.name)
         # self.metrics['raw_name'] = self.name
         # self.metrics['name'] = wt_name
-        data_loader_meta = {}
-        for k, v in self._data_loader_meta.items():
-            if isinstance(v, str):
-                data_loader_meta[k] = macro_template.apply_string(v)
-            else:
-                data_loader_meta[k] = v
-        self._data_loader = spawn_data_loader_from_dict(data_loader_meta)
-        data = self._data_loader.load()
-        validators_result = self.run_validators(data, macro_template)
+        plan = self.compile()
+        self._data_loader, data_loader_meta = plan.spawn_data_loader(macro_template)
+        validators = plan.spawn_validators(macro_template)
+        validator_objs = [validator for validator, _ in validators]
+        for validator, params in validators:
+            key = validator.baseline_key()
+            if key is not None:
+                key = (validator.get_validator_name(), params_hash(params), key)
+                validator.baseline = MetricBaseline.load((baselines or {}).get(key))
+        sample_size = self.sample_size
+        if sample_size is not None:
+            for validator in validator_objs:
+                if validator.supports_sampling():
+                    validator.sample_confidence = self.sample_confidence
+            self.metrics['sample_size'] = sample_size
+
+        watermark_column = self.watermark_column
+        incremental = sample_size is None and watermark_column is not None and \
+            self._data_loader.supports_incremental() and all(validator.supports_merge() for validator in validator_objs)
+        signatures = [self.get_signature(dict(validator=validator.module_path(), params=params))
+                      for validator, params in validators]
+        loader_signature = self.get_signature(dict(data_loader=data_loader_meta, watermark_column=watermark_column))
+        prev_aggregates = None
+        if incremental:
+            validator_objs.append(WatermarkTracker(watermark_column))
+            prev_aggregates = self.get_prev_aggregates(state, loader_signature, signatures)
+        use_fingerprint = self.fingerprint and not incremental and sample_size is None
+        if use_fingerprint and self.pushdown and self._data_loader.supports_pushdown():
+            # 计算指纹需要加载全部数据, 下推只需要返回一行聚合结果
+            logger.warning("watchtower %s: fingerprint is ignored because pushdown is enabled" % self.name)
+            use_fingerprint = False
+        data_loader = self._data_loader
+        if prev_aggregates is not None:
+            data_loader = data_loader.since(watermark_column, state['watermark'])
+        data, validators_result = None, None
+        new_state = None
+        reused_run_id = None
+        if use_fingerprint:
+            # 先只计算指纹, 与上次相同时不再计算校验器的聚合
+            data, fingerprint = self.compute_fingerprint(data_loader)
+            self.metrics['fingerprint'] = fingerprint
+            params_signature = self.get_signature(dict(loader=loader_signature, validators=signatures))
+            if fingerprint is not None:
+                new_state = dict(fingerprint=fingerprint, signature=params_signature)
+            if (fingerprint is not None and state and state.get('fingerprint') == fingerprint and
+                    state.get('signature') == params_signature and state.get('results') is not None):
+                reused_run_id = state.get('run_id')
+
+        if reused_run_id is not None:
+            # 数据和参数都没有变化, 使用上次的结果
+            validators_result = self.load_validators_result(state['results'])
+        elif sample_size is not None:
+            validators_result = self.run_sample_validators(data_loader, validators, sample_size)
+        else:
+            data, validators_aggregates = self.collect_validators_aggregates(data_loader, validator_objs, data)
+            if prev_aggregates is not None and any(item is None for item in validators_aggregates):
+                # 增量数据无法计算聚合, 重新校验全部数据
+                prev_aggregates = None
+                data, validators_aggregates = self.collect_validators_aggregates(self._data_loader, validator_objs)
+            if prev_aggregates is not None:
+                validators_aggregates = [
+                    validator.merge_aggregates(prev, aggregates)
+                    for validator, prev, aggregates in zip(validator_objs, prev_aggregates, validators_aggregates)
+                ]
+            if incremental:
+                tracker_aggregates = validators_aggregates.pop()
+                if all(item is not None for item in validators_aggregates):
+                    new_state = dict(
+                        loader=loader_signature,
+                        watermark=tracker_aggregates['watermark'],
+                        validators=dict(zip(signatures,
+                                            [without_raw_values(item) for item in validators_aggregates])),
+                    )
+            validators_result = self.run_validators(data, validators, validators_aggregates)
+        if use_fingerprint and new_state is not None:
+            new_state['results'] = self.dump_validators_result(validators_result)
         self.gen_metrics(data, validators_result)
         success = self.compute_success(validators_result)
         result = dict(
@@ -151,6 +711,56 @@ class Watchtower(object):
             metrics=self.metrics,
             validators_result=validators_result,
         )
+        if new_state is not None:
+            result['state'] = new_state
+        if reused_run_id is not None:
+            result['reused_run_id'] = reused_run_id
+        elif baselines is not None:
+            new_baselines = [
+                dict(validator=item.name, params_hash=params_hash(params), metric=validator.baseline_key(),
+                     state=item.extra['baseline'])
+                for (validator, params), item in zip(validators, validators_result) if 'baseline' in item.extra
+            ]
+            if new_baselines:
+                result['baselines'] = new_baselines
+        return result
+
+    @staticmethod
+    def dump_validators_result(validators_result):
+        return [
+            dict(name=item.name, success=item.success, metrics=without_raw_values(item.metrics), params=item.params)
+            for item in validators_result
+        ]
+
+    @staticmethod
+    def load_validators_result(items):
+        result = []
+        for item in items:
+            validator_result = ValidationResult(success=item['success'], metrics=item['metrics'])
+            validator_result.name = item['name']
+            validator_result.params = item['params']
+            result.append(validator_result)
+        return result
+
+    @staticmethod
+    def get_prev_aggregates(state, loader_signature, signatures):
+        """
+        从上一次的state中取出每个校验器的聚合结果. 加载器或者任何一个校验器的参数变化时, 返回None
+        :param state:
+        :param loader_signature:
+        :param signatures:
+        :return:
+        """
+        if not state or state.get('loader') != loader_signature or state.get('watermark') is None:
+            return None
+        validators_state = state.get('validators') or {}
+        result = []
+        for signature in signatures:
+            if signature not in validators_state:
+                return None
+            result.append(validators_state[signature])
+        # WatermarkTracker
+        result.append(dict(watermark=state['watermark']))
         return result
 
     @classmethod
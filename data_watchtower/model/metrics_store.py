@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import glob
+import datetime
+import shortuuid
+import polars as pl
+from ..utils import flatten_metrics, params_hash
+
+# 每个数值指标一行, 列的类型固定, 不同校验器的指标可以存放在同一个文件中.
+# 同一个watchtower中相同类型的校验器使用params_hash区分
+METRICS_SCHEMA = {
+    'run_id': pl.Utf8,
+    'wt_name': pl.Utf8,
+    'name': pl.Utf8,
+    'validator': pl.Utf8,
+    'params_hash': pl.Utf8,
+    'run_time': pl.Datetime('us'),
+    'success': pl.Boolean,
+    'metric': pl.Utf8,
+    'value': pl.Float64,
+}
+
+FILE_FORMATS = {
+    'parquet': 'parquet',
+    'ipc': 'arrow',
+}
+
+
+class MetricsStore(object):
+    def __init__(self, root, file_format='parquet'):
+        """
+        按日期分区保存校验器数值指标的列式存储. 目录结构: root/date=YYYY-MM-DD/<run_id>.parquet
+        :param root: 根目录
+        :param file_format: parquet 或 ipc
+        """
+        if file_format not in FILE_FORMATS:
+            raise ValueError('file_format must be one of %s. value:%s' % (list(FILE_FORMATS), file_format))
+        self.root = root
+        self.file_format = file_format
+        self.extension = FILE_FORMATS[file_format]
+
+    @staticmethod
+    def to_frame(wt_name, result, run_id=None):
+        """
+        把一次运行结果中校验器的数值指标转换为DataFrame
+        :param wt_name: watchtower的名称(未替换宏)
+        :param result: Watchtower.run的返回值
+        :param run_id: 与dw_validation_detail中的run_id一致, 为空时自动生成
+        :return:
+        """
+        run_id = run_id or shortuuid.uuid()
+        rows = {key: [] for key in METRICS_SCHEMA}
+        if not result.get('reused_run_id'):
+            for item in result['validators_result']:
+                item_params_hash = params_hash(item.params)
+                for metric, value in flatten_metrics(item.metrics):
+                    rows['run_id'].append(run_id)
+                    rows['wt_name'].append(wt_name)
+                    rows['name'].append(result['name'])
+                    rows['validator'].append(item.name)
+                    rows['params_hash'].append(item_params_hash)
+                    rows['run_time'].append(item.run_time)
+                    rows['success'].append(item.success)
+                    rows['metric'].append(metric)
+                    rows['value'].append(value)
+        return pl.DataFrame(rows, schema=METRICS_SCHEMA)
+
+    def get_partition_path(self, date):
+        return os.path.join(self.root, 'date=%s' % date.strftime('%Y-%m-%d'))
+
+    def write_file(self, df, path):
+        # 先写入临时文件再重命名, 查询时不会读到写了一半的文件
+        tmp_path = path + '.tmp'
+        if self.file_format == 'parquet':
+            df.write_parquet(tmp_path, statistics=True)
+        else:
+            df.write_ipc(tmp_path)
+        os.replace(tmp_path, path)
+
+    def append(self, wt_name, result, run_id=None):
+        """
+        追加一次运行结果. 每次运行在每个日期分区中写入一个文件
+        :param wt_name: watchtower的名称(未替换宏)
+        :param result: Watchtower.run的返回值
+        :param run_id: 与dw_validation_detail中的run_id一致, 为空时自动生成
+        :return: 写入的行数
+        """
+        run_id = run_id or shortuuid.uuid()
+        df = self.to_frame(wt_name, result, run_id)
+        if df.is_empty():
+            return 0
+        df = df.with_columns(pl.col('run_time').dt.date().alias('__date__'))
+        for (date,), part in df.group_by(['__date__']):
+            path = self.get_partition_path(date)
+            os.makedirs(path, exist_ok=True)
+            self.write_file(part.drop('__date__'), os.path.join(path, '%s.%s' % (run_id, self.extension)))
+        return len(df)
+
+    def get_files(self, start_time=None, end_time=None):
+        """
+        根据目录名称过滤分区, 不需要打开范围之外的文件
+        :param start_time:
+        :param end_time:
+        :return:
+        """
+        start_date = start_time.date() if isinstance(start_time, datetime.datetime) else start_time
+        end_date = end_time.date() if isinstance(end_time, datetime.datetime) else end_time
+        files = []
+        if not os.path.isdir(self.root):
+            return files
+        for partition in sorted(os.listdir(self.root)):
+            if not partition.startswith('date='):
+                continue
+            date = datetime.datetime.strptime(partition[5:], '%Y-%m-%d').date()
+            if start_date is not None and date < start_date:
+                continue
+            if end_date is not None and date > end_date:
+                continue
+            pattern = os.path.join(self.root, partition, '*.%s' % self.extension)
+            files.extend(sorted(glob.glob(pattern)))
+        return files
+
+    def scan(self, wt_name=None, validator=None, start_time=None, end_time=None, metrics=None, name=None):
+        """
+        查询指标的历史数据. 返回LazyFrame, 过滤条件会下推到文件的读取中
+        :param wt_name: watchtower的名称(未替换宏)
+        :param validator: 校验器的名称
+        :param start_time: 开始时间, 包含
+        :param end_time: 结束时间, 不包含
+        :param metrics: 指标名称列表
+        :param name: 替换宏之后的名称
+        :return:
+        """
+        files = self.get_files(start_time, end_time)
+        if not files:
+            return pl.DataFrame(schema=METRICS_SCHEMA).lazy()
+        if self.file_format == 'parquet':
+            lf = pl.scan_parquet(files, hive_partitioning=False)
+        else:
+            lf = pl.scan_ipc(files)
+        conditions = []
+        if wt_name is not None:
+            conditions.append(pl.col('wt_name') == wt_name)
+        if name is not None:
+            conditions.append(pl.col('name') == name)
+        if validator is not None:
+            conditions.append(pl.col('validator') == validator)
+        if start_time is not None:
+            conditions.append(pl.col('run_time') >= pl.lit(start_time).cast(METRICS_SCHEMA['run_time']))
+        if end_time is not None:
+            conditions.append(pl.col('run_time') < pl.lit(end_time).cast(METRICS_SCHEMA['run_time']))
+        if metrics is not None:
+            conditions.append(pl.col('metric').is_in(list(metrics)))
+        if conditions:
+            lf = lf.filter(pl.all_horizontal(conditions))
+        return lf
+
+    def query(self, wt_name=None, validator=None, start_time=None, end_time=None, metrics=None, name=None,
+              pivot=False):
+        """
+        查询指标的历史数据
+        :param wt_name: watchtower的名称(未替换宏)
+        :param validator: 校验器的名称
+        :param start_time: 开始时间, 包含
+        :param end_time: 结束时间, 不包含
+        :param metrics: 指标名称列表
+        :param name: 替换宏之后的名称
+        :param pivot: 为True时每个指标一列, 每次运行的每个校验器(validator, params_hash)一行
+        :return: DataFrame, 按运行时间排序
+        """
+        df = self.scan(wt_name, validator, start_time, end_time, metrics, name).sort('run_time').collect()
+        if pivot:
+            index = ['run_id', 'wt_name', 'name', 'validator', 'params_hash', 'run_time', 'success']
+            df = df.pivot(values='value', index=index, columns='metric', aggregate_function='first')
+        return df
+
+    def compact(self, date=None):
+        """
+        把分区中每次运行写入的小文件合并为一个文件, 减少查询时打开的文件数量
+        :param date: 需要合并的日期, 为空时合并所有分区
+        :return: 合并的文件数量
+        """
+        total = 0
+        for partition in sorted(os.listdir(self.root)) if os.path.isdir(self.root) else []:
+            if not partition.startswith('date='):
+                continue
+            if date is not None and partition != 'date=%s' % date.strftime('%Y-%m-%d'):
+                continue
+            path = os.path.join(self.root, partition)
+            files = sorted(glob.glob(os.path.join(path, '*.%s' % self.extension)))
+            if len(files) <= 1:
+                continue
+            if self.file_format == 'parquet':
+                df = pl.scan_parquet(files, hive_partitioning=False).collect()
+            else:
+                df = pl.concat([pl.read_ipc(f, memory_map=False) for f in files])
+            self.write_file(df.sort('run_time'), os.path.join(path, 'compacted-%s.%s' % (
+                shortuuid.uuid(), self.extension)))
+            for f in files:
+                os.remove(f)
+            total += len(files)
+        return total
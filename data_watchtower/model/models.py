@@ -37,6 +37,12 @@ class ValidationDetailModel(BaseModel):
 
     class Meta:
         table_name = 'dw_validation_detail'
+        indexes = (
+            # 按时间范围查询运行历史
+            (('wt_name', 'run_type', 'run_time'), False),
+            # 汇总超过保留期限的明细
+            (('run_time',), False),
+        )
 
 
 class WatchtowerModel(BaseModel):
@@ -70,3 +76,76 @@ class ValidatorRelationModel(BaseModel):
 
     class Meta:
         table_name = 'dw_validator_relation'
+
+
+class WatchtowerStateModel(BaseModel):
+    """
+    增量校验的状态: 上次的水位线以及每个校验器的聚合结果
+    """
+    wt_name = CharField(max_length=128, primary_key=True)
+    watermark = TextField(null=True)
+    state = TextField()
+    run_id = CharField(max_length=32)
+    update_time = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        table_name = 'dw_watchtower_state'
+
+
+class WatchtowerLatestModel(BaseModel):
+    """
+    watchtower每个名称(替换宏之后)最近一次的运行结果, 在保存运行结果时更新. 计算状态时不需要扫描历史明细
+    """
+    wt_name = CharField(max_length=128)
+    name = CharField(max_length=128)
+    success = BooleanField()
+    run_time = DateTimeField()
+    run_id = CharField(max_length=32)
+    ignored = BooleanField(default=False)
+    update_time = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        table_name = 'dw_watchtower_latest'
+        primary_key = CompositeKey('wt_name', 'name')
+
+
+class MetricBaselineModel(BaseModel):
+    """
+    校验器指标历史值的增量状态, 每次保存运行结果时更新. 相同类型的校验器使用params_hash区分
+    """
+    wt_name = CharField(max_length=128)
+    validator = CharField(max_length=128)
+    params_hash = CharField(max_length=32, default='')
+    metric = CharField(max_length=128)
+    state = TextField()
+    run_id = CharField(max_length=32)
+    update_time = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        table_name = 'dw_metric_baseline'
+        primary_key = CompositeKey('wt_name', 'validator', 'params_hash', 'metric')
+
+
+class ValidationDailySummaryModel(BaseModel):
+    """
+    超过保留期限的明细按天汇总后的结果. metrics中是数值类型指标的最小值和最大值.
+    同一个watchtower中相同类型的校验器使用params_hash区分
+    """
+    id = AutoField(primary_key=True)
+    wt_name = CharField(max_length=128)
+    name = CharField(max_length=128)
+    run_type = SmallIntegerField()
+    params_hash = CharField(max_length=32, default='')
+    date = DateField()
+    run_count = IntegerField(default=0)
+    success_count = IntegerField(default=0)
+    ignored_count = IntegerField(default=0)
+    metrics = TextField(null=True)
+    update_time = DateTimeField(default=datetime.datetime.now)
+    create_time = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        table_name = 'dw_validation_daily_summary'
+        indexes = (
+            (('wt_name', 'name', 'run_type', 'params_hash', 'date'), True),
+        )
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+import queue
+import atexit
+import logging
+import threading
+import shortuuid
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class ResultWriter(object):
+    def __init__(self, db_svr, batch_size=100, flush_interval=1.0, max_pending=1000):
+        """
+        异步批量保存运行结果. 后台线程把队列中的结果合并为一个事务写入, 减少后端数据库的小事务
+        :param db_svr: DbServices
+        :param batch_size: 每个事务最多保存的运行结果数量
+        :param flush_interval: 第一个结果进入队列后最多等待的秒数
+        :param max_pending: 队列的最大长度. 队列满时submit会阻塞, 直到写入跟上
+        """
+        self.db_svr = db_svr
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_pending)
+        # 保存失败的结果: [(watchtower名称, 错误信息)]
+        self.errors = []
+        self.written = 0
+        self.batches = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._worker, name='dw-result-writer', daemon=True)
+        self._thread.start()
+        # 进程退出前写入队列中剩余的结果
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, watchtower, result, timeout=None):
+        """
+        把运行结果放入队列
+        :param watchtower:
+        :param result: Watchtower.run的返回值
+        :param timeout: 队列满时最多等待的秒数, 为None时一直等待. 超时抛出queue.Full
+        :return: 保存时使用的run_id
+        """
+        if self._closed:
+            raise RuntimeError('result writer is closed')
+        run_id = shortuuid.uuid()
+        self.queue.put((watchtower, result, run_id), timeout=timeout)
+        return run_id
+
+    def flush(self):
+        """
+        等待已经提交的结果全部写入
+        :return:
+        """
+        self.queue.join()
+
+    def close(self):
+        """
+        写入队列中剩余的结果后停止后台线程. 可以重复调用
+        :return:
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self.queue.put(_STOP)
+        self._thread.join()
+        atexit.unregister(self.close)
+
+    def _next_batch(self):
+        """
+        等待第一个结果, 然后在flush_interval内收集到batch_size个结果
+        :return: (结果列表, 是否收到停止信号)
+        """
+        item = self.queue.get()
+        if item is _STOP:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _worker(self):
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            try:
+                if batch:
+                    self._write(batch)
+            except BaseException as e:
+                # 后台线程退出后flush和close会一直等待, 任何错误都只记录到errors
+                logger.exception("result writer failed to save %s results" % len(batch))
+                self.errors.extend((watchtower.name, str(e) or repr(e)) for watchtower, _, _ in batch)
+            finally:
+                for _ in range(len(batch) + (1 if stop else 0)):
+                    self.queue.task_done()
+
+    def _write(self, batch):
+        try:
+            self.db_svr.save_results(batch)
+        except Exception:
+            # 批量写入失败时逐个保存, 一个错误的结果不会影响其他结果
+            logger.exception("failed to save results in batch, retrying one by one")
+            for watchtower, result, run_id in batch:
+                try:
+                    self.db_svr.save_result(watchtower, result, run_id=run_id)
+                except Exception as e:
+                    logger.exception("failed to save result: %s" % watchtower.name)
+                    self.errors.append((watchtower.name, str(e)))
+                else:
+                    self.written += 1
+        else:
+            self.written += len(batch)
+        self.batches += 1
@@ -1,16 +1,46 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
+import time
 import logging
 import datetime
 import shortuuid
-from peewee import fn, JOIN, DoesNotExist
+from peewee import fn, JOIN, DoesNotExist, Tuple, Case, SQL, chunked
 from peewee import IntegrityError
-from data_watchtower import DataLoader
-from data_watchtower.model.models import ValidationDetailModel, WatchtowerModel, database_proxy, ValidatorRelationModel
-from data_watchtower.utils import json_dumps, json_loads, connect_db_from_url
+from data_watchtower.model.models import (ValidationDetailModel, WatchtowerModel, database_proxy, ValidatorRelationModel,
+                                          WatchtowerStateModel, WatchtowerLatestModel, ValidationDailySummaryModel,
+                                          MetricBaselineModel)
+from data_watchtower.utils import (flatten_metrics, json_dumps, json_loads, connect_db_from_url, state_dumps,
+                                  state_loads, params_hash, time_bucket_expression)
 
 logger = logging.getLogger(__name__)
 
+# 明细的保留天数, 更早的明细汇总到dw_validation_daily_summary后删除
+DETAIL_RETENTION_DAYS = int(os.getenv("DW_DETAIL_RETENTION_DAYS", 90))
+
+
+def merge_metric_ranges(ranges, metrics):
+    """
+    把一次运行的指标合并到汇总结果中, 只保留数值类型指标的最小值和最大值. 没有值的指标(None)被忽略
+    :param ranges: {指标: {'min': 值, 'max': 值}}
+    :param metrics: 一次运行的指标
+    :return:
+    """
+    for key, value in (metrics or {}).items():
+        if isinstance(value, dict) and 'min' in value and 'max' in value:
+            low, high = value['min'], value['max']
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            low = high = value
+        else:
+            continue
+        if not all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in (low, high)):
+            continue
+        if key in ranges:
+            low = min(ranges[key]['min'], low)
+            high = max(ranges[key]['max'], high)
+        ranges[key] = dict(min=low, max=high)
+    return ranges
+
 
 class DbServices(object):
     def __init__(self, connection):
@@ -21,6 +51,7 @@ class DbServices(object):
             str: eg: sqlite:///data.db mysql://user:passwd@ip:port/my_db
             other: eg. MySQLDatabase, PostgresqlDatabase ...
         """
+        self.connection = connection
         if isinstance(connection, str):
             self.database = connect_db_from_url(url=connection)
         else:
@@ -28,15 +59,71 @@ class DbServices(object):
         database_proxy.initialize(self.database)
 
     def create_tables(self):
-        models = [WatchtowerModel, ValidationDetailModel, ValidatorRelationModel]
+        models = [WatchtowerModel, ValidationDetailModel, ValidatorRelationModel, WatchtowerStateModel,
+                  WatchtowerLatestModel, ValidationDailySummaryModel, MetricBaselineModel]
         with self.database:
+            backfill = False
             for model in models:
                 if not self.database.table_exists(model):
                     self.database.create_tables([model])
+                    backfill = backfill or model is WatchtowerLatestModel
+                else:
+                    self.create_missing_indexes(model)
+        if backfill:
+            # 升级时根据历史明细生成最近一次的运行结果
+            self.backfill_watchtower_latest()
+
+    def create_missing_indexes(self, model):
+        """
+        升级时为已经存在的表创建新增的索引
+        :param model:
+        :return:
+        """
+        existing = {index.name for index in self.database.get_indexes(model._meta.table_name)}
+        for index in model._meta.fields_to_index():
+            if index._name not in existing:
+                self.database.execute(model._schema._create_index(index))
+
+    def backfill_watchtower_latest(self):
+        """
+        根据dw_validation_detail的历史数据生成dw_watchtower_latest. 每个watchtower单独处理, 只需要执行一次
+        :return: 写入的行数
+        """
+        count = 0
+        wt_names = ValidationDetailModel.select(ValidationDetailModel.wt_name).where(
+            ValidationDetailModel.run_type == 1).distinct().tuples()
+        for (wt_name,) in list(wt_names):
+            latest = ValidationDetailModel.select(
+                ValidationDetailModel.name,
+                fn.MAX(ValidationDetailModel.run_time).alias('run_time'),
+            ).where(
+                (ValidationDetailModel.wt_name == wt_name) & (ValidationDetailModel.run_type == 1)
+            ).group_by(ValidationDetailModel.name).alias('latest')
+            query = ValidationDetailModel.select(
+                ValidationDetailModel.name,
+                ValidationDetailModel.success,
+                ValidationDetailModel.run_time,
+                ValidationDetailModel.run_id,
+                ValidationDetailModel.ignored,
+            ).join(latest, on=(
+                (ValidationDetailModel.name == latest.c.name) & (ValidationDetailModel.run_time == latest.c.run_time)
+            )).where(
+                (ValidationDetailModel.wt_name == wt_name) & (ValidationDetailModel.run_type == 1)
+            ).order_by(ValidationDetailModel.id)
+            rows = {}
+            for name, success, run_time, run_id, ignored in query.tuples():
+                rows[name] = dict(wt_name=wt_name, name=name, success=success, run_time=run_time, run_id=run_id,
+                                  ignored=ignored)
+            with self.database.atomic():
+                WatchtowerLatestModel.delete().where(WatchtowerLatestModel.wt_name == wt_name).execute()
+                if rows:
+                    WatchtowerLatestModel.insert_many(list(rows.values())).execute()
+            count += len(rows)
+        return count
 
     def get_watchtower(self, name):
         try:
-            model = WatchtowerModel.get(WatchtowerModel.name == name).get()
+            model = WatchtowerModel.get(WatchtowerModel.name == name)
         except DoesNotExist:
             return None
         item = model.to_dict()
@@ -52,39 +139,131 @@ class DbServices(object):
             item['validators'].append(validator)
         return item
 
-    def get_watchtowers(self):
+    WATCHTOWER_LIST_FIELDS = ('name', 'success', 'run_time', 'data_loader', 'params', 'validator_count')
+    WATCHTOWER_FIELDS = ('name', 'success', 'run_time', 'data_loader', 'params', 'update_time', 'create_time')
+
+    def get_watchtowers(self, after=None, limit=None, success=None, run_time_after=None, run_time_before=None,
+                        data_loader_cls=None, fields=None, names=None):
         """
-        获取所有的watchtower
+        获取watchtower列表, 按照名称排序. 不传参数时返回所有的watchtower
+        :param names: 只返回这些名称的watchtower
+        :param after: 分页游标, 只返回名称大于after的watchtower. 使用上一页最后一个名称
+        :param limit: 最多返回的行数
+        :param success: True/False 只返回最后一次运行成功/失败的; 'null' 只返回没有运行过的
+        :param run_time_after: 只返回最后一次运行时间大于等于该时间的
+        :param run_time_before: 只返回最后一次运行时间小于该时间的
+        :param data_loader_cls: 加载器的类名或者路径(module:name)
+        :param fields: 返回的字段, 默认是WATCHTOWER_LIST_FIELDS. 不包含data_loader和params时不会解析json
         :return:
         """
+        fields = list(fields or self.WATCHTOWER_LIST_FIELDS)
+        unknown = set(fields) - set(self.WATCHTOWER_LIST_FIELDS) - set(self.WATCHTOWER_FIELDS)
+        if unknown:
+            raise ValueError('unknown fields: %s' % ', '.join(sorted(unknown)))
+        columns = [getattr(WatchtowerModel, name) for name in fields if name != 'validator_count']
+        if 'name' not in fields:
+            columns.append(WatchtowerModel.name)
+        join_query = None
+        if 'validator_count' in fields:
+            join_query = ValidatorRelationModel.select(
+                ValidatorRelationModel.wt_name,
+                fn.COUNT(ValidatorRelationModel.id).alias('validator_count'),
+            ).group_by(ValidatorRelationModel.wt_name).alias('join_query')
+            columns.append(fn.COALESCE(join_query.c.validator_count, 0).alias('validator_count'))
+        query = WatchtowerModel.select(*columns)
+        if join_query is not None:
+            query = query.join(join_query, JOIN.LEFT_OUTER, on=(WatchtowerModel.name == join_query.c.wt_name))
+        if names is not None:
+            query = query.where(WatchtowerModel.name.in_(list(names)))
+        if after is not None:
+            query = query.where(WatchtowerModel.name > after)
+        if success == 'null':
+            query = query.where(WatchtowerModel.success.is_null())
+        elif success is not None:
+            query = query.where(WatchtowerModel.success == bool(success))
+        if run_time_after is not None:
+            query = query.where(WatchtowerModel.run_time >= run_time_after)
+        if run_time_before is not None:
+            query = query.where(WatchtowerModel.run_time < run_time_before)
+        if data_loader_cls:
+            # data_loader是json字符串, 匹配其中的"__class__": "module:name"
+            if ':' in data_loader_cls:
+                query = query.where(WatchtowerModel.data_loader.contains('"%s"' % data_loader_cls))
+            else:
+                query = query.where(WatchtowerModel.data_loader.contains(':%s"' % data_loader_cls))
+        query = query.order_by(WatchtowerModel.name)
+        if limit is not None:
+            query = query.limit(limit)
         result = []
-
-        join_query = ValidatorRelationModel.select(ValidatorRelationModel.wt_name,
-                                                   fn.COUNT(ValidatorRelationModel.validator).alias(
-                                                       'validator_count')).group_by(
-            ValidatorRelationModel.wt_name).alias('join_query')
-        predicate = (WatchtowerModel.name == join_query.c.wt_name)
-        query = WatchtowerModel.select(
-            WatchtowerModel.name,
-            WatchtowerModel.success,
-            WatchtowerModel.run_time,
-            WatchtowerModel.data_loader,
-            WatchtowerModel.params,
-            join_query.c.validator_count,
-        ).join(
-            join_query, on=predicate
-        )
-        for item in query:
-            row = item.to_dict(fields_from_query=query)
-            row['params'] = json_loads(row['params'])
-            try:
-                # 不确定这么取validator_count的值是否合理，先这样
-                row['validator_count'] = item.validatorrelationmodel.validator_count
-            except AttributeError:
-                row['validator_count'] = 0
+        for row in query.dicts():
+            if 'data_loader' in row:
+                row['data_loader'] = json_loads(row['data_loader'])
+            if 'params' in row:
+                row['params'] = json_loads(row['params'])
+            if 'name' not in fields:
+                row.pop('name')
             result.append(row)
         return result
 
+    def get_watchtowers_full(self, names=None, batch_size=500, **filters):
+        """
+        批量获取watchtower以及它们的校验器, 每批只需要两次查询.
+        返回的数据与get_watchtower相同, 可以直接用于Watchtower.from_dict, 另外包含validator_count
+        :param names: 名称列表. 为None时返回所有满足filters的watchtower
+        :param batch_size: 每批的数量
+        :param filters: 过滤条件, 与get_watchtowers的参数相同
+        :return: 生成器, 按照名称排序
+        """
+        for rows in self._iter_watchtower_pages(names, batch_size, filters):
+            if not rows:
+                continue
+            validators = {row['name']: [] for row in rows}
+            query = ValidatorRelationModel.select(
+                ValidatorRelationModel.wt_name,
+                ValidatorRelationModel.validator,
+                ValidatorRelationModel.params,
+            ).where(ValidatorRelationModel.wt_name.in_(list(validators))).order_by(ValidatorRelationModel.id)
+            for wt_name, validator, params in query.tuples():
+                validators[wt_name].append(dict(
+                    params=json_loads(params),
+                    __class__=validator,
+                ))
+            for row in rows:
+                row['validators'] = validators[row['name']]
+                row['validator_count'] = len(row['validators'])
+                yield row
+
+    def _iter_watchtower_pages(self, names, batch_size, filters):
+        if names is not None:
+            names = sorted(set(names))
+            for i in range(0, len(names), batch_size):
+                yield self.get_watchtowers(names=names[i:i + batch_size], fields=self.WATCHTOWER_FIELDS, **filters)
+            return
+        filters = dict(filters)
+        after = filters.pop('after', None)
+        while True:
+            rows = self.get_watchtowers(after=after, limit=batch_size, fields=self.WATCHTOWER_FIELDS, **filters)
+            yield rows
+            if len(rows) < batch_size:
+                return
+            after = rows[-1]['name']
+
+    def get_watchtower_states(self, names):
+        """
+        批量获取上一次运行保存的状态
+        :param names: watchtower的名称列表
+        :return: {名称: 状态}, 没有状态的watchtower不在结果中
+        """
+        result = {}
+        names = list(names)
+        for i in range(0, len(names), 500):
+            query = WatchtowerStateModel.select().where(WatchtowerStateModel.wt_name.in_(names[i:i + 500]))
+            for model in query:
+                state = state_loads(model.state)
+                state['run_id'] = model.run_id
+                result[model.wt_name] = state
+        return result
+
     def watchtower_exists(self, name):
         return WatchtowerModel.select().where(WatchtowerModel.name == name).exists()
 
@@ -117,6 +296,7 @@ class DbServices(object):
             wt = WatchtowerModel.select().where(WatchtowerModel.name == name).get()
             if wt:
                 if 'data_loader' in item:
+                    from data_watchtower.core.base import DataLoader
                     data_loader = item.pop('data_loader')
                     if isinstance(data_loader, DataLoader):
                         data_loader = data_loader.to_dict()
@@ -136,13 +316,23 @@ class DbServices(object):
                 wt = WatchtowerModel.select().where(WatchtowerModel.name == name).get()
             except DoesNotExist:
                 return 0
+            WatchtowerStateModel.delete().where(WatchtowerStateModel.wt_name == name).execute()
+            WatchtowerLatestModel.delete().where(WatchtowerLatestModel.wt_name == name).execute()
+            MetricBaselineModel.delete().where(MetricBaselineModel.wt_name == name).execute()
+            ValidatorRelationModel.delete().where(ValidatorRelationModel.wt_name == name).execute()
             return wt.delete_instance()
 
-    def save_result(self, watchtower, result):
-        update_time = datetime.datetime.now()
+    @staticmethod
+    def build_result_records(wt_name, result, run_id, update_time):
+        """
+        一次运行结果对应的dw_validation_detail行: watchtower一行, 每个校验器一行
+        :param wt_name: watchtower的名称(未替换宏)
+        :param result: Watchtower.run的返回值
+        :param run_id:
+        :param update_time:
+        :return:
+        """
         records = []
-        wt_name = watchtower.name
-        run_id = shortuuid.uuid()
         row = dict(
             wt_name=wt_name,
             name=result['name'],
@@ -157,6 +347,10 @@ class DbServices(object):
             create_time=update_time,
         )
         records.append(row)
+        if result.get('reused_run_id'):
+            # 复用上次的校验结果时, 只记录本次运行, 不重复写入校验器的结果
+            row['metrics'] = json_dumps(dict(result['metrics'], reused_run_id=result['reused_run_id']))
+            return records
         for item in result['validators_result']:
             row = dict(
                 wt_name=wt_name,
@@ -173,51 +367,277 @@ class DbServices(object):
 
             )
             records.append(row)
+        return records
+
+    def save_result(self, watchtower, result, run_id=None):
+        """
+        保存一次运行结果, 并更新watchtower的状态
+        :param watchtower:
+        :param result: Watchtower.run的返回值
+        :param run_id: 为空时自动生成
+        :return: run_id
+        """
+        return self.save_results([(watchtower, result, run_id)])[0]
+
+    def save_results(self, items, chunk_size=100):
+        """
+        在一个事务中批量保存多次运行结果: 明细使用多行插入, 每个watchtower的状态只计算一次
+        :param items: [(watchtower, result, run_id)], run_id为空时自动生成
+        :param chunk_size: 每条insert语句的行数
+        :return: 与items一一对应的run_id
+        """
+        update_time = datetime.datetime.now()
+        records = []
+        run_ids = []
+        latest = {}
+        states = {}
+        baselines = {}
+        watchtowers = {}
+        for watchtower, result, run_id in items:
+            run_id = run_id or shortuuid.uuid()
+            run_ids.append(run_id)
+            wt_name = watchtower.name
+            watchtowers[wt_name] = watchtower
+            records.extend(self.build_result_records(wt_name, result, run_id, update_time))
+            key = (wt_name, result['name'])
+            if key not in latest or latest[key]['run_time'] <= result['run_time']:
+                latest[key] = dict(success=result['success'], run_time=result['run_time'], run_id=run_id)
+            if result.get('state') is not None and not result.get('reused_run_id'):
+                states[wt_name] = (result['state'], run_id)
+            for item in result.get('baselines') or []:
+                key = (item['validator'], item['params_hash'], item['metric'])
+                baselines.setdefault(wt_name, {})[key] = (item, run_id)
+        with self.database.atomic():
+            for batch in chunked(records, chunk_size):
+                ValidationDetailModel.insert_many(batch).execute()
+            self.save_watchtower_latest_many(latest)
+            self.save_watchtower_states(states)
+            self.save_metric_baselines_many(baselines)
+            self.update_watchtowers_success_status(list(watchtowers.values()))
+        return run_ids
+
+    def save_watchtower_latest(self, wt_name, name, success, run_time, run_id):
+        """
+        更新名称最近一次的运行结果. 运行时间比已有的结果早时不更新
+        :param wt_name: watchtower的名称(未替换宏)
+        :param name: 替换宏之后的名称
+        :param success:
+        :param run_time:
+        :param run_id:
+        :return:
+        """
+        self.save_watchtower_latest_many({(wt_name, name): dict(success=success, run_time=run_time, run_id=run_id)})
+
+    def save_watchtower_latest_many(self, items):
+        """
+        批量更新最近一次的运行结果. 一次查询已有的结果, 比已有结果新的名称删除后使用多行插入.
+        没有传入ignored时沿用已有结果的ignored
+        :param items: {(wt_name, name): {success, run_time, run_id[, ignored]}}
+        :return:
+        """
+        if not items:
+            return
+        update_time = datetime.datetime.now()
+        existing = {}
+        wt_names = list({wt_name for wt_name, _ in items})
+        with self.database.atomic():
+            for i in range(0, len(wt_names), 500):
+                query = WatchtowerLatestModel.select(
+                    WatchtowerLatestModel.wt_name, WatchtowerLatestModel.name, WatchtowerLatestModel.run_time,
+                    WatchtowerLatestModel.ignored,
+                ).where(WatchtowerLatestModel.wt_name.in_(wt_names[i:i + 500]))
+                for wt_name, name, run_time, ignored in query.tuples():
+                    existing[(wt_name, name)] = (run_time, ignored)
+            rows = []
+            replaced = {}
+            for (wt_name, name), item in items.items():
+                ignored = False
+                if (wt_name, name) in existing:
+                    run_time, ignored = existing[(wt_name, name)]
+                    if run_time > item['run_time']:
+                        continue
+                    replaced.setdefault(wt_name, []).append(name)
+                item = dict(item, wt_name=wt_name, name=name, update_time=update_time)
+                item.setdefault('ignored', bool(ignored))
+                rows.append(item)
+            for wt_name, names in replaced.items():
+                for batch in chunked(names, 500):
+                    WatchtowerLatestModel.delete().where(
+                        (WatchtowerLatestModel.wt_name == wt_name) & WatchtowerLatestModel.name.in_(batch)).execute()
+            for batch in chunked(rows, 100):
+                WatchtowerLatestModel.insert_many(batch).execute()
+
+    def get_watchtower_state(self, name):
+        """
+        获取上一次运行保存的状态, 用于增量校验以及数据没有变化时复用结果
+        :param name: watchtower的名称(未替换宏)
+        :return:
+        """
+        try:
+            model = WatchtowerStateModel.get(WatchtowerStateModel.wt_name == name)
+        except DoesNotExist:
+            return None
+        state = state_loads(model.state)
+        state['run_id'] = model.run_id
+        return state
+
+    def save_watchtower_state(self, name, state, run_id):
+        self.save_watchtower_states({name: (state, run_id)})
+
+    def save_watchtower_states(self, items):
+        """
+        批量保存运行后的状态. 已有的状态删除后使用多行插入
+        :param items: {名称: (state, run_id)}
+        :return:
+        """
+        if not items:
+            return
+        update_time = datetime.datetime.now()
+        rows = [
+            dict(wt_name=name, watermark=json_dumps(state.get('watermark')), state=state_dumps(state), run_id=run_id,
+                 update_time=update_time)
+            for name, (state, run_id) in items.items()
+        ]
+        with self.database.atomic():
+            for batch in chunked(list(items), 500):
+                WatchtowerStateModel.delete().where(WatchtowerStateModel.wt_name.in_(batch)).execute()
+            for batch in chunked(rows, 100):
+                WatchtowerStateModel.insert_many(batch).execute()
+
+    def get_metric_baselines(self, names):
+        """
+        批量获取校验器指标历史值的状态
+        :param names: watchtower的名称列表
+        :return: {名称: {(校验器名称, 参数摘要, 指标名称): 状态}}, 没有状态的watchtower不在结果中
+        """
+        result = {}
+        names = list(names)
+        for i in range(0, len(names), 500):
+            query = MetricBaselineModel.select().where(MetricBaselineModel.wt_name.in_(names[i:i + 500]))
+            for model in query:
+                key = (model.validator, model.params_hash, model.metric)
+                result.setdefault(model.wt_name, {})[key] = json_loads(model.state)
+        return result
+
+    def save_metric_baselines(self, wt_name, baselines, run_id):
+        """
+        保存运行后新的指标状态
+        :param wt_name: watchtower的名称(未替换宏)
+        :param baselines: [{validator, params_hash, metric, state}], Watchtower.run返回的baselines
+        :param run_id:
+        :return:
+        """
+        items = {(item['validator'], item['params_hash'], item['metric']): (item, run_id) for item in baselines}
+        self.save_metric_baselines_many({wt_name: items})
+
+    def save_metric_baselines_many(self, items):
+        """
+        批量保存指标状态. 已有的状态删除后使用多行插入
+        :param items: {wt_name: {(校验器名称, 参数摘要, 指标名称): (baseline, run_id)}}
+        :return:
+        """
+        update_time = datetime.datetime.now()
+        keys = []
+        rows = []
+        for wt_name, values in items.items():
+            for (validator, hash_value, metric), (item, run_id) in values.items():
+                keys.append((wt_name, validator, hash_value, metric))
+                rows.append(dict(wt_name=wt_name, validator=validator, params_hash=hash_value, metric=metric,
+                                 state=json_dumps(item['state']), run_id=run_id, update_time=update_time))
+        if not rows:
+            return
+        key_columns = Tuple(MetricBaselineModel.wt_name, MetricBaselineModel.validator,
+                            MetricBaselineModel.params_hash, MetricBaselineModel.metric)
         with self.database.atomic():
-            ValidationDetailModel.insert_many(records).execute()
-        self.update_watchtower_success_status(watchtower)
-        return
+            for batch in chunked(keys, 100):
+                MetricBaselineModel.delete().where(key_columns.in_(batch)).execute()
+            for batch in chunked(rows, 100):
+                MetricBaselineModel.insert_many(batch).execute()
 
     def compute_watchtower_success_status(self, watchtower):
+        """
+        根据每个名称最近一次的运行结果计算watchtower的状态.
+        all: 所有名称最近一次的运行都成功; last: 最近一次运行成功
+        :param watchtower:
+        :return:
+        """
         wt_name = watchtower.name
-        success_method = watchtower.validator_success_method
+        success_method = watchtower.success_method
         if success_method == 'all':
-            DetailAlias = ValidationDetailModel.alias()
-            DetailAliasBase = ValidationDetailModel.alias('base')
-            join_query = DetailAlias.select(
-                DetailAlias.name,
-                fn.MAX(DetailAlias.run_time).alias('run_time')
-            ).where(
-                (DetailAlias.wt_name == wt_name) & (DetailAlias.run_type == 1)
-            ).group_by(DetailAlias.name).alias('join_query')
-            predicate = ((DetailAliasBase.name == join_query.c.name) &
-                         (DetailAliasBase.run_time == join_query.c.run_time))
-            cond = (DetailAliasBase.ignored == 0) & (DetailAliasBase.success == 0)
-            query = DetailAliasBase.select(
-                DetailAliasBase.run_id
-            ).join(
-                join_query, JOIN.INNER, on=predicate
-            ).where(cond)
+            query = WatchtowerLatestModel.select(WatchtowerLatestModel.name).where(
+                (WatchtowerLatestModel.wt_name == wt_name) &
+                (WatchtowerLatestModel.success == False) &
+                (WatchtowerLatestModel.ignored == False)
+            )
             return not query.exists()
         elif success_method == 'last':
             query = (
-                ValidationDetailModel.select(ValidationDetailModel.success)
-                .where((ValidationDetailModel.wt_name == wt_name) & (ValidationDetailModel.run_type == 1))
-                .order_by(ValidationDetailModel.run_time.desc())
+                WatchtowerLatestModel.select(WatchtowerLatestModel.success)
+                .where(WatchtowerLatestModel.wt_name == wt_name)
+                .order_by(WatchtowerLatestModel.run_time.desc())
                 .limit(1)
             )
-            item = query.get()
-            if item:
-                return True
-            else:
-                return item.success
+            item = query.first()
+            if item is None:
+                return None
+            return item.success
         else:
             raise ValueError('success_method error. value:%s' % success_method)
 
     def update_watchtower_success_status(self, watchtower):
+        self.update_watchtowers_success_status([watchtower])
+
+    def compute_watchtowers_success_status(self, watchtowers):
+        """
+        批量计算watchtower的状态, 每种success_method只需要一次查询. 规则与compute_watchtower_success_status相同
+        :param watchtowers:
+        :return: {名称: 状态}
+        """
+        names = {'all': [], 'last': []}
+        for watchtower in watchtowers:
+            if watchtower.success_method not in names:
+                raise ValueError('success_method error. value:%s' % watchtower.success_method)
+            names[watchtower.success_method].append(watchtower.name)
+        result = {}
+        if names['all']:
+            failed = set()
+            for i in range(0, len(names['all']), 500):
+                query = WatchtowerLatestModel.select(WatchtowerLatestModel.wt_name).where(
+                    (WatchtowerLatestModel.wt_name.in_(names['all'][i:i + 500])) &
+                    (WatchtowerLatestModel.success == False) &
+                    (WatchtowerLatestModel.ignored == False)
+                ).distinct()
+                failed.update(wt_name for (wt_name,) in query.tuples())
+            for name in names['all']:
+                result[name] = name not in failed
+        if names['last']:
+            last = {}
+            for i in range(0, len(names['last']), 500):
+                query = WatchtowerLatestModel.select(
+                    WatchtowerLatestModel.wt_name, WatchtowerLatestModel.success, WatchtowerLatestModel.run_time,
+                ).where(WatchtowerLatestModel.wt_name.in_(names['last'][i:i + 500]))
+                for wt_name, success, run_time in query.tuples():
+                    if wt_name not in last or last[wt_name][0] < run_time:
+                        last[wt_name] = (run_time, success)
+            for name in names['last']:
+                result[name] = last[name][1] if name in last else None
+        return result
+
+    def update_watchtowers_success_status(self, watchtowers):
+        """
+        批量更新watchtower的状态, 状态相同的watchtower使用一条update语句
+        :param watchtowers:
+        :return:
+        """
         run_time = datetime.datetime.now()
-        success = self.compute_watchtower_success_status(watchtower)
-        self.update_watchtower(watchtower.name, success=success, run_time=run_time)
+        groups = {}
+        for name, success in self.compute_watchtowers_success_status(watchtowers).items():
+            groups.setdefault(success, []).append(name)
+        with self.database.atomic():
+            for success, names in groups.items():
+                for i in range(0, len(names), 500):
+                    WatchtowerModel.update(success=success, run_time=run_time, update_time=run_time).where(
+                        WatchtowerModel.name.in_(names[i:i + 500])).execute()
 
     def add_validator_to_watchtower(self, wt_name, validator, params):
         """
@@ -268,3 +688,265 @@ class DbServices(object):
         )
 
         return inst.delete_instance()
+
+    def compact_validation_detail(self, retention_days=None, before=None, batch_size=1000, sleep=0, wt_name=None):
+        """
+        把超过保留期限的明细按天汇总到dw_validation_daily_summary, 然后删除明细.
+        每批在一个事务中处理, 不会长时间锁表, 中断后再次执行会继续处理剩余的明细
+        :param retention_days: 保留的天数, 默认使用DETAIL_RETENTION_DAYS
+        :param before: 处理运行时间早于该时间的明细, 指定时忽略retention_days
+        :param batch_size: 每批处理的行数
+        :param sleep: 每批之间休眠的秒数, 降低对数据库的压力
+        :param wt_name: 只处理指定的watchtower, 默认处理全部
+        :return: 删除的明细行数
+        """
+        if before is None:
+            if retention_days is None:
+                retention_days = DETAIL_RETENTION_DAYS
+            today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+            before = today - datetime.timedelta(days=retention_days)
+        total = 0
+        last_id = 0
+        while True:
+            query = ValidationDetailModel.select(
+                ValidationDetailModel.id,
+                ValidationDetailModel.wt_name,
+                ValidationDetailModel.name,
+                ValidationDetailModel.run_type,
+                ValidationDetailModel.success,
+                ValidationDetailModel.ignored,
+                ValidationDetailModel.run_time,
+                ValidationDetailModel.metrics,
+                ValidationDetailModel.params,
+            ).where(
+                (ValidationDetailModel.id > last_id) & (ValidationDetailModel.run_time < before)
+            )
+            if wt_name is not None:
+                query = query.where(ValidationDetailModel.wt_name == wt_name)
+            rows = list(query.order_by(ValidationDetailModel.id).limit(batch_size).tuples())
+            if not rows:
+                break
+            summaries = {}
+            for _, row_wt_name, name, run_type, success, ignored, run_time, metrics, params in rows:
+                key = (row_wt_name, name, run_type, params_hash(json_loads(params)), run_time.date())
+                summary = summaries.setdefault(key, dict(run_count=0, success_count=0, ignored_count=0, metrics={}))
+                summary['run_count'] += 1
+                summary['success_count'] += 1 if success else 0
+                summary['ignored_count'] += 1 if ignored else 0
+                merge_metric_ranges(summary['metrics'], json_loads(metrics))
+            with self.database.atomic():
+                for key, summary in summaries.items():
+                    self.save_daily_summary(key, summary)
+                ValidationDetailModel.delete().where(
+                    ValidationDetailModel.id.in_([row[0] for row in rows])).execute()
+            total += len(rows)
+            last_id = rows[-1][0]
+            if sleep:
+                time.sleep(sleep)
+        return total
+
+    def save_daily_summary(self, key, summary):
+        """
+        合并到已有的汇总结果中
+        :param key: (wt_name, name, run_type, params_hash, date)
+        :param summary: {run_count, success_count, ignored_count, metrics}
+        :return:
+        """
+        wt_name, name, run_type, row_params_hash, date = key
+        cond = ((ValidationDailySummaryModel.wt_name == wt_name) & (ValidationDailySummaryModel.name == name) &
+                (ValidationDailySummaryModel.run_type == run_type) &
+                (ValidationDailySummaryModel.params_hash == row_params_hash) &
+                (ValidationDailySummaryModel.date == date))
+        model = ValidationDailySummaryModel.select().where(cond).first()
+        if model is None:
+            ValidationDailySummaryModel.insert(
+                wt_name=wt_name, name=name, run_type=run_type, params_hash=row_params_hash, date=date,
+                run_count=summary['run_count'],
+                success_count=summary['success_count'],
+                ignored_count=summary['ignored_count'],
+                metrics=json_dumps(summary['metrics']),
+            ).execute()
+            return
+        metrics = merge_metric_ranges(json_loads(model.metrics) or {}, summary['metrics'])
+        ValidationDailySummaryModel.update(
+            run_count=ValidationDailySummaryModel.run_count + summary['run_count'],
+            success_count=ValidationDailySummaryModel.success_count + summary['success_count'],
+            ignored_count=ValidationDailySummaryModel.ignored_count + summary['ignored_count'],
+            metrics=json_dumps(metrics),
+            update_time=datetime.datetime.now(),
+        ).where(ValidationDailySummaryModel.id == model.id).execute()
+
+    def get_daily_summary(self, wt_name, start_date=None, end_date=None):
+        """
+        获取按天汇总的历史结果
+        :param wt_name: watchtower的名称(未替换宏)
+        :param start_date: 开始日期, 包含
+        :param end_date: 结束日期, 包含
+        :return:
+        """
+        query = ValidationDailySummaryModel.select().where(ValidationDailySummaryModel.wt_name == wt_name)
+        if start_date is not None:
+            query = query.where(ValidationDailySummaryModel.date >= start_date)
+        if end_date is not None:
+            query = query.where(ValidationDailySummaryModel.date <= end_date)
+        result = []
+        for model in query.order_by(ValidationDailySummaryModel.date, ValidationDailySummaryModel.id):
+            item = model.to_dict()
+            item['metrics'] = json_loads(item['metrics'])
+            result.append(item)
+        return result
+
+    def get_run_history(self, wt_name, start_time=None, end_time=None, after=None, limit=100, name=None,
+                        with_validators=True):
+        """
+        获取watchtower的运行历史, 按运行时间倒序. 使用(wt_name, run_type, run_time)索引
+        :param wt_name: watchtower的名称(未替换宏)
+        :param start_time: 开始时间, 包含
+        :param end_time: 结束时间, 不包含
+        :param after: 分页游标(run_time, id), 使用上一页最后一行的值
+        :param limit: 最多返回的行数
+        :param name: 替换宏之后的名称
+        :param with_validators: 是否返回每次运行中校验器的结果
+        :return:
+        """
+        model = ValidationDetailModel
+        query = model.select(
+            model.id, model.name, model.success, model.run_time, model.metrics, model.macro_maps,
+            model.run_id, model.ignored,
+        ).where((model.wt_name == wt_name) & (model.run_type == 1))
+        if start_time is not None:
+            query = query.where(model.run_time >= start_time)
+        if end_time is not None:
+            query = query.where(model.run_time < end_time)
+        if name is not None:
+            query = query.where(model.name == name)
+        if after is not None:
+            run_time, row_id = after
+            query = query.where((model.run_time < run_time) | ((model.run_time == run_time) & (model.id < row_id)))
+        query = query.order_by(model.run_time.desc(), model.id.desc())
+        if limit is not None:
+            query = query.limit(limit)
+        result = []
+        for row in query.dicts():
+            row['metrics'] = json_loads(row['metrics'])
+            row['macro_maps'] = json_loads(row['macro_maps'])
+            result.append(row)
+        if with_validators and result:
+            validators = {row['run_id']: [] for row in result}
+            query = model.select(
+                model.run_id, model.name, model.success, model.run_time, model.metrics, model.ignored,
+            ).where((model.wt_name == wt_name) & (model.run_type == 2) &
+                    model.run_id.in_(list(validators))).order_by(model.id)
+            for row in query.dicts():
+                row['metrics'] = json_loads(row['metrics'])
+                validators[row.pop('run_id')].append(row)
+            for row in result:
+                row['validators'] = validators[row['run_id']]
+        return result
+
+    def get_history_buckets(self, wt_name, start_time, end_time, bucket_seconds, name=None, metrics=None):
+        """
+        按固定的时间间隔对运行历史降采样. 每个时间段中watchtower以及每个校验器返回运行次数、失败次数,
+        数值指标返回最小值、最大值和平均值. 只返回聚合后的结果, 不返回明细.
+        明细已经汇总到dw_validation_daily_summary的日期, 每天的汇总结果归入当天开始时的时间段,
+        没有平均值(avg为None). 指定name时, 这些日期只返回watchtower的运行结果
+        :param wt_name: watchtower的名称(未替换宏)
+        :param start_time: 开始时间, 包含
+        :param end_time: 结束时间, 不包含
+        :param bucket_seconds: 时间间隔的秒数
+        :param name: 替换宏之后的名称
+        :param metrics: 只返回这些指标, 为None时返回所有数值指标. 嵌套的指标使用.连接
+        :return: 按时间排序. validator为None的是watchtower的运行结果
+        """
+        if bucket_seconds <= 0:
+            raise ValueError('bucket_seconds must be positive. value:%s' % bucket_seconds)
+        model = ValidationDetailModel
+        where = ((model.wt_name == wt_name) & (model.run_type.in_([1, 2])) &
+                 (model.run_time >= start_time) & (model.run_time < end_time))
+        if name is not None:
+            where &= model.run_id.in_(model.select(model.run_id).where(
+                (model.wt_name == wt_name) & (model.run_type == 1) & (model.name == name) &
+                (model.run_time >= start_time) & (model.run_time < end_time)))
+        offset = time_bucket_expression(self.database, model.run_time, bucket_seconds)
+        # watchtower的运行结果的name是替换宏之后的名称, 不参与分组
+        validator = Case(None, [(model.run_type == 2, model.name)], None)
+        epoch = datetime.datetime(1970, 1, 1)
+        buckets = {}
+
+        def get_bucket(offset_value, validator_name):
+            bucket = buckets.get((offset_value, validator_name))
+            if bucket is None:
+                bucket = buckets[(offset_value, validator_name)] = dict(
+                    time=epoch + datetime.timedelta(seconds=offset_value),
+                    validator=validator_name,
+                    run_count=0,
+                    fail_count=0,
+                    metrics={},
+                )
+            return bucket
+
+        # 分组使用列的序号, 表达式中的参数在不同的位置绑定时有的数据库认为是不同的表达式
+        query = model.select(
+            offset, validator, fn.COUNT(model.id), fn.SUM(Case(None, [(model.success, 0)], 1)),
+        ).where(where).group_by(SQL('1'), SQL('2'))
+        for offset_value, validator_name, run_count, fail_count in query.tuples():
+            bucket = get_bucket(int(offset_value), validator_name)
+            bucket['run_count'] += run_count
+            bucket['fail_count'] += int(fail_count or 0)
+
+        metrics = set(metrics) if metrics is not None else None
+        if metrics is None or metrics:
+            # 只有校验器的结果有指标. 指定了指标时, 不包含这些指标名称的行不需要解析json
+            tokens = None if metrics is None else {'"%s"' % key.split('.', 1)[0] for key in metrics}
+            query = model.select(offset, model.name, model.metrics).where(where & (model.run_type == 2))
+            for offset_value, validator_name, row_metrics in query.tuples().iterator():
+                if not row_metrics or (tokens is not None and not any(token in row_metrics for token in tokens)):
+                    continue
+                bucket = get_bucket(int(offset_value), validator_name)
+                for key, value in flatten_metrics(json_loads(row_metrics)):
+                    if metrics is not None and key not in metrics:
+                        continue
+                    item = bucket['metrics'].get(key)
+                    if item is None:
+                        bucket['metrics'][key] = dict(min=value, max=value, sum=value, count=1)
+                    else:
+                        item['min'] = min(item['min'], value)
+                        item['max'] = max(item['max'], value)
+                        item['sum'] += value
+                        item['count'] += 1
+
+        summary_model = ValidationDailySummaryModel
+        query = summary_model.select().where(
+            (summary_model.wt_name == wt_name) & (summary_model.run_type.in_([1, 2])) &
+            (summary_model.date >= start_time.date()) & (summary_model.date <= end_time.date()))
+        if name is not None:
+            # 汇总后校验器的结果不再包含替换宏之后的名称
+            query = query.where((summary_model.run_type == 1) & (summary_model.name == name))
+        for summary in query.iterator():
+            day_start = datetime.datetime.combine(summary.date, datetime.time())
+            if day_start + datetime.timedelta(days=1) <= start_time or day_start >= end_time:
+                continue
+            day_offset = int((max(day_start, start_time) - epoch).total_seconds())
+            validator_name = summary.name if summary.run_type == 2 else None
+            bucket = get_bucket(day_offset - day_offset % bucket_seconds, validator_name)
+            bucket['run_count'] += summary.run_count
+            bucket['fail_count'] += summary.run_count - summary.success_count
+            if summary.run_type == 1:
+                continue
+            for key, value in (json_loads(summary.metrics) or {}).items():
+                if metrics is not None and key not in metrics:
+                    continue
+                item = bucket['metrics'].get(key)
+                if item is None:
+                    bucket['metrics'][key] = dict(min=value['min'], max=value['max'], sum=0, count=0)
+                else:
+                    item['min'] = min(item['min'], value['min'])
+                    item['max'] = max(item['max'], value['max'])
+        result = []
+        for key in sorted(buckets, key=lambda x: (x[0], x[1] is not None, x[1] or '')):
+            bucket = buckets[key]
+            for item in bucket['metrics'].values():
+                total, count = item.pop('sum'), item.pop('count')
+                item['avg'] = total / count if count else None
+            result.append(bucket)
+        return result
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+from data_watchtower.core.watchtower import Watchtower
+from data_watchtower.utils import MacroCache, state_dumps
+from data_watchtower.model.result_writer import ResultWriter
+
+logger = logging.getLogger(__name__)
+
+# 编译好的watchtower, {名称: (签名, watchtower, 锁)}. 进程池中每个工作进程各有一份
+COMPILED_CACHE_SIZE = 4096
+_compiled_watchtowers = {}
+_compiled_watchtowers_lock = threading.Lock()
+
+
+def get_compiled_watchtower(item):
+    """
+    获取编译好的watchtower. 加载器、参数和校验器都没有变化时复用上次的实例, 不重新构造加载器和校验器
+    :param item: DbServices.get_watchtower返回的数据
+    :return: (watchtower, 锁). 同一个watchtower同时只能有一次运行
+    """
+    signature = hashlib.md5(state_dumps(dict(
+        data_loader=item.get('data_loader'), params=item.get('params'), validators=item.get('validators'),
+    )).encode('utf-8')).hexdigest()
+    with _compiled_watchtowers_lock:
+        entry = _compiled_watchtowers.get(item['name'])
+        if entry is None or entry[0] != signature:
+            watchtower = Watchtower.from_dict(item)
+            watchtower.compile()
+            if len(_compiled_watchtowers) >= COMPILED_CACHE_SIZE:
+                _compiled_watchtowers.clear()
+            entry = _compiled_watchtowers[item['name']] = (signature, watchtower, threading.Lock())
+    return entry[1], entry[2]
+
+
+def run_watchtower(item, custom_macro_map=None, state=None, macro_cache=None, baselines=None):
+    """
+    运行单个watchtower. 在进程池中运行时, 参数和返回值都需要可以pickle
+    :param item: DbServices.get_watchtower返回的数据
+    :param custom_macro_map:
+    :param state: 增量校验的状态
+    :param macro_cache: 共享的MacroCache, 只在线程池中使用
+    :param baselines: 校验器指标历史值的状态
+    :return: (运行结果, 耗时)
+    """
+    start = time.perf_counter()
+    watchtower, lock = get_compiled_watchtower(item)
+    with lock:
+        if custom_macro_map:
+            watchtower.set_custom_macro(**custom_macro_map)
+        watchtower.set_macro_cache(macro_cache)
+        result = watchtower.run(state=state, baselines=baselines)
+    return result, time.perf_counter() - start
+
+
+class WatchtowerRunner(object):
+    def __init__(self, db_svr, max_workers=4, executor='thread', custom_macro_map=None, save_result=True,
+                 macro_ttl=60, metrics_store=None, write_behind=False, write_batch_size=100):
+        """
+        批量并发运行保存在数据库中的watchtower. 单个watchtower失败不会影响其他的watchtower
+        :param db_svr: DbServices
+        :param max_workers: 最大并发数
+        :param executor: thread 或 process. process模式下custom_macro_map需要可以pickle(不能使用lambda)
+        :param custom_macro_map: 所有watchtower都使用的自定义宏
+        :param save_result: 是否保存运行结果
+        :param macro_ttl: callable宏(例如today)的结果在多少秒内被所有watchtower共享. 为0时每个watchtower单独计算
+        :param metrics_store: MetricsStore, 不为空时同时把校验器的数值指标写入列式存储
+        :param write_behind: 是否使用ResultWriter在后台批量保存运行结果
+        :param write_batch_size: 后台保存时每个事务最多保存的运行结果数量
+        """
+        if executor not in ('thread', 'process'):
+            raise ValueError('executor must be thread or process. value:%s' % executor)
+        self.db_svr = db_svr
+        self.max_workers = max_workers
+        self.executor = executor
+        self.custom_macro_map = custom_macro_map or {}
+        self.save_result = save_result
+        self.metrics_store = metrics_store
+        self.write_behind = write_behind
+        self.write_batch_size = write_batch_size
+        # 进程池中不能共享缓存, 每个watchtower单独计算
+        self.macro_cache = None
+        if macro_ttl and executor == 'thread':
+            self.macro_cache = MacroCache(macro_ttl)
+        self._process_pool = None
+
+    def get_executor(self):
+        """
+        进程池在多次运行之间复用, 每个工作进程中编译好的watchtower可以被之后的运行使用. 不再使用时调用close
+        :return:
+        """
+        if self.executor == 'process':
+            if self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._process_pool
+        return ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def close(self):
+        if self._process_pool is not None:
+            self._process_pool.shutdown()
+            self._process_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_watchtower_names(self, names=None, filter_func=None):
+        """
+        :param names: watchtower名称列表. 为None时使用所有的watchtower
+        :param filter_func: 过滤函数, 参数是DbServices.get_watchtowers返回的一行数据
+        :return:
+        """
+        return [item['name'] for item in self.iter_watchtowers(names, filter_func)]
+
+    def iter_watchtowers(self, names=None, filter_func=None):
+        """
+        批量加载watchtower以及它们的校验器
+        :param names: watchtower名称列表. 为None时使用所有的watchtower
+        :param filter_func: 过滤函数, 参数是DbServices.get_watchtowers_full返回的一行数据
+        :return:
+        """
+        for item in self.db_svr.get_watchtowers_full(names=names):
+            if filter_func is None or filter_func(item):
+                yield item
+
+    @staticmethod
+    def need_state(item):
+        params = item.get('params') or {}
+        return bool(params.get('watermark_column') or params.get('fingerprint'))
+
+    def run(self, names=None, filter_func=None):
+        """
+        并发运行watchtower
+        :param names: watchtower名称列表. 为None时运行所有的watchtower
+        :param filter_func: 过滤函数, 参数是DbServices.get_watchtowers_full返回的一行数据
+        :return: 汇总结果. details中是每个watchtower的运行情况
+        """
+        start = time.perf_counter()
+        details = {}
+        futures = {}
+        items = list(self.iter_watchtowers(names, filter_func))
+        if names is not None:
+            found = {item['name'] for item in items}
+            for name in names:
+                if name not in found:
+                    details[name] = dict(success=None, error='watchtower not found', elapsed=0)
+        states = self.db_svr.get_watchtower_states([item['name'] for item in items if self.need_state(item)])
+        baselines = self.db_svr.get_metric_baselines([item['name'] for item in items])
+        writer = None
+        if self.save_result and self.write_behind:
+            writer = ResultWriter(self.db_svr, batch_size=self.write_batch_size)
+        executor = self.get_executor()
+        try:
+            for item in items:
+                state = states.get(item['name'])
+                # 没有历史的watchtower传入空的历史, 运行后保存新的状态
+                future = executor.submit(run_watchtower, item, self.custom_macro_map, state, self.macro_cache,
+                                         baselines.get(item['name'], {}))
+                futures[future] = item
+            for future in as_completed(futures):
+                item = futures[future]
+                name = item['name']
+                try:
+                    result, elapsed = future.result()
+                    run_id = None
+                    if writer is not None:
+                        run_id = writer.submit(get_compiled_watchtower(item)[0], result)
+                    elif self.save_result:
+                        run_id = self.db_svr.save_result(get_compiled_watchtower(item)[0], result)
+                    if self.metrics_store is not None:
+                        self.metrics_store.append(name, result, run_id=run_id)
+                except Exception as e:
+                    logger.exception("failed to run watchtower: %s" % name)
+                    details[name] = dict(success=None, error=str(e), elapsed=0)
+                    continue
+                details[name] = dict(success=result['success'], error=None, elapsed=elapsed)
+        finally:
+            if executor is not self._process_pool:
+                executor.shutdown()
+            if writer is not None:
+                writer.close()
+        if writer is not None:
+            for name, error in writer.errors:
+                # 与其他错误一致, 没有保存的结果不计入成功或失败
+                details[name].update(success=None, error=error)
+        elapsed_list = [item['elapsed'] for item in details.values()]
+        return dict(
+            total=len(details),
+            success=sum(1 for item in details.values() if item['success'] is True),
+            failed=sum(1 for item in details.values() if item['success'] is False),
+            error=sum(1 for item in details.values() if item['error'] is not None),
+            elapsed=time.perf_counter() - start,
+            run_elapsed=sum(elapsed_list),
+            max_elapsed=max(elapsed_list, default=0),
+            details=details,
+        )
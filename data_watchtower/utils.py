@@ -1,19 +1,234 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
 import inspect
 import re
 import json
-import copy
+import time
+import datetime
+import decimal
+import hashlib
+import threading
+import logging
 import importlib
+import importlib.util
 from pkgutil import iter_modules
+from collections.abc import Mapping
+from functools import lru_cache
 from string import Template
 
 from attrs import asdict
-from playhouse.db_url import connect
+from peewee import MySQLDatabase, PostgresqlDatabase, SqliteDatabase, SQL, Cast, NodeList, fn
+from playhouse.db_url import connect, schemes
+
+logger = logging.getLogger(__name__)
+
+DB_POOL_MAX_CONNECTIONS = int(os.getenv("DW_DB_POOL_MAX_CONNECTIONS", 8))
+# 连接创建后超过这个时间(秒)会被丢弃, 重新连接
+DB_POOL_STALE_TIMEOUT = int(os.getenv("DW_DB_POOL_STALE_TIMEOUT", 3600))
+# 连接池超过这个时间(秒)没有使用时, 关闭其中空闲的连接
+DB_POOL_IDLE_TIMEOUT = int(os.getenv("DW_DB_POOL_IDLE_TIMEOUT", 300))
+# 连接数达到上限时, 等待可用连接的时间(秒)
+DB_POOL_TIMEOUT = int(os.getenv("DW_DB_POOL_TIMEOUT", 30))
+# 自定义插件索引文件的路径, 为空时只在内存中缓存
+PLUGIN_INDEX_PATH = os.getenv("DW_PLUGIN_INDEX_PATH") or None
+
+_database_pools = {}
+_database_pools_lock = threading.Lock()
+
+
+class SqliteStddevSamp(object):
+    """
+    SQLite没有样本标准差函数, 注册为聚合函数使用. Welford算法, 没有大数相减的精度损失
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def step(self, value):
+        if value is None:
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def finalize(self):
+        if self.count < 2:
+            return None
+        return (self.m2 / (self.count - 1)) ** 0.5
 
 
 def connect_db_from_url(url, **connect_params):
-    return connect(url, unquote_password=True, **connect_params)
+    database = connect(url, unquote_password=True, **connect_params)
+    if isinstance(database, SqliteDatabase):
+        database.register_aggregate(SqliteStddevSamp, 'DW_STDDEV_SAMP', 1)
+    return database
+
+
+def get_pool_url(url):
+    """
+    转换成playhouse.db_url中对应的连接池的url. 不支持连接池的返回None
+    :param url: eg. mysql://user:passwd@ip:port/my_db
+    :return: eg. mysql+pool://user:passwd@ip:port/my_db
+    """
+    if '://' not in url:
+        return None
+    scheme, rest = url.split('://', 1)
+    if scheme.endswith('+pool'):
+        return url
+    if scheme + '+pool' in schemes:
+        return '%s+pool://%s' % (scheme, rest)
+    return None
+
+
+def to_connectorx_uri(url):
+    """
+    把playhouse.db_url格式的url转换成connectorx使用的uri
+    :param url: eg. sqlite:///data.db postgres+pool://user:passwd@ip:port/my_db
+    :return: eg. sqlite:///abs/path/data.db postgresql://user:passwd@ip:port/my_db
+    """
+    scheme, rest = url.split('://', 1)
+    scheme = scheme.split('+')[0]
+    if scheme in ('sqlite', 'sqliteext'):
+        # connectorx只支持绝对路径
+        path = rest[1:] if rest.startswith('/') else rest
+        return 'sqlite://%s' % os.path.abspath(path)
+    elif scheme in ('postgres', 'postgresql', 'postgresext', 'postgresqlext', 'psycopg3', 'cockroachdb', 'crdb'):
+        return 'postgresql://%s' % rest
+    else:
+        return '%s://%s' % (scheme, rest)
+
+
+def get_pooled_database(url):
+    """
+    获取进程内共享的数据库连接池, 相同的url使用同一个连接池.
+    使用database.connection()获取当前线程的连接, database.close()把连接还给连接池.
+    取连接时会检查连接是否可用, 超过DW_DB_POOL_STALE_TIMEOUT的连接会重新创建
+    :param url:
+    :return:
+    """
+    now = time.monotonic()
+    with _database_pools_lock:
+        item = _database_pools.get(url)
+        if item is None:
+            pool_url = get_pool_url(url)
+            if pool_url is None:
+                database = connect_db_from_url(url)
+            else:
+                connect_params = {}
+                if pool_url.startswith('sqlite'):
+                    # 连接池中的连接会被不同的线程使用(同一时间只有一个线程在用)
+                    connect_params['check_same_thread'] = False
+                database = connect_db_from_url(
+                    pool_url,
+                    max_connections=DB_POOL_MAX_CONNECTIONS,
+                    stale_timeout=DB_POOL_STALE_TIMEOUT,
+                    timeout=DB_POOL_TIMEOUT,
+                    **connect_params
+                )
+            item = _database_pools[url] = [database, now]
+        database, last_used = item
+        item[1] = now
+    if now - last_used > DB_POOL_IDLE_TIMEOUT and hasattr(database, 'close_idle'):
+        database.close_idle()
+    return database
+
+
+def close_pooled_databases():
+    """
+    关闭所有连接池中的连接
+    :return:
+    """
+    with _database_pools_lock:
+        items = list(_database_pools.values())
+        _database_pools.clear()
+    for database, _ in items:
+        if hasattr(database, 'close_all'):
+            database.close_all()
+        else:
+            database.close()
+
+
+def _reset_database_pools():
+    # fork出来的子进程不能使用父进程的连接
+    global _database_pools_lock
+    _database_pools.clear()
+    _database_pools_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_database_pools)
+
+
+def quote_identifier(database, name):
+    """
+    按数据库的规则给字段名加引号
+    :param database: peewee的Database对象
+    :param name:
+    :return:
+    """
+    left, right = database.quote
+    return left + name.replace(right, right * 2) + right
+
+
+def random_function(database):
+    """
+    数据库的随机数函数, 用于随机抽样
+    :param database: peewee的Database对象
+    :return:
+    """
+    if isinstance(database, MySQLDatabase):
+        return "RAND()"
+    return "RANDOM()"
+
+
+def stddev_function(database):
+    """
+    数据库的样本标准差聚合函数, 不支持时返回None
+    :param database: peewee的Database对象
+    :return:
+    """
+    if isinstance(database, (MySQLDatabase, PostgresqlDatabase)):
+        return "STDDEV_SAMP"
+    if isinstance(database, SqliteDatabase) and 'DW_STDDEV_SAMP' in database._aggregates:
+        return "DW_STDDEV_SAMP"
+    return None
+
+
+def time_bucket_expression(database, field, bucket_seconds):
+    """
+    按固定的时间间隔截断时间字段, 返回时间段开始时距离1970-01-01 00:00:00的整数秒数, 不考虑时区.
+    用于在数据库中按时间段分组
+    :param database: peewee的Database对象
+    :param field: 时间字段
+    :param bucket_seconds: 时间间隔的秒数
+    :return: peewee的表达式
+    """
+    if isinstance(database, MySQLDatabase):
+        seconds = fn.TIMESTAMPDIFF(SQL('SECOND'), '1970-01-01 00:00:00', field)
+        return NodeList((seconds, SQL('DIV'), bucket_seconds), parens=True) * bucket_seconds
+    if isinstance(database, PostgresqlDatabase):
+        seconds = Cast(NodeList((SQL('EXTRACT(EPOCH FROM'), field, SQL(')'))), 'BIGINT')
+    else:
+        seconds = Cast(fn.strftime('%s', field), 'INTEGER')
+    # 整数相除
+    return seconds / bucket_seconds * bucket_seconds
+
+
+class SqlQuote(object):
+    """
+    下推时传给Validator.sql_aggregations的quote: 调用时给字段名加引号, stddev是样本标准差函数名(不支持时为None)
+    """
+
+    def __init__(self, quote, stddev=None):
+        self.quote = quote
+        self.stddev = stddev
+
+    def __call__(self, name):
+        return self.quote(name)
 
 
 def load_object(path):
@@ -24,6 +239,16 @@ def load_object(path):
             raise TypeError("Unexpected argument type, expected string "
                             "or object, got: %s" % type(path))
 
+    return _load_object_path(path)
+
+
+@lru_cache(maxsize=1024)
+def _load_object_path(path):
+    """
+    import_module和getattr的结果只解析一次
+    :param path: module:name
+    :return:
+    """
     if ':' in path:
         module, obj_name = path.split(':', maxsplit=1)
     else:
@@ -103,11 +328,98 @@ class StringTemplate(Template):
     idpattern = r'(?a:[_a-zA-Z][_:a-zA-Z0-9]*)'
 
 
+@lru_cache(maxsize=65536)
+def compile_template(string):
+    """
+    把字符串解析成片段列表, 每个字符串只解析一次.
+    str是普通文本, tuple是 (宏名称, 原文), 宏不存在时保留原文, 与safe_substitute一致
+    :param string:
+    :return:
+    """
+    segments = []
+    pos = 0
+    for match in StringTemplate.pattern.finditer(string):
+        start, end = match.span()
+        if start > pos:
+            segments.append(string[pos:start])
+        if match.group('escaped') is not None:
+            segments.append(StringTemplate.delimiter)
+        else:
+            name = match.group('named') or match.group('braced')
+            if name is None:
+                segments.append(match.group())
+            else:
+                segments.append((name, match.group()))
+        pos = end
+    if pos < len(string):
+        segments.append(string[pos:])
+    return tuple(segments)
+
+
+def is_plain_string(string):
+    """
+    字符串中没有宏和转义, 替换前后不会变化
+    :param string:
+    :return:
+    """
+    segments = compile_template(string)
+    return not segments or segments == (string,)
+
+
+def render_template(segments, mapping):
+    """
+    :param segments: compile_template的结果
+    :param mapping: {宏名称: 值}
+    :return:
+    """
+    parts = []
+    for segment in segments:
+        if isinstance(segment, str):
+            parts.append(segment)
+        elif segment[0] in mapping:
+            parts.append('%s' % (mapping[segment[0]],))
+        else:
+            parts.append(segment[1])
+    return ''.join(parts)
+
+
+class MacroCache(object):
+    """
+    callable宏的计算结果缓存. 同一批运行的watchtower共享, 超过ttl秒后重新计算
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, impl):
+        now = time.monotonic()
+        with self._lock:
+            item = self._values.get(name)
+        if item is not None and item[0] is impl and now - item[1] < self.ttl:
+            return item[2]
+        value = impl()
+        with self._lock:
+            self._values[name] = (impl, now, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
 class MacroTemplate(object):
     template = StringTemplate
 
-    def __init__(self, macro_config):
-        self.macro_config = copy.deepcopy(macro_config)
+    def __init__(self, macro_config, macro_cache=None):
+        """
+        :param macro_config: {宏名称: 值或者{'impl': 值或者函数}}
+        :param macro_cache: MacroCache. 为None时每次都调用函数计算宏的值
+        """
+        # 只会修改第一层, 不需要深拷贝
+        self.macro_config = dict(macro_config)
+        self.macro_cache = macro_cache
         self._strings = []
         self._using_macro_names = set()
         self.used_macro_maps = None
@@ -126,33 +438,34 @@ class MacroTemplate(object):
             if isinstance(item, dict):
                 impl = item['impl']
                 if impl and callable(impl):
-                    result[name] = impl()
+                    if self.macro_cache is not None:
+                        result[name] = self.macro_cache.get(name, impl)
+                    else:
+                        result[name] = impl()
                 else:
                     result[name] = impl
             else:
                 result[name] = item
         return result
 
-    def get_used_macro_maps(self, strings):
+    def get_used_macro_names(self, strings):
         used_names = set()
         for string in strings:
-            names = self.get_using_macro_names(string)
-            used_names.update(set(names))
-        return self.get_macro_map(used_names)
+            used_names.update(self.get_using_macro_names(string))
+        return {name for name in used_names if name in self.macro_config}
+
+    def get_used_macro_maps(self, strings):
+        return self.get_macro_map(self.get_used_macro_names(strings))
 
     def get_using_macro_names(self, string):
         """
         获取字符串中包含的宏名称
         :return:
         """
-        names = []
-        for item in re.findall(self.template.pattern, string):
-            name = item[1] or item[2]
-            names.append(name)
-        return names
+        return [segment[0] for segment in compile_template(string) if not isinstance(segment, str)]
 
     def apply_string(self, string):
-        return self.template(string).safe_substitute(**self.macro_config)
+        return render_template(compile_template(string), self.macro_config)
 
     def apply(self, value):
         """
@@ -177,6 +490,35 @@ class MacroTemplate(object):
             return value
 
 
+def flatten_metrics(metrics, prefix=''):
+    """
+    展开嵌套的指标, 只保留数值类型的指标. 例如{'a': {'b': 1}} 转换为 [('a.b', 1.0)]
+    :param metrics:
+    :param prefix:
+    :return:
+    """
+    result = []
+    for key, value in (metrics or {}).items():
+        key = "%s%s" % (prefix, key)
+        if isinstance(value, dict):
+            result.extend(flatten_metrics(value, prefix=key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            result.append((key, float(value)))
+    return result
+
+
+def params_hash(params):
+    """
+    校验器参数的摘要. 同一个watchtower中相同类型的校验器使用参数的摘要区分
+    :param params: 替换宏之后的参数, 与dw_validation_detail中保存的params一致
+    :return:
+    """
+    if params is None:
+        return ''
+    data = json.dumps(params, default=str, ensure_ascii=True, sort_keys=True)
+    return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+
 def json_dumps(obj):
     def _default_encoder(_obj):
         return str(_obj)
@@ -195,6 +537,60 @@ def json_loads(data):
         return data
 
 
+def sql_literal(value):
+    """
+    把值转换成SQL字面量
+    :param value:
+    :return:
+    """
+    if value is None:
+        return 'NULL'
+    elif isinstance(value, bool):
+        return '1' if value else '0'
+    elif isinstance(value, (int, float, decimal.Decimal)):
+        return str(value)
+    elif isinstance(value, datetime.datetime):
+        value = value.isoformat(sep=' ')
+    elif isinstance(value, datetime.date):
+        value = value.isoformat()
+    return "'%s'" % str(value).replace("'", "''")
+
+
+def _state_encoder(obj):
+    if isinstance(obj, datetime.datetime):
+        return {'__datetime__': obj.isoformat()}
+    elif isinstance(obj, datetime.date):
+        return {'__date__': obj.isoformat()}
+    elif isinstance(obj, decimal.Decimal):
+        return float(obj)
+    elif isinstance(obj, (set, frozenset)):
+        return list(obj)
+    return str(obj)
+
+
+def _state_decoder(obj):
+    if '__datetime__' in obj:
+        return datetime.datetime.fromisoformat(obj['__datetime__'])
+    elif '__date__' in obj:
+        return datetime.date.fromisoformat(obj['__date__'])
+    return obj
+
+
+def state_dumps(obj):
+    """
+    序列化聚合状态. 与json_dumps不同, 日期类型反序列化后类型不变
+    :param obj:
+    :return:
+    """
+    return json.dumps(obj, default=_state_encoder, ensure_ascii=True, sort_keys=True)
+
+
+def state_loads(data):
+    if not data:
+        return None
+    return json.loads(data, object_hook=_state_decoder)
+
+
 def walk_modules(path):
     mods = []
     mod = importlib.import_module(path)
@@ -220,6 +616,146 @@ def load_subclasses(root_modules, base_class):
     return result
 
 
+def iter_module_files(name, spec=None):
+    """
+    不导入模块, 列出包中的所有模块以及对应的文件
+    :param name: 模块路径
+    :param spec: 为None时使用importlib查找
+    :return: [(模块路径, 文件路径)]
+    """
+    if spec is None:
+        spec = importlib.util.find_spec(name)
+        if spec is None:
+            raise ModuleNotFoundError("No module named %r" % name)
+    yield name, spec.origin
+    for finder, sub_name, is_pkg in iter_modules(spec.submodule_search_locations or []):
+        full_name = name + '.' + sub_name
+        sub_spec = finder.find_spec(full_name)
+        if sub_spec is not None:
+            yield from iter_module_files(full_name, sub_spec)
+
+
+def file_signature(path):
+    if not path or not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_mtime, stat.st_size]
+
+
+class PluginIndex(object):
+    """
+    自定义插件的索引, 格式: {模块路径: {signature: 文件的mtime和大小, classes: {基类: [类名]}}}.
+    只有新增或者修改过的模块才会被导入扫描, 其他模块在第一次使用类时才导入.
+    path为空时只在当前进程的内存中缓存, 不写入文件
+    """
+    version = 1
+
+    def __init__(self, path=PLUGIN_INDEX_PATH):
+        self.path = path
+        self._data = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._data is None:
+            data = None
+            if self.path and os.path.isfile(self.path):
+                try:
+                    with open(self.path, encoding='utf-8') as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    data = None
+            if not isinstance(data, dict) or data.get('version') != self.version:
+                data = dict(version=self.version, modules={})
+            self._data = data
+        return self._data
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp_path = "%s.%s.tmp" % (self.path, os.getpid())
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._data, f, ensure_ascii=True, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning("failed to save plugin index: %s" % self.path, exc_info=e)
+
+    def get_classes(self, root_modules, base_class):
+        """
+        查找root_modules中定义的base_class的子类
+        :param root_modules: 模块路径列表, 不存在的模块会被忽略
+        :param base_class:
+        :return: {类名: 类的路径(module:name)}
+        """
+        key = "%s:%s" % (base_class.__module__, base_class.__name__)
+        result = {}
+        with self._lock:
+            modules = self.load()['modules']
+            changed = False
+            for root_module in root_modules:
+                try:
+                    module_files = list(iter_module_files(root_module))
+                except ModuleNotFoundError:
+                    continue
+                for module_name, origin in module_files:
+                    signature = file_signature(origin)
+                    entry = modules.get(module_name)
+                    if entry is None or entry['signature'] != signature:
+                        entry = dict(signature=signature, classes={})
+                    if key not in entry['classes']:
+                        module = importlib.import_module(module_name)
+                        entry['classes'][key] = [
+                            obj.__name__ for obj in vars(module).values()
+                            if inspect.isclass(obj) and issubclass(obj, base_class) and obj.__module__ == module_name
+                        ]
+                        modules[module_name] = entry
+                        changed = True
+                    for name in entry['classes'][key]:
+                        result[name] = "%s:%s" % (module_name, name)
+            if changed:
+                self.save()
+        return result
+
+
+@lru_cache()
+def get_plugin_index():
+    return PluginIndex()
+
+
+class LazyClassMap(Mapping):
+    """
+    {类名: 类}, 第一次访问某个类时才导入对应的模块
+    """
+
+    def __init__(self, paths):
+        """
+        :param paths: {类名: 类的路径(module:name)}
+        """
+        self.paths = paths
+        self._version = None
+
+    @property
+    def version(self):
+        """
+        注册的类变化时版本也会变化, 用于缓存根据这些类生成的数据
+        :return:
+        """
+        if self._version is None:
+            data = json.dumps(sorted(self.paths.items()))
+            self._version = hashlib.md5(data.encode('utf-8')).hexdigest()
+        return self._version
+
+    def __getitem__(self, name):
+        return load_object(self.paths[name])
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+
 def get_subclasses(cls):
     subclasses = []
     for subclass in cls.__subclasses__():
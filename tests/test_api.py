@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+import tempfile
+import datetime
+from unittest import mock
+import tornado.web
+from tornado.testing import AsyncHTTPTestCase
+from data_watchtower import DbServices, Watchtower, DatabaseLoader, ExpectRowCountToBeBetween
+from data_watchtower.api.url import URLS
+from data_watchtower.model import services
+from data_watchtower.api.handlers.watchtower import WatchtowerListHandler
+from data_watchtower.core.base import ValidationResult
+
+
+class TestApi(AsyncHTTPTestCase):
+    def get_app(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_svr = DbServices('sqlite:///%s' % os.path.join(self.tmp_dir, 'api.db'))
+        self.db_svr.create_tables()
+        return tornado.web.Application(URLS, database=self.db_svr, debug=False)
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def get_json(self, response):
+        return json.loads(response.body)['data']
+
+    def test_list_etag(self):
+        for path in ('/data_watchtower/v1/validators', '/data_watchtower/v1/data_loaders'):
+            response = self.fetch(path)
+            assert response.code == 200
+            etag = response.headers['Etag']
+            records = self.get_json(response)['records']
+            assert all('schema' in item for item in records)
+            # 缓存的结果与etag都不变
+            response = self.fetch(path)
+            assert response.headers['Etag'] == etag
+            response = self.fetch(path, headers={'If-None-Match': etag})
+            assert response.code == 304
+            assert response.body == b''
+
+    def test_watchtower_list(self):
+        data_loader = DatabaseLoader(query='SELECT 1', connection='sqlite:///:memory:')
+        watchtower = Watchtower(name='api_list', data_loader=data_loader)
+        watchtower.add_validator(ExpectRowCountToBeBetween(ExpectRowCountToBeBetween.Params(min_value=1)))
+        self.db_svr.add_watchtower(watchtower)
+        response = self.fetch('/data_watchtower/v1/watchtowers')
+        records = self.get_json(response)['records']
+        assert [item['name'] for item in records] == ['api_list']
+        assert records[0]['data_loader_schema'] == DatabaseLoader.to_schema()
+
+    def test_watchtower_list_pagination(self):
+        for i in range(5):
+            data_loader = DatabaseLoader(query='SELECT %s' % i, connection='sqlite:///:memory:')
+            watchtower = Watchtower(name='page_%s' % i, data_loader=data_loader)
+            if i % 2 == 0:
+                watchtower.add_validator(ExpectRowCountToBeBetween(ExpectRowCountToBeBetween.Params(min_value=1)))
+            self.db_svr.add_watchtower(watchtower)
+        self.db_svr.update_watchtower('page_1', success=False)
+        names = []
+        cursor = None
+        while True:
+            path = '/data_watchtower/v1/watchtowers?limit=2'
+            if cursor:
+                path += '&after=%s' % cursor
+            data = self.get_json(self.fetch(path))
+            names.extend(item['name'] for item in data['records'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+        assert names == ['page_%s' % i for i in range(5)]
+
+        # 没有校验器的watchtower也会返回
+        records = self.db_svr.get_watchtowers(fields=['name', 'validator_count'])
+        assert [item['validator_count'] for item in records] == [1, 0, 1, 0, 1]
+        assert set(records[0]) == {'name', 'validator_count'}
+
+        data = self.get_json(self.fetch('/data_watchtower/v1/watchtowers?success=false&fields=name,success'))
+        assert data['records'] == [dict(name='page_1', success=False)]
+        data = self.get_json(self.fetch('/data_watchtower/v1/watchtowers?data_loader_cls=FileLoader'))
+        assert data['records'] == []
+        data = self.get_json(self.fetch('/data_watchtower/v1/watchtowers?data_loader_cls=DatabaseLoader&limit=1'))
+        assert data['records'][0]['cls_name'] == 'DatabaseLoader'
+
+        # 不合法的参数返回1004, limit超过最大值时按最大值分页
+        for query in ('limit=abc', 'success=maybe', 'run_time_after=yesterday', 'fields=name,secret'):
+            response = self.fetch('/data_watchtower/v1/watchtowers?' + query)
+            assert response.code == 200
+            assert json.loads(response.body)['err_code'] == 1004
+        data = self.get_json(self.fetch('/data_watchtower/v1/watchtowers?limit=100000&success=0&fields=name'))
+        assert data['records'] == [dict(name='page_1')]
+        WatchtowerListHandler.MAX_LIMIT = 2
+        try:
+            data = self.get_json(self.fetch('/data_watchtower/v1/watchtowers?limit=100000&fields=name'))
+        finally:
+            del WatchtowerListHandler.MAX_LIMIT
+        assert [item['name'] for item in data['records']] == ['page_0', 'page_1']
+        assert data['next_cursor'] == 'page_1'
+
+    def test_watchtower_history(self):
+        data_loader = DatabaseLoader(query='SELECT 1', connection='sqlite:///:memory:')
+        watchtower = Watchtower(name='history', data_loader=data_loader)
+        self.db_svr.add_watchtower(watchtower)
+        start = datetime.datetime(2024, 5, 1)
+        for i in range(6):
+            run_time = start + datetime.timedelta(hours=12 * i)
+            validator_result = ValidationResult(success=i != 3, run_time=run_time, metrics=dict(total_rows=i))
+            validator_result.name = 'expect_row_count_to_be_between'
+            validator_result.params = {}
+            result = dict(name='history', success=i != 3, run_time=run_time, macro_maps={}, metrics={},
+                          validators_result=[validator_result])
+            self.db_svr.save_result(watchtower, result)
+
+        records = []
+        path = '/data_watchtower/v1/watchtower/history?name=history&limit=4'
+        data = self.get_json(self.fetch(path))
+        records.extend(data['records'])
+        data = self.get_json(self.fetch(path + '&after=%s' % data['next_cursor']))
+        records.extend(data['records'])
+        assert data['next_cursor'] is None
+        # 按运行时间倒序, 包含每次运行中校验器的结果
+        assert [item['validators'][0]['metrics']['total_rows'] for item in records] == [5, 4, 3, 2, 1, 0]
+        assert [item['success'] for item in records] == [True, True, False, True, True, True]
+
+        path = '/data_watchtower/v1/watchtower/history?name=history&bucket=86400' \
+               '&start_time=2024-05-01T00:00:00&end_time=2024-05-03T00:00:00'
+        data = self.get_json(self.fetch(path))
+        buckets = [item for item in data['buckets'] if item['validator']]
+        assert [item['run_count'] for item in buckets] == [2, 2]
+        assert [item['fail_count'] for item in buckets] == [0, 1]
+        assert buckets[1]['metrics']['total_rows'] == dict(min=2, max=3, avg=2.5)
+        assert [item['fail_count'] for item in data['buckets'] if item['validator'] is None] == [0, 1]
+
+        # 次数在数据库中分组计算, 只有包含指定指标的行才解析json
+        decoded = []
+        with mock.patch.object(services, 'json_loads', side_effect=lambda value: decoded.append(value) or
+                               json.loads(value)):
+            start_time, end_time = datetime.datetime(2024, 5, 1), datetime.datetime(2024, 5, 3)
+            buckets = self.db_svr.get_history_buckets('history', start_time, end_time, 86400, metrics=['other'])
+            assert [item['run_count'] for item in buckets] == [2, 2, 2, 2]
+            assert all(item['metrics'] == {} for item in buckets)
+            assert decoded == []
+            buckets = self.db_svr.get_history_buckets('history', start_time, end_time, 86400, name='history',
+                                                      metrics=['total_rows'])
+            assert buckets[3]['metrics']['total_rows'] == dict(min=2, max=3, avg=2.5)
+            assert len(decoded) == 4
+
+        # limit超出范围时截断, 参数格式错误时返回错误码
+        data = self.get_json(self.fetch('/data_watchtower/v1/watchtower/history?name=history&limit=0'))
+        assert len(data['records']) == 1
+        data = self.get_json(self.fetch('/data_watchtower/v1/watchtower/history?name=history&limit=-5'))
+        assert len(data['records']) == 1
+        for query in ('limit=x', 'bucket=x', 'bucket=0', 'after=x', 'start_time=x'):
+            response = self.fetch('/data_watchtower/v1/watchtower/history?name=history&' + query)
+            assert response.code == 200
+            assert json.loads(response.body)['err_code'] == 1004
+
+        # 已经汇总的日期使用dw_validation_daily_summary
+        self.db_svr.compact_validation_detail(before=datetime.datetime(2024, 5, 2))
+        data = self.get_json(self.fetch(path))
+        buckets = [item for item in data['buckets'] if item['validator']]
+        assert [item['run_count'] for item in buckets] == [2, 2]
+        assert [item['fail_count'] for item in buckets] == [0, 1]
+        assert buckets[0]['metrics']['total_rows'] == dict(min=0, max=1, avg=None)
+        assert buckets[1]['metrics']['total_rows'] == dict(min=2, max=3, avg=2.5)
+        assert [item['run_count'] for item in data['buckets'] if item['validator'] is None] == [2, 2]
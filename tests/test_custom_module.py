@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
+import sys
 import logging
 import pytest
+from data_watchtower import Validator
 from data_watchtower.core import get_registered_validators, get_registered_data_loaders
+from data_watchtower.utils import PluginIndex, LazyClassMap
 
 
 def test_validator_schema():
@@ -21,3 +25,42 @@ def test_data_loader_schema():
         except Exception as e:
             logging.error("failed to get schema for %s" % cls.__name__, exc_info=e)
             assert cls.__name__ is None
+
+
+def test_plugin_index(tmp_path, monkeypatch):
+    package = tmp_path / 'dw_test_plugins'
+    (package / 'sub').mkdir(parents=True)
+    (package / '__init__.py').write_text('')
+    (package / 'sub' / '__init__.py').write_text('')
+    (package / 'sub' / 'checks.py').write_text(
+        "from data_watchtower import ExpectRowCountToBeBetween\n\n\n"
+        "class ExpectPluginRowCount(ExpectRowCountToBeBetween):\n    pass\n"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    index_path = str(tmp_path / 'index.json')
+
+    index = PluginIndex(index_path)
+    classes = index.get_classes(['dw_test_plugins', 'not_exists'], Validator)
+    assert classes == {'ExpectPluginRowCount': 'dw_test_plugins.sub.checks:ExpectPluginRowCount'}
+    assert os.path.isfile(index_path)
+
+    # 使用索引时不会导入模块, 第一次访问类时才导入
+    monkeypatch.delitem(sys.modules, 'dw_test_plugins.sub.checks')
+    classes = PluginIndex(index_path).get_classes(['dw_test_plugins'], Validator)
+    assert 'dw_test_plugins.sub.checks' not in sys.modules
+    class_map = LazyClassMap(classes)
+    assert class_map['ExpectPluginRowCount'].__name__ == 'ExpectPluginRowCount'
+    assert 'dw_test_plugins.sub.checks' in sys.modules
+
+    # 文件修改后重新扫描
+    with open(str(package / 'sub' / 'checks.py'), 'a') as f:
+        f.write("\n\nclass ExpectPluginOther(ExpectRowCountToBeBetween):\n    pass\n")
+    monkeypatch.delitem(sys.modules, 'dw_test_plugins.sub.checks')
+    classes = PluginIndex(index_path).get_classes(['dw_test_plugins'], Validator)
+    assert set(classes) == {'ExpectPluginRowCount', 'ExpectPluginOther'}
+
+    # 没有配置路径时只在内存中缓存
+    monkeypatch.chdir(tmp_path)
+    index = PluginIndex(None)
+    assert set(index.get_classes(['dw_test_plugins'], Validator)) == {'ExpectPluginRowCount', 'ExpectPluginOther'}
+    assert set(os.listdir(str(tmp_path))) == {'dw_test_plugins', 'index.json'}
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import pytest
+import polars as pl
+from attrs import define, field
+from data_watchtower.core.base import DataLoader
+from data_watchtower.utils import MacroTemplate, get_pool_url, get_pooled_database, to_connectorx_uri
+from data_watchtower import (Watchtower, FileLoader, DatabaseLoader, ParallelDatabaseLoader, ExpectRowCountToBeBetween, ExpectColumnMeanToBeBetween,
+                             ExpectColumnValuesToNotBeNull, ExpectColumnDistinctValuesToBeInSet,
+                             ExpectColumnNullRatioToBeBetween, ExpectColumnStdToBeBetween, ExpectColumnRecentlyUpdated)
+
+
+@define()
+class FramesLoader(DataLoader):
+    """
+    测试用的加载器, 按批次返回给定的数据并记录加载的次数
+    """
+    frames = field(type=list)
+    loads = field(factory=list, type=list)
+
+    def _load(self):
+        self.loads.append('load')
+        return pl.concat(self.frames, how='diagonal_relaxed')
+
+    def _iter_batches(self, batch_size):
+        self.loads.append('iter_batches')
+        yield from self.frames
+
+
+@pytest.fixture
+def parquet_path(tmp_path):
+    path = str(tmp_path / 'data.parquet')
+    df = pl.DataFrame({
+        'column1': [1, 2, 3, 4, 5],
+        'column2': ['a', 'b', None, 'd', 'e'],
+    })
+    df.write_parquet(path)
+    return path
+
+
+def test_file_loader(parquet_path):
+    data_loader = FileLoader(path=parquet_path)
+    assert isinstance(data_loader.load(), pl.DataFrame)
+    assert isinstance(data_loader.load_lazy(), pl.LazyFrame)
+    assert len(data_loader.load()) == 5
+
+
+def test_lazy_watchtower(parquet_path):
+    results = []
+    for lazy in (False, True):
+        wt = Watchtower(name='lazy', data_loader=FileLoader(path=parquet_path), lazy=lazy)
+        wt.add_validator(ExpectRowCountToBeBetween(ExpectRowCountToBeBetween.Params(min_value=3, max_value=7)))
+        wt.add_validator(ExpectColumnMeanToBeBetween(ExpectColumnMeanToBeBetween.Params(column='column1')))
+        wt.add_validator(ExpectColumnValuesToNotBeNull(ExpectColumnValuesToNotBeNull.Params(column='column2')))
+        wt.add_validator(ExpectColumnDistinctValuesToBeInSet(
+            ExpectColumnDistinctValuesToBeInSet.Params(column='column2', value_set=['a', 'b', 'd', 'e'])))
+        results.append(wt.run())
+    eager, lazy = results
+    assert eager['success'] == lazy['success'] is False
+    for x, y in zip(eager['validators_result'], lazy['validators_result']):
+        assert x.success == y.success
+        assert x.metrics == y.metrics
+
+
+def test_pooled_database_loader(tmp_path):
+    url = 'sqlite:///%s' % (tmp_path / 'pool.db')
+    assert get_pool_url(url) == 'sqlite+pool:///%s' % (tmp_path / 'pool.db')
+    assert get_pool_url('mysql+pool://u:p@host/db') == 'mysql+pool://u:p@host/db'
+    database = get_pooled_database(url)
+    assert get_pooled_database(url) is database
+    database.execute_sql("CREATE TABLE t (a INTEGER)")
+    database.execute_sql("INSERT INTO t VALUES (1), (2)")
+    database.close()
+
+    data_loader = DatabaseLoader(query="SELECT * FROM t", connection=url)
+    for _ in range(3):
+        assert len(data_loader.load()) == 2
+    # 连接被还回连接池并复用
+    assert len(database._in_use) == 0
+    assert len(database._connections) == 1
+
+
+def test_parallel_database_loader(tmp_path):
+    path = tmp_path / 'parallel.db'
+    url = 'sqlite:///%s' % path
+    assert to_connectorx_uri('sqlite:///data.db') == 'sqlite://%s' % os.path.abspath('data.db')
+    assert to_connectorx_uri('postgres+pool://u:p@host:5432/db') == 'postgresql://u:p@host:5432/db'
+    database = get_pooled_database(url)
+    database.execute_sql("CREATE TABLE t (id INTEGER PRIMARY KEY, a TEXT)")
+    database.execute_sql("INSERT INTO t (a) VALUES ('a'), ('b'), ('c'), (NULL)")
+    database.close()
+
+    expected = DatabaseLoader(query="SELECT * FROM t", connection=url).load()
+    data_loader = ParallelDatabaseLoader(query="SELECT * FROM t", connection=url, partition_on='id', partition_num=2)
+    data = data_loader.load()
+    assert sorted(data['id']) == sorted(expected['id'])
+    assert data['a'].null_count() == 1
+
+
+def test_pushdown_std(tmp_path):
+    url = 'sqlite:///%s' % (tmp_path / 'std.db')
+    database = get_pooled_database(url)
+    database.execute_sql("CREATE TABLE t (a REAL)")
+    # 数值很大而方差很小, 使用平方和计算时精度全部丢失
+    database.execute_sql("INSERT INTO t VALUES %s" % ", ".join("(%s)" % (1e9 + i % 3) for i in range(300)))
+    database.close()
+    data_loader = DatabaseLoader(query="SELECT * FROM t", connection=url)
+    validator = ExpectColumnStdToBeBetween(ExpectColumnStdToBeBetween.Params(column='a'))
+    aggregates = Watchtower.compute_pushdown_aggregates(data_loader, [validator])[0]
+    expected = data_loader.load()['a'].std()
+    assert aggregates['std'] == pytest.approx(expected, rel=1e-6)
+
+
+def test_pushdown_missing_column(tmp_path):
+    url = 'sqlite:///%s' % (tmp_path / 'missing.db')
+    database = get_pooled_database(url)
+    database.execute_sql("CREATE TABLE t (a REAL)")
+    database.execute_sql("INSERT INTO t VALUES (1), (2)")
+    database.close()
+    wt = Watchtower(name='missing', data_loader=DatabaseLoader(query="SELECT * FROM t", connection=url),
+                    pushdown=True)
+    wt.add_validator(ExpectColumnRecentlyUpdated(ExpectColumnRecentlyUpdated.Params(update_time_column='not_exists')))
+    wt.add_validator(ExpectColumnStdToBeBetween(ExpectColumnStdToBeBetween.Params(column='a')))
+    # 字段不存在的校验器不下推, 其他校验器不受影响
+    result = wt.run()
+    assert result['validators_result'][0].success is False
+    assert result['validators_result'][0].metrics['last_updated_time'] is None
+    assert result['validators_result'][1].metrics['std'] == pytest.approx(0.7071, abs=0.01)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_sampling(tmp_path, lazy):
+    path = str(tmp_path / 'sample.parquet')
+    pl.DataFrame({'column1': [i if i % 2 else None for i in range(10000)]}).write_parquet(path)
+    wt = Watchtower(name='sample', data_loader=FileLoader(path=path), lazy=lazy, sample_size=200, sample_seed=1)
+    # 全部数据的空值比率是0.5, 不在范围内, 但是样本的置信区间与范围有交集
+    wt.add_validator(ExpectColumnNullRatioToBeBetween(
+        ExpectColumnNullRatioToBeBetween.Params(column='column1', min_value=0.3, max_value=0.48)))
+    result = wt.run()
+    metrics = result['validators_result'][0].metrics
+    assert result['metrics']['sample_size'] == 200
+    assert metrics['total_rows'] == 200
+    assert metrics['null_ratio_lower'] < 0.48 < metrics['null_ratio_upper']
+    assert result['success'] is True
+
+
+def test_batch_schema_change():
+    # 第二批才缺少字段, 第一批已经丢弃, 校验器使用完整的数据, 而不是只使用剩余的批次
+    frames = [pl.DataFrame({'a': [1, 2], 'b': [1, None]}), pl.DataFrame({'a': [3]}), pl.DataFrame({'a': [4], 'b': [5]})]
+    data_loader = FramesLoader(frames=frames)
+    wt = Watchtower(name='schema', data_loader=data_loader, batch_size=2)
+    wt.add_validator(ExpectRowCountToBeBetween(ExpectRowCountToBeBetween.Params(min_value=1)))
+    wt.add_validator(ExpectColumnValuesToNotBeNull(ExpectColumnValuesToNotBeNull.Params(column='b')))
+    data, states = wt.compute_batch_aggregates(data_loader, [validator for validator, _ in wt.spawn_validators(
+        MacroTemplate(wt.get_macro_maps()))], 2)
+    assert data is None
+    assert states[0]['total_rows'] == 4 and states[1] is None
+    result = wt.run()
+    assert result['validators_result'][0].metrics['total_rows'] == 4
+    assert result['validators_result'][1].metrics['total_rows'] == 4
+    assert result['validators_result'][1].metrics['null_rows'] == 2
+
+
+def test_sampling_loads_once():
+    frames = [pl.DataFrame({'a': [i if i % 2 else None for i in range(100)]})]
+    data_loader = FramesLoader(frames=frames)
+    wt = Watchtower(name='sample_once', data_loader=data_loader, sample_size=10, sample_seed=1)
+    wt.add_validator(ExpectColumnNullRatioToBeBetween(ExpectColumnNullRatioToBeBetween.Params(column='a')))
+    wt.add_validator(ExpectRowCountToBeBetween(ExpectRowCountToBeBetween.Params(min_value=1)))
+    result = wt.run()
+    # 加载器不支持抽样时只加载一次, 在polars中抽样
+    assert wt._data_loader.loads == ['load']
+    assert result['validators_result'][0].metrics['total_rows'] == 10
+    assert result['validators_result'][1].metrics['total_rows'] == 100
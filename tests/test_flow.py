@@ -1,12 +1,20 @@
 import os
 import pytest
 import random
+import threading
 import datetime
 from faker import Faker
 from peewee import *
 from playhouse.db_url import connect
-from data_watchtower import (DbServices, Watchtower, DatabaseLoader,
-                             ExpectRowCountToBeBetween, ExpectColumnValuesToNotBeNull)
+from data_watchtower.utils import MacroTemplate, params_hash, json_dumps
+from data_watchtower.model.metrics_store import MetricsStore
+from data_watchtower.model.result_writer import ResultWriter
+from data_watchtower.model.models import WatchtowerLatestModel, ValidationDetailModel, ValidationDailySummaryModel
+from data_watchtower import (DbServices, Watchtower, DatabaseLoader, WatchtowerRunner,
+                             ExpectRowCountToBeBetween, ExpectColumnValuesToNotBeNull, ExpectColumnMeanToBeBetween,
+                             ExpectColumnStdToBeBetween, ExpectColumnNullRatioToBeBetween,
+                             ExpectColumnDistinctValuesToContainSet, ExpectColumnRecentlyUpdated,
+                             ExpectMetricToMatchBaseline)
 
 dw_test_data_db_url = os.getenv('DW_TEST_DATA_DB_URL', 'sqlite:///test.db')
 dw_backend_db_url = os.getenv('DW_BACKEND_DB_URL', "sqlite:///data.db")
@@ -79,6 +87,11 @@ def teardown_module():
     pass
 
 
+def exact_metrics(metrics):
+    # 下推时没有分位数和直方图, 分批合并时是近似值
+    return {k: v for k, v in metrics.items() if k not in ('quantiles', 'histogram')}
+
+
 @pytest.fixture
 def custom_macro_map():
     return {
@@ -194,3 +207,493 @@ def test_case1(db_svr):
     assert result['name'] == watchtower.macro_template.apply_string(watchtower.name)
     assert wt_name == watchtower.name
     return
+
+
+def test_pushdown(custom_macro_map):
+    query = "SELECT * FROM score where date='${today}'"
+    results = []
+    for pushdown in (False, True):
+        data_loader = DatabaseLoader(query=query, connection=dw_test_data_db_url)
+        watchtower = Watchtower(name='pushdown', data_loader=data_loader, custom_macro_map=custom_macro_map,
+                                pushdown=pushdown)
+        watchtower.add_validator(ExpectRowCountToBeBetween(ExpectRowCountToBeBetween.Params(min_value=1)))
+        watchtower.add_validator(ExpectColumnNullRatioToBeBetween(
+            ExpectColumnNullRatioToBeBetween.Params(column='math')))
+        watchtower.add_validator(ExpectColumnMeanToBeBetween(ExpectColumnMeanToBeBetween.Params(column='chinese')))
+        watchtower.add_validator(ExpectColumnStdToBeBetween(ExpectColumnStdToBeBetween.Params(column='english')))
+        # 不能下推的校验器会加载数据后计算
+        watchtower.add_validator(ExpectColumnDistinctValuesToContainSet(
+            ExpectColumnDistinctValuesToContainSet.Params(column='name', value_set=[])))
+        results.append(watchtower.run())
+    full, pushed = results
+    assert full['success'] == pushed['success']
+    for x, y in zip(full['validators_result'], pushed['validators_result']):
+        assert x.success == y.success
+        assert exact_metrics(x.metrics) == y.metrics
+
+
+def test_sampling():
+    data_loader = DatabaseLoader(query="SELECT * FROM score", connection=dw_test_data_db_url)
+    watchtower = Watchtower(name='sampling', data_loader=data_loader, sample_size=50, sample_confidence=0.9)
+    watchtower.add_validator(ExpectRowCountToBeBetween(ExpectRowCountToBeBetween.Params(min_value=1)))
+    watchtower.add_validator(ExpectColumnNullRatioToBeBetween(ExpectColumnNullRatioToBeBetween.Params(column='math')))
+    result = watchtower.run()
+    # 行数校验使用全部数据, 只有比率类的校验器使用样本
+    total_rows = connect(dw_test_data_db_url).execute_sql("SELECT COUNT(*) FROM score").fetchone()[0]
+    assert total_rows > 50
+    assert result['validators_result'][0].metrics['total_rows'] == total_rows
+    assert 'confidence' not in result['validators_result'][0].metrics
+    metrics = result['validators_result'][1].metrics
+    assert metrics['total_rows'] == 50
+    assert metrics['confidence'] == 0.9
+    assert metrics['null_ratio_lower'] <= metrics['null_ratio'] <= metrics['null_ratio_upper']
+
+
+def test_compile(custom_macro_map):
+    query = "SELECT * FROM score where date='${today}'"
+    data_loader = DatabaseLoader(query=query, connection=dw_test_data_db_url)
+    watchtower = Watchtower(name='compile', data_loader=data_loader, custom_macro_map=custom_macro_map)
+    watchtower.add_validator(ExpectRowCountToBeBetween(ExpectRowCountToBeBetween.Params(min_value=1)))
+    watchtower.add_validator(ExpectColumnNullRatioToBeBetween(
+        ExpectColumnNullRatioToBeBetween.Params(column='${column}')))
+    plan = watchtower.compile()
+    assert watchtower.compile() is plan
+    # 包含宏的字段每次运行时替换, 其他的只构造一次
+    assert plan.data_loader is None
+    assert plan.validators[0][2] is not None
+    assert plan.validators[1][2] is None
+    macro_template = MacroTemplate(watchtower.get_macro_maps())
+    loader, meta = plan.spawn_data_loader(macro_template)
+    assert loader.query == "SELECT * FROM score where date='%s'" % datetime.datetime.today().strftime("%Y-%m-%d")
+    validators = plan.spawn_validators(macro_template)
+    assert validators[1][0].params.column == 'name'
+    assert validators[0][0].params is plan.validators[0][2]
+    first, second = watchtower.run(), watchtower.run()
+    assert first['success'] == second['success']
+    watchtower.add_validator(ExpectRowCountToBeBetween(ExpectRowCountToBeBetween.Params(min_value=1)))
+    assert watchtower.compile() is not plan
+
+
+@pytest.mark.parametrize('executor,write_behind', [('thread', False), ('process', False), ('thread', True)])
+def test_runner(db_svr, executor, write_behind, tmp_path):
+    db_svr.create_tables()
+    names = ['runner_%s_%s_%s' % (executor, write_behind, i) for i in range(3)]
+    for i, name in enumerate(names):
+        db_svr.delete_watchtower(name)
+        # 最后一个watchtower的查询是错误的
+        query = "SELECT * FROM score" if i < 2 else "SELECT * FROM not_exists"
+        data_loader = DatabaseLoader(query=query, connection=dw_test_data_db_url)
+        watchtower = Watchtower(name=name, data_loader=data_loader)
+        watchtower.add_validator(ExpectRowCountToBeBetween(ExpectRowCountToBeBetween.Params(min_value=1)))
+        db_svr.add_watchtower(watchtower)
+    metrics_store = MetricsStore(str(tmp_path))
+    runner = WatchtowerRunner(db_svr, max_workers=2, executor=executor, metrics_store=metrics_store,
+                              write_behind=write_behind)
+    report = runner.run(filter_func=lambda row: row['name'] in names)
+    assert report['total'] == 3
+    assert report['success'] == 2
+    assert report['error'] == 1
+    assert report['details'][names[2]]['error'] is not None
+    assert db_svr.get_watchtower(names[0])['success'] is True
+    df = metrics_store.query(metrics=['total_rows'])
+    assert sorted(df['wt_name'].to_list()) == names[:2]
+    assert set(df['run_id']) <= {item.run_id for item in ValidationDetailModel.select().where(
+        ValidationDetailModel.wt_name.in_(names[:2]))}
+
+
+def test_runner_reuse_compiled(db_svr, monkeypatch):
+    db_svr.create_tables()
+    name = 'runner_compiled'
+    db_svr.delete_watchtower(name)
+    data_loader = DatabaseLoader(query="SELECT * FROM score", connection=dw_test_data_db_url)
+    watchtower = Watchtower(name=name, data_loader=data_loader)
+    watchtower.add_validator(ExpectRowCountToBeBetween(ExpectRowCountToBeBetween.Params(min_value=1)))
+    db_svr.add_watchtower(watchtower)
+    spawned = []
+    from_dict = Watchtower.from_dict.__func__
+    monkeypatch.setattr(Watchtower, 'from_dict', classmethod(lambda cls, data: spawned.append(1) or from_dict(cls, data)))
+    runner = WatchtowerRunner(db_svr, max_workers=1)
+    for _ in range(3):
+        assert runner.run(names=[name])['success'] == 1
+    # 第二次运行开始复用编译好的watchtower
+    assert len(spawned) == 1
+    # 校验器变化后重新编译
+    validator = ExpectRowCountToBeBetween(ExpectRowCountToBeBetween.Params(max_value=1)).to_dict()
+    db_svr.add_validator_to_watchtower(name, validator['__class__'], json_dumps(validator['params']))
+    assert runner.run(names=[name])['failed'] == 1
+    assert len(spawned) == 2
+
+
+def test_runner_write_error(db_svr, monkeypatch):
+    db_svr.create_tables()
+    name = 'runner_write_error'
+    db_svr.delete_watchtower(name)
+    data_loader = DatabaseLoader(query="SELECT * FROM score", connection=dw_test_data_db_url)
+    watchtower = Watchtower(name=name, data_loader=data_loader)
+    watchtower.add_validator(ExpectRowCountToBeBetween(ExpectRowCountToBeBetween.Params(min_value=1)))
+    db_svr.add_watchtower(watchtower)
+
+    def save_result(*args, **kwargs):
+        raise RuntimeError('save failed')
+
+    monkeypatch.setattr(db_svr, 'save_results', save_result)
+    monkeypatch.setattr(db_svr, 'save_result', save_result)
+    runner = WatchtowerRunner(db_svr, max_workers=1, write_behind=True)
+    report = runner.run(names=[name])
+    # 结果没有保存时与其他错误一致
+    assert report['details'][name]['success'] is None
+    assert report['details'][name]['error'] == 'save failed'
+    assert (report['success'], report['error']) == (0, 1)
+
+
+def test_result_writer(db_svr):
+    db_svr.create_tables()
+    names = ['writer_%s' % i for i in range(3)]
+    watchtowers = []
+    for name in names:
+        db_svr.delete_watchtower(name)
+        data_loader = DatabaseLoader(query="SELECT * FROM score", connection=dw_test_data_db_url)
+        watchtower = Watchtower(name=name, data_loader=data_loader)
+        watchtower.add_validator(ExpectRowCountToBeBetween(ExpectRowCountToBeBetween.Params(min_value=1)))
+        db_svr.add_watchtower(watchtower)
+        watchtowers.append(watchtower)
+    results = [watchtower.run() for watchtower in watchtowers]
+
+    # 队列很小时submit会等待写入, 关闭时写入剩余的结果
+    writer = ResultWriter(db_svr, batch_size=4, flush_interval=0.05, max_pending=2)
+    run_ids = []
+    for i in range(12):
+        run_ids.append(writer.submit(watchtowers[i % 3], results[i % 3]))
+    writer.close()
+    assert writer.written == 12
+    assert writer.errors == []
+    assert writer.batches < 12
+    rows = ValidationDetailModel.select().where(ValidationDetailModel.run_id.in_(run_ids))
+    assert len(rows) == 12 * 2
+    assert all(db_svr.get_watchtower(name)['success'] is True for name in names)
+    with pytest.raises(RuntimeError):
+        writer.submit(watchtowers[0], results[0])
+
+    # 一个结果保存失败时不影响同一批的其他结果
+    with ResultWriter(db_svr, batch_size=10, flush_interval=0.05) as writer:
+        writer.submit(watchtowers[0], results[0])
+        writer.submit(watchtowers[1], dict(results[1], validators_result=None))
+        writer.flush()
+        assert writer.written == 1
+    assert [name for name, _ in writer.errors] == [names[1]]
+
+    # 不是Exception的错误也不会让后台线程退出, flush不会一直等待
+    class Fatal(BaseException):
+        pass
+
+    def fail(*args, **kwargs):
+        raise Fatal()
+
+    with ResultWriter(db_svr, batch_size=10, flush_interval=0.05) as writer:
+        save_results = db_svr.save_results
+        db_svr.save_results = fail
+        try:
+            writer.submit(watchtowers[0], results[0])
+            flusher = threading.Thread(target=writer.flush, daemon=True)
+            flusher.start()
+            flusher.join(timeout=5)
+            assert not flusher.is_alive()
+        finally:
+            db_svr.save_results = save_results
+        writer.submit(watchtowers[1], results[1])
+        writer.flush()
+        assert writer.written == 1
+    assert [name for name, _ in writer.errors] == [names[0]]
+
+
+def test_get_watchtowers_full(db_svr):
+    db_svr.create_tables()
+    names = ['full_%s' % i for i in range(5)]
+    for i, name in enumerate(names):
+        db_svr.delete_watchtower(name)
+        data_loader = DatabaseLoader(query="SELECT * FROM score", connection=dw_test_data_db_url)
+        watchtower = Watchtower(name=name, data_loader=data_loader)
+        for _ in range(i):
+            watchtower.add_validator(ExpectRowCountToBeBetween(ExpectRowCountToBeBetween.Params(min_value=i)))
+        db_svr.add_watchtower(watchtower)
+    items = list(db_svr.get_watchtowers_full(names=names + ['not_exists'], batch_size=2))
+    assert [item['name'] for item in items] == names
+    for item in items:
+        expected = db_svr.get_watchtower(item['name'])
+        assert item.pop('validator_count') == len(expected['validators'])
+        assert item == expected
+    # 不指定名称时使用游标分页
+    items = [item for item in db_svr.get_watchtowers_full(batch_size=2) if item['name'] in names]
+    assert [item['validator_count'] for item in items] == [0, 1, 2, 3, 4]
+    report = WatchtowerRunner(db_svr, save_result=False).run(names=names[:2] + ['not_exists'])
+    assert report['total'] == 3
+    assert report['details']['not_exists']['error'] == 'watchtower not found'
+
+
+def test_watchtower_latest(db_svr):
+    db_svr.create_tables()
+
+    def save(watchtower, name, success, days):
+        run_time = datetime.datetime(2024, 5, 1) + datetime.timedelta(days=days)
+        result = dict(name=name, success=success, run_time=run_time, macro_maps={}, metrics={}, validators_result=[])
+        db_svr.save_result(watchtower, result)
+        return db_svr.get_watchtower(watchtower.name)['success']
+
+    data_loader = DatabaseLoader(query="SELECT * FROM score", connection=dw_test_data_db_url)
+    for success_method in ('all', 'last'):
+        wt_name = 'latest_%s' % success_method
+        db_svr.delete_watchtower(wt_name)
+        watchtower = Watchtower(name=wt_name, data_loader=data_loader, success_method=success_method)
+        db_svr.add_watchtower(watchtower)
+        assert save(watchtower, 'day1', False, 1) is False
+        assert save(watchtower, 'day2', True, 2) is (success_method == 'last')
+        # 较早的结果不会覆盖最近的结果
+        assert save(watchtower, 'day2', False, 0) is (success_method == 'last')
+        assert save(watchtower, 'day1', True, 3) is True
+        # 忽略的名称再次运行后仍然忽略
+        if success_method == 'all':
+            WatchtowerLatestModel.update(ignored=True).where(
+                (WatchtowerLatestModel.wt_name == wt_name) & (WatchtowerLatestModel.name == 'day1')).execute()
+            assert save(watchtower, 'day1', False, 4) is True
+            assert WatchtowerLatestModel.get(wt_name=wt_name, name='day1').ignored is True
+            WatchtowerLatestModel.update(ignored=False).where(WatchtowerLatestModel.wt_name == wt_name).execute()
+            assert save(watchtower, 'day1', True, 5) is True
+
+    # 根据历史明细重新生成
+    WatchtowerLatestModel.delete().execute()
+    assert db_svr.backfill_watchtower_latest() >= 4
+    rows = WatchtowerLatestModel.select().where(WatchtowerLatestModel.wt_name == 'latest_all').order_by(
+        WatchtowerLatestModel.name)
+    assert [(row.name, row.success, row.run_time.day) for row in rows] == [('day1', True, 6), ('day2', True, 3)]
+
+
+def test_save_results_statements(db_svr, monkeypatch):
+    db_svr.create_tables()
+    data_loader = DatabaseLoader(query="SELECT * FROM score", connection=dw_test_data_db_url)
+    watchtower = Watchtower(name='save_statements', data_loader=data_loader)
+    db_svr.delete_watchtower(watchtower.name)
+    db_svr.add_watchtower(watchtower)
+
+    ValidationDetailModel.delete().where(ValidationDetailModel.wt_name == watchtower.name).execute()
+    WatchtowerLatestModel.delete().where(WatchtowerLatestModel.wt_name == watchtower.name).execute()
+
+    def save(count, days):
+        run_time = datetime.datetime(2024, 5, 1) + datetime.timedelta(days=days)
+        items = []
+        for i in range(count):
+            result = dict(name='name%s' % i, success=True, run_time=run_time, macro_maps={}, metrics={},
+                          validators_result=[], state={'watermark': days},
+                          baselines=[dict(validator='v', params_hash='', metric='m%s' % i, state={'days': days})])
+            items.append((watchtower, result, None))
+        statements = []
+        execute_sql = db_svr.database.execute_sql
+        monkeypatch.setattr(db_svr.database, 'execute_sql',
+                            lambda sql, *args, **kwargs: statements.append(sql) or execute_sql(sql, *args, **kwargs))
+        db_svr.save_results(items)
+        monkeypatch.undo()
+        return len([sql for sql in statements if sql.startswith(('UPDATE', 'INSERT', 'DELETE'))])
+
+    # 写入的语句数量与名称的数量无关
+    save(20, 1)
+    assert save(2, 2) == save(20, 3)
+    assert db_svr.get_watchtower_state(watchtower.name)['watermark'] == 3
+    assert db_svr.get_metric_baselines([watchtower.name])[watchtower.name][('v', '', 'm0')] == {'days': 3}
+    db_svr.delete_watchtower(watchtower.name)
+
+
+def test_compact_validation_detail(db_svr):
+    db_svr.create_tables()
+    wt_name = 'compact'
+    ValidationDetailModel.delete().where(ValidationDetailModel.wt_name == wt_name).execute()
+    ValidationDailySummaryModel.delete().where(ValidationDailySummaryModel.wt_name == wt_name).execute()
+    rows = []
+    for day in (1, 2):
+        for hour, value in enumerate((3, 1, 5)):
+            rows.append(dict(
+                wt_name=wt_name, name='validator', success=value > 1, run_type=2, ignored=hour == 0,
+                run_time=datetime.datetime(2024, 5, day, hour), params='{"column": "a"}',
+                metrics='{"value": %s, "flag": true, "label": "x"}' % value,
+            ))
+    # 相同类型、参数不同的校验器单独汇总, 没有值的指标被忽略
+    rows.append(dict(
+        wt_name=wt_name, name='validator', success=True, run_type=2, run_time=datetime.datetime(2024, 5, 1, 5),
+        params='{"column": "b"}', metrics='{"value": 7, "sketch": {"min": null, "max": null}}',
+    ))
+    ValidationDetailModel.insert_many(rows).execute()
+    recent = datetime.datetime.now()
+    ValidationDetailModel.insert(wt_name=wt_name, name='validator', success=True, run_type=2,
+                                 run_time=recent, metrics='{"value": 100}').execute()
+
+    before = datetime.datetime(2024, 5, 2)
+    assert db_svr.compact_validation_detail(before=before, batch_size=2, wt_name=wt_name) == 4
+    assert db_svr.compact_validation_detail(retention_days=1, batch_size=2, wt_name=wt_name) == 3
+    # 没有需要处理的明细时不会重复汇总
+    assert db_svr.compact_validation_detail(retention_days=1, wt_name=wt_name) == 0
+    remaining = ValidationDetailModel.select().where(ValidationDetailModel.wt_name == wt_name)
+    assert [row.run_time for row in remaining] == [recent]
+
+    summary = db_svr.get_daily_summary(wt_name)
+    other = [item for item in summary if item['params_hash'] == params_hash({'column': 'b'})]
+    assert [(item['run_count'], item['metrics']) for item in other] == [(1, {'value': {'min': 7, 'max': 7}})]
+    summary = [item for item in summary if item not in other]
+    assert [item['date'] for item in summary] == [datetime.date(2024, 5, 1), datetime.date(2024, 5, 2)]
+    for item in summary:
+        assert (item['run_count'], item['success_count'], item['ignored_count']) == (3, 2, 1)
+        assert item['metrics'] == {'value': {'min': 1, 'max': 5}}
+    assert len(db_svr.get_daily_summary(wt_name, start_date=datetime.date(2024, 5, 2))) == 1
+
+
+def test_metric_baseline(db_svr):
+    db_svr.create_tables()
+    name = 'metric_baseline'
+    db_svr.delete_watchtower(name)
+    data_loader = DatabaseLoader(query="SELECT * FROM score", connection=dw_test_data_db_url)
+    watchtower = Watchtower(name=name, data_loader=data_loader)
+    watchtower.add_validator(ExpectMetricToMatchBaseline(ExpectMetricToMatchBaseline.Params(min_history=2)))
+    watchtower.add_validator(ExpectMetricToMatchBaseline(
+        ExpectMetricToMatchBaseline.Params(metric='null_ratio', column='math', min_history=2)))
+    db_svr.add_watchtower(watchtower)
+    runner = WatchtowerRunner(db_svr, max_workers=1)
+    for i in range(3):
+        assert runner.run(names=[name])['success'] == 1
+    baselines = db_svr.get_metric_baselines([name])[name]
+    row_count_key = ('expect_metric_to_match_baseline', params_hash(watchtower.get_validator_meta()[0]['params']),
+                     'row_count')
+    assert set(baselines) == {row_count_key, ('expect_metric_to_match_baseline',
+                                              params_hash(watchtower.get_validator_meta()[1]['params']), 'null_ratio:math')}
+    state = baselines[row_count_key]
+    assert state['count'] == 3
+    assert len(set(state['window'])) == 1
+
+    # 历史上行数不变, 行数变化时校验失败
+    data_loader = DatabaseLoader(query="SELECT * FROM score LIMIT 10", connection=dw_test_data_db_url)
+    watchtower = Watchtower(name=name, data_loader=data_loader)
+    watchtower.add_validator(ExpectMetricToMatchBaseline(ExpectMetricToMatchBaseline.Params(min_history=2)))
+    result = watchtower.run(baselines=baselines)
+    assert result['success'] is False
+    assert result['baselines'][0]['state']['count'] == 4
+    # 没有加载历史时不返回新的状态, 保存结果时不会覆盖已有的历史
+    result = watchtower.run()
+    assert 'baselines' not in result
+    db_svr.save_result(watchtower, result)
+    assert db_svr.get_metric_baselines([name])[name][row_count_key]['count'] == 3
+    db_svr.delete_watchtower(name)
+    assert db_svr.get_metric_baselines([name]) == {}
+
+
+def test_batch_size():
+    query = "SELECT * FROM score"
+    results = []
+    for batch_size in (None, 7):
+        data_loader = DatabaseLoader(query=query, connection=dw_test_data_db_url)
+        watchtower = Watchtower(name='batch', data_loader=data_loader, batch_size=batch_size)
+        watchtower.add_validator(ExpectRowCountToBeBetween(ExpectRowCountToBeBetween.Params(min_value=1)))
+        watchtower.add_validator(ExpectColumnNullRatioToBeBetween(
+            ExpectColumnNullRatioToBeBetween.Params(column='math')))
+        watchtower.add_validator(ExpectColumnMeanToBeBetween(ExpectColumnMeanToBeBetween.Params(column='chinese')))
+        watchtower.add_validator(ExpectColumnStdToBeBetween(ExpectColumnStdToBeBetween.Params(column='english')))
+        watchtower.add_validator(ExpectColumnRecentlyUpdated(
+            ExpectColumnRecentlyUpdated.Params(update_time_column='date', days=2)))
+        watchtower.add_validator(ExpectColumnDistinctValuesToContainSet(
+            ExpectColumnDistinctValuesToContainSet.Params(column='name', value_set=['not exists'])))
+        results.append(watchtower.run())
+    full, batched = results
+    assert full['success'] == batched['success']
+    for x, y in zip(full['validators_result'], batched['validators_result']):
+        assert x.success == y.success
+        assert exact_metrics(x.metrics) == exact_metrics(y.metrics)
+
+
+def test_incremental(db_svr, tmp_path):
+    db_svr.create_tables()
+    url = 'sqlite:///%s' % (tmp_path / 'events.db')
+    database = connect(url)
+    database.execute_sql("CREATE TABLE events (id INTEGER PRIMARY KEY, value INTEGER, name TEXT)")
+    database.execute_sql("INSERT INTO events (value, name) VALUES (1, 'a'), (2, NULL), (3, 'b')")
+
+    def create_watchtower():
+        data_loader = DatabaseLoader(query="SELECT * FROM events", connection=url)
+        watchtower = Watchtower(name='incremental', data_loader=data_loader, watermark_column='id')
+        watchtower.add_validator(ExpectRowCountToBeBetween(ExpectRowCountToBeBetween.Params(min_value=1)))
+        watchtower.add_validator(ExpectColumnNullRatioToBeBetween(
+            ExpectColumnNullRatioToBeBetween.Params(column='name')))
+        watchtower.add_validator(ExpectColumnMeanToBeBetween(ExpectColumnMeanToBeBetween.Params(column='value')))
+        return watchtower
+
+    db_svr.delete_watchtower('incremental')
+    watchtower = create_watchtower()
+    db_svr.add_watchtower(watchtower)
+    result = watchtower.run(state=db_svr.get_watchtower_state('incremental'))
+    assert result['state']['watermark'] == 3
+    db_svr.save_result(watchtower, result)
+
+    database.execute_sql("INSERT INTO events (value, name) VALUES (4, NULL), (5, 'c')")
+    state = db_svr.get_watchtower_state('incremental')
+    assert state.pop('run_id')
+    assert state == result['state']
+    incremental = create_watchtower().run(state=state)
+    full = create_watchtower().run()
+    assert incremental['state']['watermark'] == 5
+    for x, y in zip(incremental['validators_result'], full['validators_result']):
+        assert x.success == y.success
+        assert exact_metrics(x.metrics) == exact_metrics(y.metrics)
+    assert full['validators_result'][0].metrics['total_rows'] == 5
+
+    # 原始数据只在本次运行的metrics中, 不写入状态
+    watchtower = create_watchtower()
+    watchtower.add_validator(ExpectColumnStdToBeBetween(
+        ExpectColumnStdToBeBetween.Params(column='value', keep_values=True, max_values=100)))
+    result = watchtower.run()
+    assert result['validators_result'][-1].metrics['values'] == [1, 2, 3, 4, 5]
+    assert all('values' not in item for item in result['state']['validators'].values())
+
+
+def test_fingerprint(db_svr, tmp_path, monkeypatch):
+    db_svr.create_tables()
+    url = 'sqlite:///%s' % (tmp_path / 'dim.db')
+    database = connect(url)
+    database.execute_sql("CREATE TABLE dim (id INTEGER PRIMARY KEY, name TEXT)")
+    database.execute_sql("INSERT INTO dim (name) VALUES ('a'), (NULL), ('b')")
+
+    def create_watchtower():
+        data_loader = DatabaseLoader(query="SELECT * FROM dim", connection=url)
+        watchtower = Watchtower(name='fingerprint', data_loader=data_loader, fingerprint=True)
+        watchtower.add_validator(ExpectColumnNullRatioToBeBetween(
+            ExpectColumnNullRatioToBeBetween.Params(column='name', max_value=0.5)))
+        return watchtower
+
+    db_svr.delete_watchtower('fingerprint')
+    watchtower = create_watchtower()
+    db_svr.add_watchtower(watchtower)
+    result = watchtower.run()
+    assert 'reused_run_id' not in result
+    db_svr.save_result(watchtower, result)
+
+    state = db_svr.get_watchtower_state('fingerprint')
+    # 指纹相同时不计算校验器的聚合
+    with monkeypatch.context() as m:
+        m.setattr(ExpectColumnNullRatioToBeBetween, 'aggregations', lambda self: 1 / 0)
+        reused = create_watchtower().run(state=state)
+    assert reused['reused_run_id'] == state['run_id']
+    assert reused['validators_result'][0].metrics == result['validators_result'][0].metrics
+    db_svr.save_result(watchtower, reused)
+    assert db_svr.get_watchtower_state('fingerprint')['run_id'] == state['run_id']
+
+    database.execute_sql("INSERT INTO dim (name) VALUES (NULL)")
+    watchtower = create_watchtower()
+    changed = watchtower.run(state=state)
+    assert 'reused_run_id' not in changed
+    assert changed['validators_result'][0].metrics['null_rows'] == 2
+    # 同一个watchtower多次运行, 之前结果中的metrics不会被修改
+    database.execute_sql("INSERT INTO dim (name) VALUES ('c')")
+    again = watchtower.run(state=state)
+    assert again['metrics'] is not changed['metrics']
+    assert again['metrics']['fingerprint'] != changed['metrics']['fingerprint']
+
+    data_loader = DatabaseLoader(query="SELECT * FROM dim", connection=url)
+    pushdown = Watchtower(name='fingerprint', data_loader=data_loader, fingerprint=True, pushdown=True)
+    pushdown.add_validator(ExpectColumnNullRatioToBeBetween(
+        ExpectColumnNullRatioToBeBetween.Params(column='name', max_value=0.5)))
+    result = pushdown.run(state=db_svr.get_watchtower_state('fingerprint'))
+    assert 'reused_run_id' not in result
+    assert result['validators_result'][0].metrics['null_rows'] == 2
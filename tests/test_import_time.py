@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys
+import json
+import subprocess
+
+HEAVY_MODULES = ('polars', 'pandas', 'numpy', 'apischema', 'arrow', 'tornado')
+
+
+def import_in_subprocess(statement):
+    code = (
+        "import sys, time, json\n"
+        "start = time.perf_counter()\n"
+        "%s\n"
+        "elapsed = time.perf_counter() - start\n"
+        "print(json.dumps(dict(elapsed=elapsed, modules=[m for m in %r if m in sys.modules])))\n"
+    ) % (statement, HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', code])
+    return json.loads(output)
+
+
+def test_import_time():
+    result = import_in_subprocess("import data_watchtower")
+    assert result['modules'] == []
+    # 不导入任何依赖时只需要几毫秒, 留出足够的余量避免在慢的机器上失败
+    assert result['elapsed'] < 0.5
+
+
+def test_lazy_attributes():
+    result = import_in_subprocess("from data_watchtower import DbServices, WatchtowerRunner")
+    assert 'pandas' not in result['modules']
+    assert 'apischema' not in result['modules']
+    result = import_in_subprocess("from data_watchtower import ExpectRowCountToBeBetween, get_registered_validators")
+    assert 'pandas' not in result['modules']
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from data_watchtower.utils import StringTemplate, MacroTemplate, MacroCache, compile_template
+
+
+def test_compiled_template():
+    mapping = {'today': '2024-05-01', 'a:1': 'x'}
+    strings = [
+        "SELECT * FROM t WHERE date='${today}'",
+        "$today and $a:1 and ${missing} and $$today and $ and $1",
+        "no macros",
+        "",
+    ]
+    template = MacroTemplate(mapping)
+    for string in strings:
+        assert template.apply_string(string) == StringTemplate(string).safe_substitute(**mapping)
+    assert template.get_using_macro_names(strings[1]) == ['today', 'a:1', 'missing']
+    assert template.get_used_macro_names(strings) == {'today', 'a:1'}
+    # 相同的字符串只解析一次
+    assert compile_template(strings[0]) is compile_template(strings[0])
+
+
+def test_macro_cache():
+    calls = []
+
+    def impl():
+        calls.append(1)
+        return len(calls)
+
+    config = {'counter': {'impl': impl}}
+    cache = MacroCache(ttl=60)
+    for _ in range(3):
+        assert MacroTemplate(config, cache).get_macro_map(['counter']) == {'counter': 1}
+    assert len(calls) == 1
+    # 过期后重新计算
+    cache.ttl = 0
+    assert MacroTemplate(config, cache).get_macro_map(['counter']) == {'counter': 2}
+    # 不使用缓存时每次都计算
+    assert MacroTemplate(config).get_macro_map(['counter']) == {'counter': 3}
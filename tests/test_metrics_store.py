@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import datetime
+import pytest
+from data_watchtower.core.base import ValidationResult
+from data_watchtower.model.metrics_store import MetricsStore, flatten_metrics
+
+
+def make_result(run_time, row_count):
+    validator_result = ValidationResult(
+        success=row_count > 1, run_time=run_time,
+        metrics=dict(total_rows=row_count, stats=dict(mean=row_count / 2), ok=True, label='x'),
+    )
+    validator_result.name = 'expect_row_count_to_be_between'
+    validator_result.params = {}
+    return dict(name='wt_%s' % run_time.day, success=validator_result.success, run_time=run_time,
+                macro_maps={}, metrics={}, validators_result=[validator_result])
+
+
+def test_flatten_metrics():
+    assert flatten_metrics({'a': 1, 'b': {'c': 2.5, 'd': 'x'}, 'e': True, 'f': None}) == [('a', 1.0), ('b.c', 2.5)]
+
+
+@pytest.mark.parametrize('file_format', ['parquet', 'ipc'])
+def test_metrics_store(tmp_path, file_format):
+    store = MetricsStore(str(tmp_path), file_format=file_format)
+    for day in range(1, 6):
+        assert store.append('wt', make_result(datetime.datetime(2024, 5, day, 12), day)) == 2
+    store.append('other', make_result(datetime.datetime(2024, 5, 1, 12), 100))
+    assert len(store.get_files()) == 6
+    # 按日期目录过滤分区
+    assert len(store.get_files(datetime.datetime(2024, 5, 4), datetime.datetime(2024, 5, 5))) == 2
+
+    df = store.query('wt', metrics=['total_rows'], start_time=datetime.datetime(2024, 5, 2),
+                     end_time=datetime.datetime(2024, 5, 5))
+    assert df['value'].to_list() == [2, 3, 4]
+    assert df['name'].to_list() == ['wt_2', 'wt_3', 'wt_4']
+
+    df = store.query('wt', validator='expect_row_count_to_be_between', pivot=True)
+    assert df['total_rows'].to_list() == [1, 2, 3, 4, 5]
+    assert df['stats.mean'].to_list() == [0.5, 1, 1.5, 2, 2.5]
+    assert df['success'].to_list() == [False, True, True, True, True]
+
+    # 相同类型的校验器使用参数区分, 不会在pivot时丢失
+    result = make_result(datetime.datetime(2024, 6, 1, 12), 3)
+    other = ValidationResult(success=True, run_time=result['run_time'], metrics=dict(total_rows=7))
+    other.name = 'expect_row_count_to_be_between'
+    other.params = {'min_value': 1}
+    result['validators_result'].append(other)
+    store.append('same_class', result)
+    df = store.query('same_class', pivot=True).sort('total_rows')
+    assert df['total_rows'].to_list() == [3, 7]
+    assert df['params_hash'].n_unique() == 2
+
+    # 合并小文件后查询结果不变
+    before = store.query().sort(['wt_name', 'run_time', 'metric'])
+    assert store.compact() == 2
+    assert len(store.get_files()) == 6
+    assert store.query().sort(['wt_name', 'run_time', 'metric']).equals(before)
+    assert store.query('other')['value'].to_list() == [100, 50]
+    assert MetricsStore(str(tmp_path / 'empty')).query('wt').is_empty()
@@ -6,7 +6,9 @@ import polars as pl
 from data_watchtower import ExpectColumnValuesToNotBeNull, ExpectColumnRecentlyUpdated, \
     ExpectColumnStdToBeBetween, ExpectColumnMeanToBeBetween, ExpectColumnNullRatioToBeBetween, \
     ExpectRowCountToBeBetween, ExpectColumnDistinctValuesToContainSet, ExpectColumnDistinctValuesToEqualSet, \
-    ExpectColumnDistinctValuesToBeInSet
+    ExpectColumnDistinctValuesToBeInSet, ExpectColumnApproxDistinctCountToBeBetween, ExpectColumnQuantileToBeBetween, \
+    ExpectMetricToMatchBaseline, Watchtower
+from data_watchtower.core.baseline import MetricBaseline
 
 
 # 定义测试类
@@ -108,6 +110,30 @@ class TestValidators:
         assert result.success
         assert result.metrics['mean'] == 30
         assert round(result.metrics['std'], 2) == 15.81
+        assert result.metrics['min'] == 10
+        assert result.metrics['max'] == 50
+        assert result.metrics['quantiles']['0.5'] == 30
+        assert sum(result.metrics['histogram']['counts']) == 5
+        assert 'values' not in result.metrics
+
+        validator = ExpectColumnMeanToBeBetween(
+            ExpectColumnMeanToBeBetween.Params(column='column2', keep_values=True, max_values=3))
+        validator.set_data(df)
+        result = validator.validation()
+        assert result.metrics['values'] == [10, 20, 30]
+        assert result.metrics['values_truncated'] is True
+        # 分批合并时也只保留max_values条
+        batches = [Watchtower.compute_aggregates(batch, [validator])[0] for batch in df.iter_slices(2)]
+        merged = batches[0]
+        for item in batches[1:]:
+            merged = validator.merge_aggregates(merged, item)
+        assert merged['values'] == [10, 20, 30]
+        assert validator.validation(merged).metrics['values_truncated'] is True
+        # 分位数合并t-digest, 而不是按行数加权平均
+        assert validator.validation(merged).metrics['quantiles']['0.5'] == 30
+        with pytest.raises(ValueError):
+            ExpectColumnMeanToBeBetween(
+                ExpectColumnMeanToBeBetween.Params(column='column2', keep_values=True, max_values=None))
 
     def test_expect_column_null_ratio_to_be_between(self):
         # 创建需要的测试数据
@@ -200,3 +226,126 @@ class TestValidators:
         # 断言验证结果是否符合预期
         assert result.success is False
         assert set(result.metrics['excrescent_values']) == {'c', 'e'}
+
+    def test_fused_aggregates(self):
+        data = {
+            'column1': [1, 2, 3, 4, 5],
+            'column2': ['a', None, 'c', None, 'e']
+        }
+        df = pl.DataFrame(data)
+        validators = [
+            ExpectColumnMeanToBeBetween(ExpectColumnMeanToBeBetween.Params(column='column1', min_value=2)),
+            ExpectColumnStdToBeBetween(ExpectColumnStdToBeBetween.Params(column='column1', min_value=1)),
+            ExpectColumnNullRatioToBeBetween(ExpectColumnNullRatioToBeBetween.Params(column='column2')),
+            ExpectRowCountToBeBetween(ExpectRowCountToBeBetween.Params(min_value=3, max_value=7)),
+            ExpectColumnValuesToNotBeNull(ExpectColumnValuesToNotBeNull.Params(column='not_exists')),
+        ]
+        # 所有校验器的聚合只计算一次
+        aggregates = Watchtower.compute_aggregates(df, validators)
+        assert aggregates[-1] is None
+        for validator, item in zip(validators[:-1], aggregates[:-1]):
+            validator.set_data(df)
+            fused = validator.validation(item)
+            single = validator.validation()
+            assert fused.success == single.success
+            assert fused.metrics == single.metrics
+
+    def test_expect_column_approx_distinct_count_to_be_between(self):
+        df = pl.DataFrame({'column1': [i % 20000 for i in range(100000)] + [None] * 10})
+        params = ExpectColumnApproxDistinctCountToBeBetween.Params(column='column1', min_value=19000, max_value=21000)
+        validator = ExpectColumnApproxDistinctCountToBeBetween(params)
+        validator.set_data(df)
+        result = validator.validation()
+        assert result.success
+        assert abs(result.metrics['distinct_count'] - 20000) < 20000 * 0.02 * 3
+
+        # 基数较小时接近精确值
+        validator.set_data(pl.DataFrame({'column1': ['a', 'b', 'c', 'b', None]}))
+        result = validator.validation()
+        assert result.success is False
+        assert result.metrics['distinct_count'] == 3
+        with pytest.raises(ValueError):
+            ExpectColumnApproxDistinctCountToBeBetween(
+                ExpectColumnApproxDistinctCountToBeBetween.Params(column='column1', relative_error=0))
+
+    def test_expect_column_quantile_to_be_between(self):
+        df = pl.DataFrame({'column1': [float(i) for i in range(100001)] + [None]})
+        params = ExpectColumnQuantileToBeBetween.Params(column='column1', quantile=0.5, min_value=49000,
+                                                        max_value=51000)
+        validator = ExpectColumnQuantileToBeBetween(params)
+        validator.set_data(df.lazy())
+        result = validator.validation()
+        assert result.success
+        assert abs(result.metrics['quantile_value'] - 50000) < 100000 * 0.01
+        assert result.metrics['count'] == 100001
+
+        validator.set_data(pl.DataFrame({'column1': [None]}, schema={'column1': pl.Float64}))
+        result = validator.validation()
+        assert result.success is False
+        assert result.metrics['quantile_value'] is None
+        with pytest.raises(ValueError):
+            ExpectColumnQuantileToBeBetween(ExpectColumnQuantileToBeBetween.Params(column='column1', quantile=50))
+
+    def test_sketch_merge(self):
+        df = pl.DataFrame({
+            'column1': [i % 5000 for i in range(40000)],
+            'column2': [float(i) for i in range(40000)],
+        })
+        validators = [
+            ExpectColumnApproxDistinctCountToBeBetween(
+                ExpectColumnApproxDistinctCountToBeBetween.Params(column='column1')),
+            ExpectColumnQuantileToBeBetween(ExpectColumnQuantileToBeBetween.Params(column='column2', quantile=0.9)),
+        ]
+        merged = None
+        for batch in df.iter_slices(7000):
+            aggregates = Watchtower.compute_aggregates(batch, validators)
+            if merged is None:
+                merged = aggregates
+            else:
+                merged = [validator.merge_aggregates(left, right)
+                          for validator, left, right in zip(validators, merged, aggregates)]
+        distinct_result = validators[0].validation(merged[0])
+        quantile_result = validators[1].validation(merged[1])
+        assert abs(distinct_result.metrics['distinct_count'] - 5000) < 5000 * 0.02 * 3
+        assert abs(quantile_result.metrics['quantile_value'] - 36000) < 40000 * 0.01
+        # 合并后的sketch与一次计算全部数据的结果一致
+        validators[0].set_data(df)
+        assert validators[0].validation().metrics['sketch'] == distinct_result.metrics['sketch']
+
+    @pytest.mark.parametrize('method', ['zscore', 'mad'])
+    def test_expect_metric_to_match_baseline(self, method):
+        params = ExpectMetricToMatchBaseline.Params(metric='mean', column='column1', method=method, window=10,
+                                                    min_history=3)
+        validator = ExpectMetricToMatchBaseline(params)
+        assert validator.baseline_key() == 'mean:column1'
+        baseline = None
+        for i, value in enumerate([10, 12, 8, 11, 9, 10, 11]):
+            validator.baseline = MetricBaseline.load(baseline)
+            validator.set_data(pl.DataFrame({'column1': [value - 1, value + 1, None]}))
+            result = validator.validation()
+            assert result.success is True
+            assert result.metrics['history_count'] == i
+            assert ('score' in result.metrics) is (i >= 3)
+            baseline = result.extra['baseline']
+        assert baseline['count'] == 7
+        assert len(baseline['window']) == 7
+        # 明显偏离历史
+        validator.baseline = MetricBaseline.load(baseline)
+        validator.set_data(pl.DataFrame({'column1': [100, 100]}))
+        result = validator.validation()
+        assert result.success is False
+        assert result.metrics['score'] > 3
+
+        # 分批计算的聚合与一次计算的结果相同
+        df = pl.DataFrame({'column1': [float(i) if i % 3 else None for i in range(100)]})
+        for metric in ('row_count', 'null_ratio', 'std', 'max'):
+            validator = ExpectMetricToMatchBaseline(ExpectMetricToMatchBaseline.Params(metric=metric, column='column1'))
+            aggregates = [Watchtower.compute_aggregates(batch, [validator])[0] for batch in df.iter_slices(30)]
+            merged = aggregates[0]
+            for item in aggregates[1:]:
+                merged = validator.merge_aggregates(merged, item)
+            validator.set_data(df)
+            assert validator.validation(merged).metrics['value'] == pytest.approx(
+                validator.validation().metrics['value'])
+        with pytest.raises(ValueError):
+            ExpectMetricToMatchBaseline(ExpectMetricToMatchBaseline.Params(metric='mean'))